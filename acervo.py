@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Acervo local em Parquet (histórico sem reenviar XML)
+
+- Cada ingestão acrescenta arquivos novos em itens/ano=AAAA/mes=M/ e notas/ano=AAAA/mes=M/
+  (partições no estilo hive; nada do que já está gravado é reescrito)
+- Deduplicação pela chave de 44 dígitos (xml_sig = "ch:<chave>"; sem chave, sha1 do conteúdo):
+  nota que já está no acervo não entra de novo
+- Leitura preguiçosa via pyarrow.dataset: só abre as partições do período e aplica os filtros
+  de Data/cClassTrib no scan (pushdown nas estatísticas de cada row group)
+
+Uso:
+    info = _gravar_acervo(df_itens, notas)          # depois da extração (notas = resumo por nota)
+    itens, notas = _abrir_acervo(date(2026, 1, 1), date(2026, 12, 31), cclass=["000001"])
+    versao = _versao_acervo()                        # muda a cada gravação (deste ou de outro processo)
+"""
+import os
+import uuid
+import threading
+from datetime import date, datetime
+from pathlib import Path
+
+import pandas as pd
+
+from extrator import _pyarrow, _tabela_notas
+from campos_nfe import CAMPOS_ITEM_DETALHE
+
+ACERVO_DIR = Path(os.environ.get("EXTRATOR_ACERVO_DIR") or (Path(__file__).parent / "acervo"))
+
+# Colunas gravadas (o resto é recalculado na leitura, ex.: validação da base)
+COLUNAS_ITENS = {
+    "Data": "date",
+    "Numero": "str",
+    "Item/Serviço": "str",
+    "cClassTrib": "str",
+    "Valor da operação": "float",
+    "vIBS": "float",
+    "vCBS": "float",
+    "vProd": "float",
+    "vDesc": "float",
+    "vICMS_item": "float",
+    "vPIS_item": "float",
+    "vCOFINS_item": "float",
+    "arquivo": "str",
+    "Fonte do valor": "str",
+    "CNPJ Emitente": "str",
+    "xml_sig": "str",
+    # detalhe IBS/CBS, CFOP, NCM e CST (campos_nfe): itens gravados antes vêm vazios (null)
+    **{c[0]: "str" if c[2] == "texto" else "float" for c in CAMPOS_ITEM_DETALHE},
+}
+COLUNAS_NOTAS = {
+    "xml_sig": "str",
+    "chave": "str",
+    "Numero": "str",
+    "Data": "date",
+    "CNPJ Emitente": "str",
+    "vICMS": "float",
+    "vPIS": "float",
+    "vCOFINS": "float",
+    "vProd": "float",      # vProd/vDesc/vNF/itens_xml: notas gravadas antes vêm vazias (null)
+    "vDesc": "float",
+    "vNF": "float",
+    "itens": "int",
+    "itens_xml": "int",
+    "arquivo": "str",
+    "gravado_em": "timestamp",
+}
+
+_ACERVO_LOCK = threading.Lock()
+
+
+def _esquema(colunas: dict[str, str]):
+    pa, _ = _pyarrow()
+    tipos = {
+        "str": pa.string(),
+        "float": pa.float64(),
+        "int": pa.int32(),
+        "date": pa.date32(),
+        "timestamp": pa.timestamp("s"),
+    }
+    return pa.schema([(nome, tipos[t]) for nome, t in colunas.items()])
+
+
+def _particionamento():
+    pa, _ = _pyarrow()
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([("ano", pa.int16()), ("mes", pa.int8())]), flavor="hive")
+
+
+def _dataset(tabela: str, colunas: dict[str, str], raiz: Path | None = None):
+    """Dataset (preguiçoso) de itens/ ou notas/; None se ainda não existe nada gravado."""
+    import pyarrow.dataset as ds
+
+    pasta = (raiz or ACERVO_DIR) / tabela
+    if not pasta.is_dir():
+        return None
+    pa, _ = _pyarrow()
+    esquema = _esquema(colunas).append(pa.field("ano", pa.int16())).append(pa.field("mes", pa.int8()))
+    return ds.dataset(str(pasta), format="parquet", partitioning=_particionamento(), schema=esquema)
+
+
+def _ano_mes(datas: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """Partição de cada linha; sem data -> ano=0/mes=0."""
+    d = pd.to_datetime(datas, errors="coerce")
+    return d.dt.year.fillna(0).astype(int), d.dt.month.fillna(0).astype(int)
+
+
+def _para_tabela(df: pd.DataFrame, colunas: dict[str, str]):
+    pa, _ = _pyarrow()
+    df = df.reindex(columns=list(colunas))
+    for nome, t in colunas.items():
+        if t == "date":
+            df[nome] = pd.to_datetime(df[nome], errors="coerce").dt.date
+        elif t == "str":
+            df[nome] = df[nome].astype("string")
+    return pa.Table.from_pandas(df, schema=_esquema(colunas), preserve_index=False, safe=False)
+
+
+def _gravar_particoes(df: pd.DataFrame, tabela: str, colunas: dict[str, str], raiz: Path, lote: str) -> int:
+    import pyarrow.parquet as pq
+
+    if df.empty:
+        return 0
+    anos, meses = _ano_mes(df["Data"])
+    for (ano, mes), grupo in df.groupby([anos, meses], sort=True):
+        pasta = raiz / tabela / f"ano={ano}" / f"mes={mes}"
+        pasta.mkdir(parents=True, exist_ok=True)
+        final = pasta / f"part-{lote}.parquet"
+        # "." no início: o dataset ignora o arquivo enquanto ele não estiver completo
+        tmp = pasta / f".part-{lote}.tmp"
+        pq.write_table(_para_tabela(grupo, colunas), str(tmp), compression="zstd")
+        os.replace(tmp, final)
+    return len(df)
+
+
+def _sigs_no_acervo(notas: pd.DataFrame, raiz: Path) -> set[str]:
+    """xml_sig já gravados, lendo só a coluna xml_sig das partições que o lote toca."""
+    import pyarrow.dataset as ds
+
+    dset = _dataset("notas", COLUNAS_NOTAS, raiz)
+    if dset is None or notas.empty:
+        return set()
+    anos, meses = _ano_mes(notas["Data"])
+    filtro = None
+    for ano, mes in sorted(set(zip(anos, meses))):
+        f = (ds.field("ano") == ano) & (ds.field("mes") == mes)
+        filtro = f if filtro is None else (filtro | f)
+    sigs = dset.to_table(columns=["xml_sig"], filter=filtro).column("xml_sig")
+    return set(sigs.to_pylist())
+
+
+def _sigs_do_acervo(raiz: Path | None = None) -> set[str]:
+    """Todos os xml_sig já gravados (só a coluna xml_sig de notas/)."""
+    dset = _dataset("notas", COLUNAS_NOTAS, raiz)
+    if dset is None:
+        return set()
+    return set(dset.to_table(columns=["xml_sig"]).column("xml_sig").to_pylist())
+
+
+def _versao_acervo(raiz: Path | None = None) -> tuple:
+    """
+    Marca barata do conteúdo do acervo: (arquivos, maior mtime_ns) das pastas itens/, notas/ e das
+    partições. Toda gravação cria um arquivo numa pasta mes=M, então a marca muda junto (deste ou de
+    outro processo, ex.: o vigia); custa um scandir por partição, sem abrir Parquet.
+    """
+    raiz = raiz or ACERVO_DIR
+    arquivos, maior = 0, 0
+    pilha = [(raiz / "itens", 0), (raiz / "notas", 0)]
+    while pilha:
+        pasta, nivel = pilha.pop()
+        try:
+            maior = max(maior, pasta.stat().st_mtime_ns)
+            for e in os.scandir(pasta):
+                if nivel < 2 and e.is_dir():  # tabela/ano=/mes=
+                    pilha.append((Path(e.path), nivel + 1))
+                elif nivel == 2:
+                    arquivos += 1
+        except OSError:
+            continue
+    return arquivos, maior
+
+
+def _gravar_acervo(df_itens: pd.DataFrame, notas: list[dict], raiz: Path | None = None) -> dict:
+    """
+    Acrescenta ao acervo os itens/notas que ainda não estão lá.
+    Retorna {"notas_novas", "notas_existentes", "itens_gravados"}.
+    """
+    raiz = raiz or ACERVO_DIR
+    df_notas = _tabela_notas(notas).reindex(columns=[c for c in COLUNAS_NOTAS if c != "gravado_em"])
+    df_notas = df_notas.drop_duplicates("xml_sig")
+
+    with _ACERVO_LOCK:
+        existentes = _sigs_no_acervo(df_notas, raiz)
+        novas = df_notas[~df_notas["xml_sig"].isin(existentes)].copy()
+        novas["gravado_em"] = datetime.now().replace(microsecond=0)
+        itens = df_itens
+        if not itens.empty:
+            itens = itens[itens["xml_sig"].isin(set(novas["xml_sig"]))]
+
+        lote = f"{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+        n_itens = _gravar_particoes(itens, "itens", COLUNAS_ITENS, raiz, lote)
+        _gravar_particoes(novas, "notas", COLUNAS_NOTAS, raiz, lote)
+
+    return {
+        "notas_novas": len(novas),
+        "notas_existentes": len(df_notas) - len(novas),
+        "itens_gravados": n_itens,
+    }
+
+
+def _filtro_periodo(inicio: date | None, fim: date | None):
+    """Filtro nas partições (poda de diretórios) + na coluna Data (pushdown por row group)."""
+    pa, _ = _pyarrow()
+    import pyarrow.dataset as ds
+
+    ano, mes, data = ds.field("ano"), ds.field("mes"), ds.field("Data")
+    filtro = None
+
+    def _e(a, b):
+        return b if a is None else (a & b)
+
+    if inicio is not None:
+        filtro = _e(filtro, (ano > inicio.year) | ((ano == inicio.year) & (mes >= inicio.month)))
+        filtro = _e(filtro, data >= pa.scalar(inicio, pa.date32()))
+    if fim is not None:
+        filtro = _e(filtro, (ano < fim.year) | ((ano == fim.year) & (mes <= fim.month)))
+        filtro = _e(filtro, data <= pa.scalar(fim, pa.date32()))
+    return filtro
+
+
+def _abrir_acervo(inicio: date | None = None, fim: date | None = None, cclass: list[str] | None = None,
+                  raiz: Path | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Reabre um período do acervo sem reprocessar XML.
+    Retorna (itens, notas) no mesmo formato da extração (colunas do app; Data em datetime64).
+    cclass filtra só os itens; as notas (totais ICMSTot) vêm do período inteiro.
+    """
+    import pyarrow.dataset as ds
+
+    filtro = _filtro_periodo(inicio, fim)
+    saida = []
+    for tabela, colunas, extra in (
+        ("itens", COLUNAS_ITENS, ds.field("cClassTrib").isin(list(cclass)) if cclass else None),
+        ("notas", COLUNAS_NOTAS, None),
+    ):
+        dset = _dataset(tabela, colunas, raiz)
+        if dset is None:
+            saida.append(pd.DataFrame(columns=list(colunas)))
+            continue
+        f = filtro if extra is None else (extra if filtro is None else filtro & extra)
+        # Data como datetime64 (como a tabela do upload): filtros de período sem conversão
+        df = dset.to_table(columns=list(colunas), filter=f).to_pandas(date_as_object=False)
+        for nome, t in colunas.items():
+            if t == "str":
+                df[nome] = df[nome].astype(object).where(df[nome].notna(), None)
+        saida.append(df)
+    return saida[0], saida[1]
@@ -10,19 +10,43 @@ Como rodar:
   python -m streamlit run app.py
 """
 import io
-import zipfile
-from datetime import datetime, date
-import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from itertools import islice
+from datetime import date
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 import streamlit.components.v1 as components
-import html
 import time
-import hashlib
 from openpyxl import load_workbook
 from textwrap import dedent
 
+from extrator import (
+    TOLERANCIA_BASE_IBSCBS, _safe_num, aplicar_validacao_base_ibscbs, _ordem_divergencia,
+    FORMATOS_COLUNARES, _exportar_colunar, _itens_validados, _n_itens, _tabela_itens,
+    _tabela_notas,
+)
+from formato_br import _moeda_br, _moeda_br_valor, _html_escapar, _html_valor
+from acervo import ACERVO_DIR, _gravar_acervo, _abrir_acervo, _versao_acervo
+from ingestao import (
+    _iniciar_ingestao, _coletar_ingestao, _aguardar_ingestao, _cancelar_ingestao, _progresso_ingestao,
+    _ingestao_concluida,
+)
+from busca_itens import _indice_para
+from filtros_itens import _cache_filtros_novo, _assinatura, _recorte, _validado_do_recorte, _ordem_do_recorte
+from conciliacao import _conciliar_notas, _resumo_conciliacao
+from banco_itens import BANCO_PATH, _conectar, _gravar_banco, _consultar_itens, _resumo_banco
+from planilha_export import (
+    _append_to_workbook_streaming, _append_to_workbook_xml, _perfil_template,
+    _checar_limite_excel, _gerar_zip_particoes,
+)
+
+# Copy-on-Write: recortes/colunas derivadas da tabela base não copiam dados até alguém escrever neles
+# (no pandas >= 3 já é sempre assim e a opção está obsoleta)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
 # -----------------------------
 # Page config + CSS (Figma-like)
 # -----------------------------
@@ -1127,286 +1151,104 @@ SPINNER_HTML = dedent("""
 """)
 
 
-# -----------------------------
-# XML helpers
-# -----------------------------
-def _local(tag: str) -> str:
-    # "{ns}Tag" -> "Tag"
-    return tag.split("}", 1)[-1] if "}" in tag else tag
-
-def _find_text(elem: ET.Element, path: str) -> str | None:
-    x = elem.find(path)
-    if x is None or x.text is None:
-        return None
-    return x.text.strip()
-
-def _parse_date(root: ET.Element) -> date | None:
-    """
-    Tenta pegar data de emissão:
-      - NFe/infNFe/ide/dhEmi (ISO datetime) ou dEmi (YYYY-MM-DD)
-    """
-    for p in [
-        ".//{*}infNFe/{*}ide/{*}dhEmi",
-        ".//{*}infNFe/{*}ide/{*}dEmi",
-        ".//{*}ide/{*}dhEmi",
-        ".//{*}ide/{*}dEmi",
-    ]:
-        t = _find_text(root, p)
-        if not t:
-            continue
-        try:
-            # dhEmi pode ser "2026-01-08T10:22:33-03:00"
-            if "T" in t:
-                # remove timezone para parse mais simples
-                base = t.split("T")[0]
-                return datetime.fromisoformat(base).date() if len(base) > 10 else datetime.fromisoformat(t[:19]).date()
-            return datetime.fromisoformat(t).date()
-        except Exception:
-            try:
-                return datetime.strptime(t[:10], "%Y-%m-%d").date()
-            except Exception:
-                pass
-    return None
-
-def _parse_nnf(root: ET.Element) -> str | None:
-    # Número da NF: ide/nNF
-    for p in [".//{*}infNFe/{*}ide/{*}nNF", ".//{*}ide/{*}nNF"]:
-        t = _find_text(root, p)
-        if t:
-            return t
-    return None
-
-
-def _extract_nfe_key(xml_bytes: bytes) -> str:
-    """Tenta extrair a chave (44 dígitos) da NFe/NFCe.
-    - Prioriza Id do infNFe (ex.: Id="NFe3519...")
-    - Fallback para tags chNFe comuns em protNFe/infProt ou eventos.
-    Retorna "" se não encontrar.
-    """
-    try:
-        root = ET.fromstring(xml_bytes)
-    except Exception:
-        return ""
-
-    # 1) infNFe @Id (mais comum)
-    inf = root.find(".//{*}infNFe")
-    if inf is not None:
-        idv = inf.attrib.get("Id") or inf.attrib.get("id") or ""
-        digits = "".join(ch for ch in idv if ch.isdigit())
-        if len(digits) >= 44:
-            return digits[-44:]
-
-    # 2) chNFe em protocolos
-    ch = (
-        _find_text(root, ".//{*}protNFe/{*}infProt/{*}chNFe")
-        or _find_text(root, ".//{*}infProt/{*}chNFe")
-        or _find_text(root, ".//{*}chNFe")
-        or ""
-    )
-    ch_digits = "".join(chh for chh in ch if chh.isdigit())
-    if len(ch_digits) >= 44:
-        return ch_digits[-44:]
-    return ""
-
-
-def _xml_signature(xml_bytes: bytes) -> str:
-    """Assinatura estável para deduplicação:
-    - Se achar chave, usa chave (melhor)
-    - Senão, usa hash do conteúdo (sha1)
-    """
-    chave = _extract_nfe_key(xml_bytes)
-    if chave:
-        return f"ch:{chave}"
-    return "sha1:" + hashlib.sha1(xml_bytes).hexdigest()
-
-def _parse_items_from_xml(xml_bytes: bytes, filename: str) -> list[dict]:
-    """
-    Extrai itens (det) e IBS/CBS:
-      - Item/Serviço: det/prod/xProd
-      - cClassTrib: imposto/IBSCBS/cClassTrib
-      - Base (vBC): imposto/IBSCBS/vBC
-      - vIBS / vCBS: imposto/IBSCBS/vIBS, vCBS (se existirem)
-    """
-    try:
-        root = ET.fromstring(xml_bytes)
-    except Exception:
-        return []
-
-    emissao = _parse_date(root)
-    nnf = _parse_nnf(root)
-
-    rows: list[dict] = []
-    dets = root.findall(".//{*}infNFe/{*}det") or root.findall(".//{*}det")
-    for det in dets:
-        xprod = _find_text(det, ".//{*}prod/{*}xProd") or ""
-        # Componentes do item (para validação por subtração)
-        vprod = _find_text(det, ".//{*}prod/{*}vProd")
-        vdesc = _find_text(det, ".//{*}prod/{*}vDesc")
-
-        # Tributos por ITEM (quando existirem)
-        vicms_item = _find_text(det, ".//{*}imposto/{*}ICMS//{*}vICMS")
-        vpis_item = _find_text(det, ".//{*}imposto/{*}PIS//{*}vPIS")
-        vcof_item = _find_text(det, ".//{*}imposto/{*}COFINS//{*}vCOFINS")
-
-        ibscbs = det.find(".//{*}imposto/{*}IBSCBS")
-        if ibscbs is None:
-            # alguns XML podem não ter IBSCBS -> ignora item
-            continue
-
-        cclass = _find_text(ibscbs, ".//{*}cClassTrib") or ""
-        vbc = _find_text(ibscbs, ".//{*}vBC")
-        vibs = _find_text(ibscbs, ".//{*}vIBS")
-        vcbs = _find_text(ibscbs, ".//{*}vCBS")
-
-        def _to_float(x: str | None):
-            try:
-                if x in (None, ""):
-                    return None
-                # suporta vírgula decimal
-                s = str(x).strip().replace(",", ".")
-                return float(s)
-            except Exception:
-                return None
-
-        def _to_float0(x: str | None) -> float:
-            v = _to_float(x)
-            return float(v) if v is not None else 0.0
-
-        vbc_f = _to_float(vbc)
-        vibs_f = _to_float(vibs)
-        vcbs_f = _to_float(vcbs)
-
-        # Componentes para validação por subtração (sempre em float)
-        vprod_f = _to_float0(vprod)
-        vdesc_f = _to_float0(vdesc)
-        vicms_item_f = _to_float0(vicms_item)
-        vpis_item_f = _to_float0(vpis_item)
-        vcof_item_f = _to_float0(vcof_item)
-
-        # Fonte do valor (base)
-        fonte = "IBSCBS/vBC" if vbc_f is not None else ""
-
-        rows.append(
-            {
-                "Data": emissao,
-                "Numero": nnf,
-                "Item/Serviço": xprod,
-                "cClassTrib": cclass,
-                "Valor da operação": vbc_f,
-                "vIBS": vibs_f,
-                "vCBS": vcbs_f,
-                "vProd": vprod_f,
-                "vDesc": vdesc_f,
-                "vICMS_item": vicms_item_f,
-                "vPIS_item": vpis_item_f,
-                "vCOFINS_item": vcof_item_f,
-                "arquivo": filename,
-                "Fonte do valor": fonte,
-            }
-        )
-
-    return rows
-
-
-
-def _parse_tax_totals_from_xml(xml_bytes: bytes) -> dict:
-    """Extrai totais do XML (por NOTA) via ICMSTot:
-    - vICMS (ICMS próprio)
-    - vPIS
-    - vCOFINS
-    """
-    try:
-        root = ET.fromstring(xml_bytes)
-    except Exception:
-        return {"vICMS": 0.0, "vPIS": 0.0, "vCOFINS": 0.0}
-
-    def _to_float(x: str | None) -> float:
-        try:
-            return float(x) if x not in (None, "") else 0.0
-        except Exception:
-            return 0.0
-
-    vICMS = _find_text(root, ".//{*}ICMSTot/{*}vICMS")
-    vPIS = _find_text(root, ".//{*}ICMSTot/{*}vPIS")
-    vCOF = _find_text(root, ".//{*}ICMSTot/{*}vCOFINS")
-
-    return {"vICMS": _to_float(vICMS), "vPIS": _to_float(vPIS), "vCOFINS": _to_float(vCOF)}
-
-
 # ============================
-# Validação Premium IBS/CBS
-# Regra: Base Calc = vProd − vDesc − vICMS_item − vPIS_item − vCOFINS_item
-# Zero tolerância: precisa bater exatamente (0,00).
+# Validação Premium IBS/CBS (painel)
+# Parse do XML e regra da base ficam em extrator.py
 # ============================
+def _html_memoria_calculo(row) -> tuple[str, str]:
+    """(status do item, HTML da memória de cálculo): a parte do painel que depende só do item."""
+    vProd = _safe_num(row.get("vProd"))
+    vDesc = _safe_num(row.get("vDesc"))
+    vICMS = _safe_num(row.get("vICMS_item"))
+    vPIS  = _safe_num(row.get("vPIS_item"))
+    vCOF  = _safe_num(row.get("vCOFINS_item"))
 
-TOLERANCIA_BASE_IBSCBS = 0.0  # ZERO TOLERÂNCIA
-
-def _br_money(v: float) -> str:
-    try:
-        s = f"{float(v):,.2f}"
-        return s.replace(",", "X").replace(".", ",").replace("X", ".")
-    except Exception:
-        return "0,00"
-
-def _safe_num(x) -> float:
-    try:
-        if x in (None, ""):
-            return 0.0
-        if isinstance(x, str):
-            x = x.strip().replace(".", "").replace(",", ".")
-        return float(x)
-    except Exception:
-        return 0.0
+    base_xml = float(row["Base IBS/CBS (XML)"])
+    base_calc = float(row["Base IBS/CBS (Calc)"])
+    dif = float(row["Dif Base IBS/CBS"])
 
-def aplicar_validacao_base_ibscbs(df_itens: pd.DataFrame) -> pd.DataFrame:
-    """Adiciona colunas de validação IBS/CBS (por item)."""
-    df = df_itens.copy()
+    status_item = "OK" if abs(dif) <= TOLERANCIA_BASE_IBSCBS else "Divergente"
 
-    # Base do XML já vem em 'Valor da operação' (IBSCBS/vBC) no seu app
-    if "Valor da operação" in df.columns:
-        base_xml = df["Valor da operação"].fillna(0).apply(_safe_num)
-    else:
-        base_xml = pd.Series([0.0]*len(df), index=df.index)
+    html_calc = f"""
+  <div class="ibscbs-calc">
+  <div class="calc-left">
+    <div class="calc-head">
+      <div class="t">Memória de cálculo</div>
+      <div class="calc-badge"><span class="dot"></span>{status_item}</div>
+    </div>
 
-    vProd = df.get("vProd", 0)
-    vDesc = df.get("vDesc", 0)
-    vICMS = df.get("vICMS_item", 0)
-    vPIS = df.get("vPIS_item", 0)
-    vCOF = df.get("vCOFINS_item", 0)
+    <div class="calc-lines">
+      <div class="calc-line">
+        <div class="name"><i>+</i>vProd</div>
+        <div class="val">R$ {_moeda_br_valor(vProd)}</div>
+      </div>
 
-    vProd = pd.Series(vProd).fillna(0).apply(_safe_num)
-    vDesc = pd.Series(vDesc).fillna(0).apply(_safe_num)
-    vICMS = pd.Series(vICMS).fillna(0).apply(_safe_num)
-    vPIS  = pd.Series(vPIS).fillna(0).apply(_safe_num)
-    vCOF  = pd.Series(vCOF).fillna(0).apply(_safe_num)
+      <div class="calc-line minus">
+        <div class="name"><i>−</i>vDesc</div>
+        <div class="val">R$ {_moeda_br_valor(vDesc)}</div>
+      </div>
 
-    base_calc = (vProd - vDesc - vICMS - vPIS - vCOF).round(2)
-    dif = (base_calc - base_xml).round(2)
+      <div class="calc-line icms">
+        <div class="name"><i>−</i>ICMS</div>
+        <div class="val">R$ {_moeda_br_valor(vICMS)}</div>
+      </div>
 
-    status = dif.apply(lambda d: "OK" if abs(d) <= TOLERANCIA_BASE_IBSCBS else "Divergente")
+      <div class="calc-line pis">
+        <div class="name"><i>−</i>PIS</div>
+        <div class="val">R$ {_moeda_br_valor(vPIS)}</div>
+      </div>
 
-    df["Base IBS/CBS (XML)"] = base_xml.round(2)
-    df["Base IBS/CBS (Calc)"] = base_calc
-    df["Dif Base IBS/CBS"] = dif
-    df["Status Base IBS/CBS"] = status
+      <div class="calc-line cof">
+        <div class="name"><i>−</i>COFINS</div>
+        <div class="val">R$ {_moeda_br_valor(vCOF)}</div>
+      </div>
+    </div>
 
-    # Diagnóstico curto (premium)
-    def _diag(row):
-        if row["Status Base IBS/CBS"] == "OK":
-            return "✓ Base bateu exatamente (0,00)"
-        # Se calc zerou mas XML > 0: normalmente faltam tributos por item (ou vProd não veio)
-        if row["Base IBS/CBS (Calc)"] == 0 and row["Base IBS/CBS (XML)"] > 0:
-            return "Componentes do item vieram 0,00 (ver vProd/vDesc/tributos por item)"
-        return "Base do XML não bate com a decomposição do item (subtração)"
+    <div class="calc-eq">
+      <div class="eq">= Base Calc</div>
+      <div class="res">R$ {_moeda_br_valor(base_calc)}</div>
+    </div>
+  </div>
 
-    df["Diagnóstico Base IBS/CBS"] = df.apply(_diag, axis=1)
+  <div class="calc-right">
+    <div class="row"><span>Base XML</span><b>R$ {_moeda_br_valor(base_xml)}</b></div>
+    <div class="row"><span>Base Calc</span><b>R$ {_moeda_br_valor(base_calc)}</b></div>
+    <div class="row"><span>Diferença</span><b>R$ {_moeda_br_valor(dif)}</b></div>
 
-    return df
+    <div class="delta">
+      <div class="row {('status-ok' if status_item=='OK' else 'status-bad')}"><span>Status do item</span><b>{status_item}</b></div>
+      <div class="row"><span>Nº da nota</span><b>{_html_valor(row.get('Numero','') or '')}</b></div>
+      <div class="row"><span>Arquivo</span><b>{_html_valor(row.get('arquivo',''))}</b></div>
+    </div>
+  </div>
+</div>
 
+"""
+    return status_item, html_calc
+
+def _detalhe_item(row, chave=None) -> tuple[str, str]:
+    """_html_memoria_calculo com cache por (versão do dataset, id_item); chave None = sem cache."""
+    if chave is None:
+        return _html_memoria_calculo(row)
+    cache = st.session_state.setdefault("cache_detalhe_itens", OrderedDict())
+    if chave in cache:
+        cache.move_to_end(chave)
+    else:
+        cache[chave] = _html_memoria_calculo(row)
+        while len(cache) > CAPACIDADE_CACHE_DETALHE:
+            cache.popitem(last=False)
+    return cache[chave]
 
-def render_painel_validacao_premium(df_validado: pd.DataFrame, *, key_prefix: str = "ibscbs"):
+@st.fragment
+def render_painel_validacao_premium(df_validado: pd.DataFrame, *, key_prefix: str = "ibscbs", ordem=None, versao=None):
     """Retângulo premium com resumo + cálculo detalhado.
 
+    Fragmento: trocar o item detalhado ou "só divergentes" roda só este painel.
+    `ordem`: posições (iloc) de df_validado por divergência decrescente (_ordem_divergencia), se já calculadas.
+    O seletor mostra uma página de ITENS_POR_PAGINA_SELETOR itens (busca e paginação ficam no servidor).
+    O item escolhido é o rótulo do índice (id_item na tabela do upload/acervo): continua o mesmo quando
+    os filtros mudam. Com `versao` (versão do dataset), a memória de cálculo de cada id fica em cache.
+
     ✅ Fix:
     - Dropdown pode mostrar só divergentes
     - Painel de detalhe renderiza via components.html (não vira texto/código)
@@ -1685,7 +1527,8 @@ def render_painel_validacao_premium(df_validado: pd.DataFrame, *, key_prefix: st
     chip_txt = "✓ Validado (0,00)" if status_global_ok else f"⚠ Divergências ({div})"
 
     # Exportar só divergentes
-    df_div = df_validado[df_validado["Status Base IBS/CBS"] != "OK"].copy()
+    # sem .copy(): com Copy-on-Write os recortes só copiam se alguém escrever neles
+    df_div = df_validado[df_validado["Status Base IBS/CBS"] != "OK"]
     if not df_div.empty:
         csv_div = df_div.to_csv(index=False, sep=';', encoding='utf-8')
         st.download_button(
@@ -1704,29 +1547,67 @@ def render_painel_validacao_premium(df_validado: pd.DataFrame, *, key_prefix: st
         help="Filtra o seletor e mostra apenas itens com Status = Divergente."
     )
 
-    df_tmp = df_validado.copy()
-    if show_only_div:
-        df_tmp = df_tmp[df_tmp["Status Base IBS/CBS"] != "OK"].copy()
+    # ranking por |diferença| sem ordenar a tabela: as divergentes são o começo da ordem
+    if ordem is None:
+        ordem = _ordem_divergencia(df_validado["Dif Base IBS/CBS"])
+    candidatos = ordem[:div] if show_only_div else ordem
 
-    if df_tmp.empty:
+    if len(candidatos) == 0:
         st.success("✅ Nenhuma divergência encontrada. (Tudo OK)")
         return
 
-    df_tmp["_absdif"] = df_tmp["Dif Base IBS/CBS"].abs()
-    df_tmp = df_tmp.sort_values("_absdif", ascending=False)
+    label_col = "Item/Serviço" if "Item/Serviço" in df_validado.columns else df_validado.columns[0]
+    rotulos = df_validado[label_col]
+    difs = df_validado["Dif Base IBS/CBS"]
 
-    label_col = "Item/Serviço" if "Item/Serviço" in df_tmp.columns else df_tmp.columns[0]
-    options = df_tmp[label_col].fillna("").astype(str).tolist()
+    c_busca, c_pag = st.columns([3, 1])
+    with c_busca:
+        busca_sel = st.text_input(
+            "Procurar item no seletor",
+            key=f"{key_prefix}_busca",
+            placeholder="parte da descrição",
+        )
+    if busca_sel and busca_sel.strip():
+        achou = rotulos.iloc[candidatos].astype(str).str.contains(busca_sel.strip(), case=False, regex=False, na=False)
+        candidatos = candidatos[achou.to_numpy()]
+        if len(candidatos) == 0:
+            st.info("Nenhum item do seletor contém esse texto.")
+            return
+
+    n_paginas = max(1, -(-len(candidatos) // ITENS_POR_PAGINA_SELETOR))
+    pagina = 1
+    with c_pag:
+        if n_paginas > 1:
+            if st.session_state.get(f"{key_prefix}_pagina", 1) > n_paginas:
+                st.session_state[f"{key_prefix}_pagina"] = n_paginas
+            pagina = int(st.number_input(f"Página (de {n_paginas})", min_value=1, max_value=n_paginas, step=1,
+                                         key=f"{key_prefix}_pagina"))
+    ini = (pagina - 1) * ITENS_POR_PAGINA_SELETOR
+    pagina_pos = candidatos[ini:ini + ITENS_POR_PAGINA_SELETOR]
+    options = df_validado.index[pagina_pos].tolist()
+
+    # rótulos da página de uma vez (formato_br), em vez de formatar item a item no format_func
+    textos = rotulos.iloc[pagina_pos]
+    textos = textos.where(textos.notna(), "").astype(str).to_numpy(dtype=object)
+    d = difs.iloc[pagina_pos].to_numpy(dtype=float)
+    rotulos_pagina = dict(zip(options, np.where(
+        np.abs(d) > TOLERANCIA_BASE_IBSCBS, textos + " · dif R$ " + _moeda_br(d).astype(object), textos,
+    ).tolist()))
+
+    def _rotulo(id_item) -> str:
+        return rotulos_pagina.get(id_item, str(id_item))
 
     pick = st.selectbox(
         "Detalhar cálculo (selecione um item)",
         options=options,
         index=0,
+        format_func=_rotulo,
         key=f"{key_prefix}_pick",
-        help="Mostra a decomposição do item: vProd − vDesc − ICMS_item − PIS_item − COFINS_item."
+        help="Mostra a decomposição do item: vProd − vDesc − ICMS_item − PIS_item − COFINS_item. "
+             "Itens em ordem de maior diferença; use a busca e a página para achar os demais."
     )
 
-    row = df_tmp[df_tmp[label_col].astype(str) == str(pick)].iloc[0]
+    row = df_validado.loc[pick]
 
     # Download do XML da nota selecionada (individual)
     try:
@@ -1753,22 +1634,8 @@ def render_painel_validacao_premium(df_validado: pd.DataFrame, *, key_prefix: st
         pass
 
 
-    vProd = _safe_num(row.get("vProd"))
-    vDesc = _safe_num(row.get("vDesc"))
-    vICMS = _safe_num(row.get("vICMS_item"))
-    vPIS  = _safe_num(row.get("vPIS_item"))
-    vCOF  = _safe_num(row.get("vCOFINS_item"))
-
-    base_xml = float(row["Base IBS/CBS (XML)"])
-    base_calc = float(row["Base IBS/CBS (Calc)"])
-    dif = float(row["Dif Base IBS/CBS"])
-
-    status_item = "OK" if abs(dif) <= TOLERANCIA_BASE_IBSCBS else "Divergente"
+    status_item, html_calc = _detalhe_item(row, None if versao is None else (versao, pick))
     panel_class = "ibscbs-panel" + (" divergente" if status_item != "OK" else "")
-    formula = (
-        f"vProd ({_br_money(vProd)})  −  vDesc ({_br_money(vDesc)})  −  ICMS ({_br_money(vICMS)})  −  PIS ({_br_money(vPIS)})  −  COFINS ({_br_money(vCOF)})\n"
-        f"= Base Calc ({_br_money(base_calc)})"
-    )
 
     panel = f"""
 <div class="{panel_class}">
@@ -1785,66 +1652,14 @@ def render_painel_validacao_premium(df_validado: pd.DataFrame, *, key_prefix: st
 
   <div class="ibscbs-metrics">
     <div class="ibscbs-metric"><p class="k">Itens</p><p class="v">{total}</p><p class="s">Total analisado</p></div>
-    <div class="ibscbs-metric"><p class="k">Soma Base (XML)</p><p class="v">R$ {_br_money(soma_xml)}</p><p class="s">Total do XML</p></div>
-    <div class="ibscbs-metric"><p class="k">Soma Base (Calc)</p><p class="v">R$ {_br_money(soma_calc)}</p><p class="s">Subtração por item</p></div>
-    <div class="ibscbs-metric"><p class="k">Diferença</p><p class="v">R$ {_br_money(delta_total)}</p><p class="s">Calc − XML</p></div>
+    <div class="ibscbs-metric"><p class="k">Soma Base (XML)</p><p class="v">R$ {_moeda_br_valor(soma_xml)}</p><p class="s">Total do XML</p></div>
+    <div class="ibscbs-metric"><p class="k">Soma Base (Calc)</p><p class="v">R$ {_moeda_br_valor(soma_calc)}</p><p class="s">Subtração por item</p></div>
+    <div class="ibscbs-metric"><p class="k">Diferença</p><p class="v">R$ {_moeda_br_valor(delta_total)}</p><p class="s">Calc − XML</p></div>
   </div>
 
   <div class="ibscbs-divider"></div>
 
-  <div class="ibscbs-calc">
-  <div class="calc-left">
-    <div class="calc-head">
-      <div class="t">Memória de cálculo</div>
-      <div class="calc-badge"><span class="dot"></span>{status_item}</div>
-    </div>
-
-    <div class="calc-lines">
-      <div class="calc-line">
-        <div class="name"><i>+</i>vProd</div>
-        <div class="val">R$ {_br_money(vProd)}</div>
-      </div>
-
-      <div class="calc-line minus">
-        <div class="name"><i>−</i>vDesc</div>
-        <div class="val">R$ {_br_money(vDesc)}</div>
-      </div>
-
-      <div class="calc-line icms">
-        <div class="name"><i>−</i>ICMS</div>
-        <div class="val">R$ {_br_money(vICMS)}</div>
-      </div>
-
-      <div class="calc-line pis">
-        <div class="name"><i>−</i>PIS</div>
-        <div class="val">R$ {_br_money(vPIS)}</div>
-      </div>
-
-      <div class="calc-line cof">
-        <div class="name"><i>−</i>COFINS</div>
-        <div class="val">R$ {_br_money(vCOF)}</div>
-      </div>
-    </div>
-
-    <div class="calc-eq">
-      <div class="eq">= Base Calc</div>
-      <div class="res">R$ {_br_money(base_calc)}</div>
-    </div>
-  </div>
-
-  <div class="calc-right">
-    <div class="row"><span>Base XML</span><b>R$ {_br_money(base_xml)}</b></div>
-    <div class="row"><span>Base Calc</span><b>R$ {_br_money(base_calc)}</b></div>
-    <div class="row"><span>Diferença</span><b>R$ {_br_money(dif)}</b></div>
-
-    <div class="delta">
-      <div class="row {('status-ok' if status_item=='OK' else 'status-bad')}"><span>Status do item</span><b>{status_item}</b></div>
-      <div class="row"><span>Nº da nota</span><b>{_h(str(row.get('Numero','') or ''))}</b></div>
-      <div class="row"><span>Arquivo</span><b>{_h(row.get('arquivo',''))}</b></div>
-    </div>
-  </div>
-</div>
-
+{html_calc}
 <div class="ibscbs-foot">Regra rígida: diferença precisa ser <b>0,00</b>. Qualquer centavo vira divergência.</div>
 </div>
 """
@@ -1853,32 +1668,23 @@ def render_painel_validacao_premium(df_validado: pd.DataFrame, *, key_prefix: st
     st.markdown(_html_clean(panel), unsafe_allow_html=True)
 
 
-def _detect_cancel_event(xml_bytes: bytes) -> dict | None:
-    """Detecta XML de evento de cancelamento (procEventoNFe / evento).
-    Retorna dict com dados úteis ou None se não for cancelamento.
-    """
-    try:
-        root = ET.fromstring(xml_bytes)
-    except Exception:
-        return None
-
-    # Procura tpEvento=110111 (Cancelamento)
-    tp = _find_text(root, ".//{*}detEvento/{*}tpEvento") or _find_text(root, ".//{*}tpEvento")
-    if tp != "110111":
-        return None
-
-    ch = _find_text(root, ".//{*}infEvento/{*}chNFe") or _find_text(root, ".//{*}chNFe") or ""
-    dh = _find_text(root, ".//{*}infEvento/{*}dhEvento") or _find_text(root, ".//{*}dhEvento") or ""
-    nprot = _find_text(root, ".//{*}infEvento/{*}nProt") or _find_text(root, ".//{*}nProt") or ""
-    xjust = _find_text(root, ".//{*}detEvento/{*}xJust") or _find_text(root, ".//{*}xJust") or ""
-
-    return {"chNFe": ch, "dhEvento": dh, "nProt": nprot, "xJust": xjust}
-
-
-
 # -----------------------------
 # Excel write helper
 # -----------------------------
+# Writers disponíveis no "Gerar planilha" (os dois primeiros ficam em planilha_export.py)
+MODOS_PLANILHA = {
+    "XML direto (rápido)": "xml",
+    "Streaming (reconstrói a aba)": "streaming",
+    "openpyxl (compatível)": "openpyxl",
+}
+
+# Saída: arquivo único ou um .xlsx por partição (ZIP); a partição sempre usa o writer XML direto
+SAIDAS_PLANILHA = {
+    "Arquivo único": None,
+    "Gerar por competência (ZIP)": "mes",
+    "Um arquivo por CNPJ emitente (ZIP)": "cnpj",
+}
+
 def _append_to_workbook(template_bytes: bytes, df: pd.DataFrame) -> bytes:
     """
     Abre o template e grava df na aba LANCAMENTOS, acrescentando linhas.
@@ -1896,56 +1702,17 @@ def _append_to_workbook(template_bytes: bytes, df: pd.DataFrame) -> bytes:
     ws = wb["LANCAMENTOS"] if "LANCAMENTOS" in wb.sheetnames else wb.active
 
     # ------------------------------------------------------------
-    # 1) Descobre em qual linha estão os cabeçalhos (layout pode mudar)
-    # ------------------------------------------------------------
-    expected = {"Data", "Numero", "Item/Serviço", "cClassTrib", "Valor da operação"}
-    header_row = None
-
-    # procura nos primeiros 25 rows (suficiente pro seu layout)
-    for r in range(1, 26):
-        values = []
-        for c in range(1, 101):  # lê até 100 colunas (bem além do necessário)
-            v = ws.cell(row=r, column=c).value
-            if isinstance(v, str):
-                values.append(v.strip())
-        hit = len(expected.intersection(values))
-        if hit >= 3:  # achou linha com a maioria dos cabeçalhos
-            header_row = r
-            break
-
-    if header_row is None:
-        # fallback antigo (assume linha 1)
-        header_row = 1
-
-    # mapeia "nome do cabeçalho" -> coluna
-    headers: dict[str, int] = {}
-    last_col = 0
-    for col in range(1, 201):  # até 200 colunas
-        v = ws.cell(row=header_row, column=col).value
-        if isinstance(v, str) and v.strip():
-            headers[v.strip()] = col
-            last_col = max(last_col, col)
-
-    # se ainda não achou nada (planilha muito custom), tenta usar as colunas usadas do sheet
-    if last_col == 0:
-        last_col = min(ws.max_column, 200)
-
-    # ------------------------------------------------------------
-    # 2) Define a "linha modelo" (a primeira linha de dados com fórmulas)
+    # 1) a 3) Linha de cabeçalhos, mapa "cabeçalho" -> coluna, linha modelo e
+    #    próxima linha vazia (coluna "Data"): vêm do perfil do template, que é
+    #    analisado 1x por arquivo (cache por hash em planilha_export.py).
     #    No seu modelo: header_row=2, a linha 3 é seção, a 4 é a linha modelo.
     # ------------------------------------------------------------
-    template_row = header_row + 2
-
-    # ------------------------------------------------------------
-    # 3) Descobre a próxima linha vazia olhando a coluna "Data"
-    # ------------------------------------------------------------
-    next_row = ws.max_row + 1
-    if "Data" in headers:
-        c = headers["Data"]
-        r = ws.max_row
-        while r >= (template_row) and ws.cell(row=r, column=c).value in (None, ""):
-            r -= 1
-        next_row = max(r + 1, template_row)
+    perfil = _perfil_template(template_bytes)
+    headers: dict[str, int] = dict(perfil["headers"])
+    last_col = perfil["last_col"]
+    template_row = perfil["template_row"]
+    next_row = perfil["next_row"]
+    _checar_limite_excel(perfil, len(df))
 
     # ------------------------------------------------------------
     # 4) Função para copiar estilo + fórmulas da linha modelo
@@ -2133,7 +1900,7 @@ with st.sidebar:
 """), unsafe_allow_html=True)
 
     st.markdown('<div class="uiverse-uploader">', unsafe_allow_html=True)
-    xml_files = st.file_uploader("", type=["xml","zip"], accept_multiple_files=True, label_visibility="collapsed")
+    xml_files = st.file_uploader("", type=["xml","zip","gz","tgz","tar"], accept_multiple_files=True, label_visibility="collapsed")
     components.html(
         '''
     <script>
@@ -2171,6 +1938,34 @@ with st.sidebar:
 </div>
 """), unsafe_allow_html=True)
 
+    # Acervo local (Parquet): grava o que foi enviado / reabre períodos sem reenviar XML
+    with st.expander("Acervo local (histórico)"):
+        gravar_acervo = st.checkbox(
+            "Gravar XMLs enviados no acervo",
+            value=False,
+            help=f"Itens e totais por nota vão para {ACERVO_DIR} (Parquet por ano/mês). "
+                 "Notas já gravadas (mesma chave) são ignoradas.",
+        )
+        abrir_acervo = st.checkbox("Incluir notas do acervo", value=False)
+        if abrir_acervo:
+            hoje = date.today()
+            periodo_acervo = st.date_input(
+                "Período",
+                value=(date(hoje.year, 1, 1), hoje),
+                format="DD/MM/YYYY",
+            )
+            cclass_acervo = st.text_input("cClassTrib (opcional, separados por vírgula)", value="")
+
+    # Banco SQLite: grava os itens enviados e faz os filtros da tabela com consultas indexadas
+    with st.expander("Banco local (SQLite)"):
+        usar_banco = st.checkbox(
+            "Gravar no banco e filtrar por ele",
+            value=False,
+            help=f"Itens ficam em {BANCO_PATH.name} entre sessões (índices em chave, nNF, data, cClassTrib, "
+                 "arquivo; busca de texto sem acento). Com isso ligado, a tabela mostra todas as notas do banco "
+                 "e a busca por nNF é exata.",
+        )
+
 # Carrega planilha modelo FIXA (arquivo na pasta do projeto)
 from pathlib import Path
 TEMPLATE_PATH = Path(__file__).parent / "planilha_modelo.xlsx"
@@ -2199,155 +1994,198 @@ if template_bytes is None:
 </div>
 """), unsafe_allow_html=True)
 
-# Parse XMLs
-rows_all: list[dict] = []
+# Parse XMLs (em segundo plano: ingestao.py)
+# Espera inicial pelo job: lote pequeno já aparece pronto, sem painel de progresso
+ESPERA_INICIAL_INGESTAO = 1.0
+
+# Linhas por página da tabela de itens (o CSV filtrado continua com todas)
+ITENS_POR_PAGINA_TABELA = 500
+# Itens por página no seletor do painel de validação (o navegador só recebe esses)
+ITENS_POR_PAGINA_SELETOR = 50
+# Notas exibidas na tabela da conciliação (o CSV traz todas)
+LINHAS_CONCILIACAO = 1000
+# Memórias de cálculo (HTML do detalhe) guardadas por sessão
+CAPACIDADE_CACHE_DETALHE = 256
+
+
+@st.fragment(run_every=1.0)
+def _painel_ingestao():
+    """Progresso do processamento (atualiza sozinho a cada 1s, sem rodar a página inteira)."""
+    job = st.session_state.get("ingestao")
+    if job is None:
+        return
+    _coletar_ingestao(job)
+    if _ingestao_concluida(job):
+        st.rerun()  # terminou: página inteira com o resultado final
+    p = _progresso_ingestao(job)
+    eta = f" · faltam ~{p['eta_s']:.0f}s" if p["eta_s"] is not None else ""
+    st.progress(
+        min(p["fracao"], 1.0),
+        text=f"Processando XMLs… {p['feitos']}/{p['total'] or '?'} · {p['docs_s']:.0f} docs/s{eta}",
+    )
+    st.caption(f"{p['itens']} item(ns) extraído(s) até agora · {p['erros']} aviso(s)/erro(s)")
+    b1, b2 = st.columns(2)
+    with b1:
+        if st.button("Cancelar processamento", key="ingestao_cancelar"):
+            _cancelar_ingestao(job)
+    with b2:
+        if st.button("Ver resultados parciais", key="ingestao_parciais"):
+            st.rerun()
+
+
+colunas_all: dict[str, list] = {}  # itens do upload por coluna (texto bruto; ver _tabela_itens)
 errors: list[str] = []
 cancelados: list[dict] = []
+notas_all: list[dict] = []  # resumo por nota (acervo)
 
 # Acumuladores por NOTA (ICMSTot)
 icms_total_all = 0.0
 pis_total_all = 0.0
 cofins_total_all = 0.0
 
+job_ingestao = st.session_state.get("ingestao")
 if xml_files:
-    # Mostra spinner enquanto processa uploads (XML/ZIP)
-    spinner_placeholder.markdown(SPINNER_HTML, unsafe_allow_html=True)
-
-    seen_xml_sigs: set[str] = set()
-
-    # Store dos XMLs para download individual (por nota)
-    if "xml_store" not in st.session_state:
-        st.session_state["xml_store"] = {}  # sig -> {bytes, src, Numero, Data, chave}
-    if "nnf_to_sig" not in st.session_state:
-        st.session_state["nnf_to_sig"] = {}  # nnf -> [sig, sig...]
-
-    dupes_ignored = 0
-    xml_processed = 0
+    # mesmo conjunto de arquivos = mesmo job (reruns não reprocessam). O file_id do Streamlit é novo
+    # a cada envio: outro lote com os mesmos nomes e tamanhos (exportações numeradas da SEFAZ) é outro job
+    chave_upload = tuple((f.file_id, f.name, f.size) for f in xml_files)
+    if job_ingestao is None or job_ingestao["chave"] != chave_upload:
+        if job_ingestao is not None:
+            _cancelar_ingestao(job_ingestao)
+        job_ingestao = _iniciar_ingestao([(f.name, f.getvalue()) for f in xml_files], chave=chave_upload)
+        st.session_state["ingestao"] = job_ingestao
+        _aguardar_ingestao(job_ingestao, timeout=ESPERA_INICIAL_INGESTAO)
+    _coletar_ingestao(job_ingestao)
+elif job_ingestao is not None:
+    # uploads removidos: descarta o job
+    _cancelar_ingestao(job_ingestao)
+    del st.session_state["ingestao"]
+    job_ingestao = None
+
+# concluída só depois de coletado o marcador de fim (o último parcial já está no resultado)
+ingestao_concluida = job_ingestao is None or _ingestao_concluida(job_ingestao)
+if job_ingestao is not None:
+    if not ingestao_concluida:
+        _painel_ingestao()
+
+    res_ingestao = job_ingestao["resultado"]
+    colunas_all = res_ingestao["colunas_itens"]
+    errors = res_ingestao["erros"]
+    cancelados = res_ingestao["cancelados"]
+    notas_all = res_ingestao["notas"]
+    icms_total_all = res_ingestao["totais"]["vICMS"]
+    pis_total_all = res_ingestao["totais"]["vPIS"]
+    cofins_total_all = res_ingestao["totais"]["vCOFINS"]
+    # Store dos XMLs para download individual (por nota): sig -> {bytes, src, Numero, Data, chave}
+    st.session_state["xml_store"] = res_ingestao["xml_store"]
+
+    if res_ingestao["duplicados"]:
+        st.info(f"🔁 {res_ingestao['duplicados']} XML(s) foram ignorados por duplicidade (mesma chave/conteúdo).")
+    if job_ingestao["status"] == "cancelado":
+        st.warning(
+            f"Processamento cancelado: {job_ingestao['feitos']} de {job_ingestao['total'] or '?'} XML(s) lidos. "
+            "Mostrando o que já tinha sido processado."
+        )
+    elif job_ingestao["status"] == "erro":
+        st.error(f"Falha no processamento dos XMLs: {job_ingestao['falha']}")
+
+# Tabela base (imutável): montada uma vez por conjunto de linhas; reruns (e os filtros, que só guardam
+# posições) reaproveitam o mesmo DataFrame. O índice é o id_item (igual à posição nas linhas do upload)
+n_itens_all = _n_itens(colunas_all)
+chave_base = (job_ingestao["inicio"] if job_ingestao is not None else None, n_itens_all)
+tabela_base = st.session_state.get("tabela_base")
+if tabela_base is None or tabela_base[0] != chave_base:
+    df = _tabela_itens(colunas_all)  # conversão dos valores: uma vez por lote, coluna inteira
+    st.session_state["tabela_base"] = (chave_base, df)
+else:
+    df = tabela_base[1]
 
-    for f in xml_files:
+# Acervo local: grava o lote enviado e/ou junta o período escolhido (sem reprocessar XML)
+if gravar_acervo and notas_all and ingestao_concluida:
+    try:
+        # uma gravação por lote (reruns reaproveitam o resultado)
+        info_acervo = job_ingestao.get("info_acervo") or _gravar_acervo(df, notas_all)
+        job_ingestao["info_acervo"] = info_acervo
+        st.caption(
+            f"🗄️ Acervo: {info_acervo['notas_novas']} nota(s) nova(s) gravada(s), "
+            f"{info_acervo['notas_existentes']} já estavam no acervo."
+        )
+    except Exception as e:
+        st.warning(f"Não consegui gravar no acervo local: {e}")
+
+notas_acervo_incluidas = None  # notas do acervo somadas aos totais (entram na conciliação)
+versao_acervo = None  # período/cClassTrib + marca do conteúdo do acervo (entra nas versões do dataset)
+if abrir_acervo:
+    ini_acervo, fim_acervo = (tuple(periodo_acervo) + (None, None))[:2]
+    cclass_lista = [c.strip() for c in cclass_acervo.split(",") if c.strip()]
+    versao_acervo = (ini_acervo, fim_acervo, tuple(cclass_lista), _versao_acervo())
+    # leitura + concat uma vez por (tabela do upload, consulta, conteúdo do acervo): reruns reaproveitam
+    # o mesmo DataFrame
+    chave_acervo = (chave_base, len(notas_all), versao_acervo)
+    acervo_incluido = st.session_state.get("acervo_incluido")
+    if acervo_incluido is None or acervo_incluido["chave"] != chave_acervo:
+        acervo_incluido = None
         try:
-            b = f.read()
-            # Deduplicação: evita processar o mesmo XML mais de uma vez
-            if not f.name.lower().endswith(".zip"):
-                sig = _xml_signature(b)
-                if sig in seen_xml_sigs:
-                    dupes_ignored += 1
-                    continue
-                seen_xml_sigs.add(sig)
-                xml_processed += 1
-
-                # Guardar XML para download individual (por assinatura/chave)
-                try:
-                    root_tmp = ET.fromstring(b)
-                    nnf_tmp = _parse_nnf(root_tmp) or ""
-                    dh_tmp = _parse_date(root_tmp)
-                    chave_tmp = _extract_nfe_key(b)
-                except Exception:
-                    nnf_tmp, dh_tmp, chave_tmp = "", None, ""
-                st.session_state["xml_store"][sig] = {
-                    "bytes": b,
-                    "src": f.name,
-                    "Numero": nnf_tmp,
-                    "Data": dh_tmp,
-                    "chave": chave_tmp,
-                }
-                if nnf_tmp:
-                    st.session_state["nnf_to_sig"].setdefault(str(nnf_tmp), [])
-                    if sig not in st.session_state["nnf_to_sig"][str(nnf_tmp)]:
-                        st.session_state["nnf_to_sig"][str(nnf_tmp)].append(sig)
-            # Totais por NOTA (somente quando for XML direto)
-            if not f.name.lower().endswith(".zip"):
-                tot0 = _parse_tax_totals_from_xml(b)
-                icms_total_all += tot0["vICMS"]
-                pis_total_all += tot0["vPIS"]
-                cofins_total_all += tot0["vCOFINS"]
-            if f.name.lower().endswith(".zip"):
-                with zipfile.ZipFile(io.BytesIO(b)) as z:
-                    xml_names = sorted(set(n for n in z.namelist() if n.lower().endswith(".xml")))
-                    if not xml_names:
-                        errors.append(f"{f.name}: zip sem .xml")
-                        continue
-                    for xn in xml_names:
-                        xb = z.read(xn)
-                        sig = _xml_signature(xb)
-                        if sig in seen_xml_sigs:
-                            dupes_ignored += 1
-                            continue
-                        seen_xml_sigs.add(sig)
-                        xml_processed += 1
-
-                        # Guardar XML para download individual (por assinatura/chave)
-                        try:
-                            root_tmp = ET.fromstring(xb)
-                            nnf_tmp2 = _parse_nnf(root_tmp) or ""
-                            dh_tmp2 = _parse_date(root_tmp)
-                            chave_tmp2 = _extract_nfe_key(xb)
-                        except Exception:
-                            nnf_tmp2, dh_tmp2, chave_tmp2 = "", None, ""
-                        st.session_state["xml_store"][sig] = {
-                            "bytes": xb,
-                            "src": f"{f.name}:{xn}",
-                            "Numero": nnf_tmp2,
-                            "Data": dh_tmp2,
-                            "chave": chave_tmp2,
-                        }
-                        if nnf_tmp2:
-                            st.session_state["nnf_to_sig"].setdefault(str(nnf_tmp2), [])
-                            if sig not in st.session_state["nnf_to_sig"][str(nnf_tmp2)]:
-                                st.session_state["nnf_to_sig"][str(nnf_tmp2)].append(sig)
-
-                        tot = _parse_tax_totals_from_xml(xb)
-                        icms_total_all += tot["vICMS"]
-                        pis_total_all += tot["vPIS"]
-                        cofins_total_all += tot["vCOFINS"]
-                        rows = _parse_items_from_xml(xb, f"{f.name}:{xn}")
-                        for rr in rows:
-                            rr['xml_sig'] = sig
-                        if not rows:
-                            ce = _detect_cancel_event(xb)
-                            if ce is not None:
-                                ce["arquivo"] = f"{f.name}:{xn}"
-                                cancelados.append(ce)
-                                # evento de cancelamento não possui itens/IBSCBS
-                                continue
-                            errors.append(f"{f.name}:{xn}: não encontrei itens com IBSCBS")
-                        rows_all.extend(rows)
-            else:
-                rows = _parse_items_from_xml(b, f.name)
-                for rr in rows:
-                    rr['xml_sig'] = sig
-                if not rows:
-                    ce = _detect_cancel_event(b)
-                    if ce is not None:
-                        ce["arquivo"] = f.name
-                        cancelados.append(ce)
-                    else:
-                        errors.append(f"{f.name}: não encontrei itens com IBSCBS")
-                rows_all.extend(rows)
+            itens_acervo, notas_acervo = _abrir_acervo(ini_acervo, fim_acervo or ini_acervo, cclass=cclass_lista or None)
         except Exception as e:
-            errors.append(f"{f.name}: erro ao ler ({e})")
-
-    # Remove spinner ao terminar
-    spinner_placeholder.empty()
-
-    if dupes_ignored:
-        st.info(f"🔁 {dupes_ignored} XML(s) foram ignorados por duplicidade (mesma chave/conteúdo).")
-
-df = pd.DataFrame(rows_all)
-
-# Normaliza Data
-if not df.empty:
-    df["Data"] = pd.to_datetime(df["Data"], errors="coerce").dt.date
+            st.warning(f"Não consegui abrir o acervo local: {e}")
+        else:
+            # o que veio no upload tem prioridade (mesma nota não entra duas vezes)
+            ja_lidas = {n["xml_sig"] for n in notas_all}
+            itens_acervo = itens_acervo[~itens_acervo["xml_sig"].isin(ja_lidas)]
+            notas_acervo = notas_acervo[~notas_acervo["xml_sig"].isin(ja_lidas)]
+            df_com_acervo = df
+            if not itens_acervo.empty:
+                # ids negativos para os itens do acervo (os do upload são 0, 1, 2... e crescem a cada lote)
+                itens_acervo = itens_acervo.assign(id_item=range(-1, -1 - len(itens_acervo), -1))
+                df_com_acervo = pd.concat([df, itens_acervo], ignore_index=True) if not df.empty \
+                    else itens_acervo.reset_index(drop=True)
+                df_com_acervo.index = df_com_acervo["id_item"].to_numpy()
+            acervo_incluido = {
+                "chave": chave_acervo,
+                "df": df_com_acervo,
+                "notas": notas_acervo,
+                "itens": len(itens_acervo),
+                "totais": {c: float(notas_acervo[c].sum()) for c in ("vICMS", "vPIS", "vCOFINS")},
+            }
+            st.session_state["acervo_incluido"] = acervo_incluido
+    if acervo_incluido is not None:
+        df = acervo_incluido["df"]
+        notas_acervo_incluidas = acervo_incluido["notas"]
+        icms_total_all += acervo_incluido["totais"]["vICMS"]
+        pis_total_all += acervo_incluido["totais"]["vPIS"]
+        cofins_total_all += acervo_incluido["totais"]["vCOFINS"]
+        st.caption(f"🗄️ Acervo: {len(notas_acervo_incluidas)} nota(s) e {acervo_incluido['itens']} item(ns) "
+                   "do período incluídos.")
+else:
+    st.session_state.pop("acervo_incluido", None)
 
-# ---------- KPIs ----------
-def money(x):
-    if x is None or (isinstance(x, float) and pd.isna(x)):
-        return "R$ 0,00"
+resumo_banco = None
+if usar_banco:
     try:
-        return "R$ {:,.2f}".format(float(x)).replace(",", "X").replace(".", ",").replace("X", ".")
-    except Exception:
-        return "R$ 0,00"
+        with _conectar() as con:
+            if notas_all and ingestao_concluida:
+                info_banco = job_ingestao.get("info_banco") or _gravar_banco(con, df, notas_all)
+                job_ingestao["info_banco"] = info_banco
+                st.caption(
+                    f"🗃️ Banco: {info_banco['notas_novas']} nota(s) nova(s), "
+                    f"{info_banco['itens_gravados']} item(ns) gravado(s)."
+                )
+            resumo_banco = _resumo_banco(con)
+    except Exception as e:
+        st.warning(f"Não consegui usar o banco local: {e}")
+        usar_banco = False
+
+# Índice de busca de itens (sem acento, por prefixo): atualizado só com os itens novos a cada lote.
+# Sem acervo, a tabela do job só cresce no fim; com acervo, os itens dele vêm depois dos do upload
+# e qualquer mudança no upload ou no período refaz o índice
+if not df.empty and not usar_banco:
+    lista_busca = (job_ingestao["inicio"] if job_ingestao is not None else None,
+                   (n_itens_all, len(notas_all), versao_acervo) if abrir_acervo else None)
+    st.session_state["indice_busca"] = _indice_para(
+        st.session_state.get("indice_busca"), df["Item/Serviço"], lista_busca,
+    )
 
+# ---------- KPIs ----------
 def pct(x):
     try:
         return f"{float(x):.1f}%"
@@ -2355,21 +2193,6 @@ def pct(x):
         return ""
 
 
-def _fmt_money_br(x):
-    try:
-        if x is None or (isinstance(x, float) and pd.isna(x)):
-            return "0,00"
-        return "{:,.2f}".format(float(x)).replace(",", "X").replace(".", ",").replace("X", ".")
-    except Exception:
-        return "0,00"
-
-def _h(x):
-    # escape for safe HTML rendering (keeps text)
-    try:
-        return html.escape("" if x is None else str(x))
-    except Exception:
-        return ""
-
 def _clean_html(s: str) -> str:
     # Remove indentation that can turn HTML into a markdown code block
     return "\n".join(line.lstrip() for line in s.splitlines() if line.strip())
@@ -2381,21 +2204,21 @@ def _render_doc_table(df: pd.DataFrame, total_items: int | None = None):
     if df is None or df.empty:
         st.info("Nenhum item para exibir.")
         return
+    st.markdown(_html_doc_table(df, total_items), unsafe_allow_html=True)
 
+def _html_doc_table(df: pd.DataFrame, total_items: int | None = None) -> str:
+    """HTML da tabela premium (separado para poder guardar a página pronta no cache de filtros)."""
     total = total_items if total_items is not None else len(df)
 
-    rows = []
-    for _, r in df.iterrows():
-        data = _h(r.get("Data", ""))
-        numero = _h(r.get("Numero", ""))
-        item = _h(r.get("Item/Serviço", ""))
-        cclass = _h(r.get("cClassTrib", ""))
-        valor = _fmt_money_br(r.get("Valor da operação", 0))
-        vibs = _fmt_money_br(r.get("vIBS", 0))
-        vcbs = _fmt_money_br(r.get("vCBS", 0))
-        arquivo = _h(r.get("arquivo", ""))
-
-        rows.append(f"""
+    # coluna inteira de cada vez (formato_br): R$ e escape HTML em lote, sem iterrows
+    vazia = pd.Series([None] * len(df), index=df.index, dtype=object)
+
+    def _col(nome):
+        return df[nome] if nome in df.columns else vazia
+
+    datas = pd.to_datetime(_col("Data"), errors="coerce").dt.strftime("%Y-%m-%d").fillna("")
+    rows = [
+        f"""
 <tr>
   <td class="col-date">{data}</td>
   <td class="col-num">{numero}</td>
@@ -2406,7 +2229,18 @@ def _render_doc_table(df: pd.DataFrame, total_items: int | None = None):
   <td class="col-vcbs">{vcbs}</td>
   <td class="col-file" title="{arquivo}">{arquivo}</td>
 </tr>
-""")
+"""
+        for data, numero, item, cclass, valor, vibs, vcbs, arquivo in zip(
+            datas.tolist(),
+            _html_escapar(_col("Numero")).tolist(),
+            _html_escapar(_col("Item/Serviço")).tolist(),
+            _html_escapar(_col("cClassTrib")).tolist(),
+            _moeda_br(_col("Valor da operação")).tolist(),
+            _moeda_br(_col("vIBS")).tolist(),
+            _moeda_br(_col("vCBS")).tolist(),
+            _html_escapar(_col("arquivo")).tolist(),
+        )
+    ]
 
     html_block = f"""
 <div class="doc-table-wrap">
@@ -2430,7 +2264,7 @@ def _render_doc_table(df: pd.DataFrame, total_items: int | None = None):
   <div class="doc-table-foot">Mostrando {len(df)} de {total} itens</div>
 </div>
 """
-    st.markdown(_clean_html(html_block), unsafe_allow_html=True)
+    return _clean_html(html_block)
 
 
 # --- Totais (Somatório das bases do XML) ---
@@ -2483,7 +2317,7 @@ st.markdown(
           </svg>
         </div>
       </div>
-      <div class="value">{money(ibs_total)}</div>
+      <div class="value">{_moeda_br_valor(ibs_total, "R$ ")}</div>
       <div class="sub">Soma das bases IBS (XML)</div>
     </div>
   </a>
@@ -2502,7 +2336,7 @@ st.markdown(
           </svg>
         </div>
       </div>
-      <div class="value">{money(cbs_total)}</div>
+      <div class="value">{_moeda_br_valor(cbs_total, "R$ ")}</div>
       <div class="sub">Soma das bases CBS (XML)</div>
     </div>
   </a>
@@ -2522,8 +2356,8 @@ st.markdown(
           </svg>
         </div>
       </div>
-      <div class="sub" style="margin-top:6px; font-weight:900; color:#f59e0b;">IBS: {money(creditos_ibs_total)}</div>
-      <div class="sub" style="margin-top:6px; font-weight:900; color:#f59e0b;">CBS: {money(creditos_cbs_total)}</div>
+      <div class="sub" style="margin-top:6px; font-weight:900; color:#f59e0b;">IBS: {_moeda_br_valor(creditos_ibs_total, "R$ ")}</div>
+      <div class="sub" style="margin-top:6px; font-weight:900; color:#f59e0b;">CBS: {_moeda_br_valor(creditos_cbs_total, "R$ ")}</div>
       <div class="sub" style="margin-top:8px;">Totais extraídos de <b>vIBS</b> e <b>vCBS</b> (XML)</div>
     </div>
   </a>
@@ -2543,7 +2377,7 @@ st.markdown(
           </svg>
         </div>
       </div>
-      <div class="value">{money(total_tributos)}</div>
+      <div class="value">{_moeda_br_valor(total_tributos, "R$ ")}</div>
       <div class="sub">Somatório de ICMS (ICMSTot)</div>
     </div>
   </a>
@@ -2583,7 +2417,7 @@ with c1:
   </div>
 
   <div style="margin-top: 8px;">
-    <div class="bar-label"><span>Total</span><span class="badge-money">{money(pis_total)}</span></div>
+    <div class="bar-label"><span>Total</span><span class="badge-money">{_moeda_br_valor(pis_total, "R$ ")}</span></div>
     <div class="bar-track"><div class="bar-fill ibs" style="width:100%"></div></div>
   </div>
 </div>
@@ -2613,7 +2447,7 @@ with c2:
   </div>
 
   <div style="margin-top: 8px;">
-    <div class="bar-label"><span>Total</span><span class="badge-money">{money(cofins_total)}</span></div>
+    <div class="bar-label"><span>Total</span><span class="badge-money">{_moeda_br_valor(cofins_total, "R$ ")}</span></div>
     <div class="bar-track"><div class="bar-fill cbs" style="width:100%"></div></div>
   </div>
 </div>
@@ -2648,173 +2482,373 @@ st.markdown('<div class="card">', unsafe_allow_html=True)
 st.markdown("## Itens do Documento")
 st.caption("Detalhamento dos itens extraídos do XML (inclui base vBC e valores de IBS/CBS quando presentes).")
 
-if df.empty:
+if df.empty and not (usar_banco and resumo_banco["itens"]):
     st.info("Envie XML(s) para visualizar os itens aqui.")
     st.markdown("</div>", unsafe_allow_html=True)
     st.stop()
 
-c1, c2, c3, c4 = st.columns([1, 2, 1, 1], gap="large")
+def _sigs_por_numero(store: dict) -> dict[str, list[str]]:
+    """Numero -> xml_sigs do store de XMLs; só as notas novas (o store só cresce) entram a cada rerun."""
+    atual = st.session_state.get("sigs_por_numero")
+    if atual is None or atual["store"] is not store or atual["n"] > len(store):
+        atual = {"store": store, "n": 0, "indice": {}}
+        st.session_state["sigs_por_numero"] = atual
+    if atual["n"] < len(store):
+        indice = atual["indice"]
+        for sig, meta in islice(store.items(), atual["n"], None):
+            indice.setdefault(str(meta.get("Numero") or ""), []).append(sig)
+        atual["n"] = len(store)
+    return atual["indice"]
+
+@st.fragment
+def _secao_itens(df: pd.DataFrame, usar_banco: bool, resumo_banco: dict | None, selected_kpi: str, versao_df=None):
+    """
+    Filtros + validação + tabela. É um fragmento: mexer em período/busca/cClassTrib/nNF roda só esta
+    seção (upload, acervo, banco, KPIs e CSS ficam como estão). O recorte vai para
+    st.session_state["df_view"], de onde a seção de planilha lê.
+    versao_df identifica o conteúdo de df (chave do cache de filtros, ver filtros_itens.py).
+    """
+    c1, c2, c3, c4 = st.columns([1, 2, 1, 1], gap="large")
 
-with c1:
-    min_d = df["Data"].min()
-    max_d = df["Data"].max()
-    # SEMPRE define "periodo" (evita NameError)
-    periodo = st.date_input("Período", value=(min_d, max_d), min_value=min_d, max_value=max_d)
+    with c1:
+        if usar_banco:
+            min_d, max_d = resumo_banco["data_min"], resumo_banco["data_max"]
+        else:
+            # Data em datetime64 -> date (o st.date_input trabalha com date)
+            min_d, max_d = (d.date() if pd.notna(d) else None for d in (df["Data"].min(), df["Data"].max()))
+        # SEMPRE define "periodo" (evita NameError)
+        periodo = st.date_input("Período", value=(min_d, max_d), min_value=min_d, max_value=max_d)
 
-with c2:
-    q = st.text_input("Buscar item", placeholder="Ex.: produto, serviço, descrição...")
+    with c2:
+        q = st.text_input("Buscar item", placeholder="Ex.: produto, serviço, descrição...")
 
-with c3:
-    classes = sorted([c for c in df["cClassTrib"].dropna().unique().tolist() if str(c).strip() != ""])
-    pick = st.selectbox("cClassTrib", options=["(Todos)"] + classes, index=0)
+    with c3:
+        if usar_banco:
+            classes = resumo_banco["classes"]
+        else:
+            classes = sorted([c for c in df["cClassTrib"].dropna().unique().tolist() if str(c).strip() != ""])
+        pick = st.selectbox("cClassTrib", options=["(Todos)"] + classes, index=0)
+
+    with c4:
+        nota_q = st.text_input("Buscar nota (nNF)", placeholder="Ex.: 6484")
+
+    if usar_banco:
+        # mesmos filtros, como uma consulta indexada no banco (todas as notas gravadas)
+        d1, d2 = periodo if isinstance(periodo, (list, tuple)) and len(periodo) == 2 else (None, None)
+        with _conectar() as con:
+            df_view = _consultar_itens(
+                con, d1, d2,
+                busca=q or "",
+                cclass=pick if pick and pick != "(Todos)" else None,
+                numero="".join(ch for ch in str(nota_q or "").strip() if ch.isdigit()),
+            )
+        recorte = None
+    else:
+        # período, busca (índice: "servico" acha "SERVIÇO"), cClassTrib, nNF e KPI num recorte só,
+        # guardado no cache (LRU) pela assinatura dos filtros: rerun com os mesmos filtros não refaz nada
+        cache_filtros = st.session_state.setdefault("cache_filtros", _cache_filtros_novo())
+        assin = _assinatura(versao_df, periodo, q, pick, nota_q, selected_kpi)
+        recorte = _recorte(cache_filtros, df, st.session_state.get("indice_busca"), assin)
+        df_view = df.iloc[recorte["pos"]]
 
-with c4:
-    nota_q = st.text_input("Buscar nota (nNF)", placeholder="Ex.: 6484")
 
-df_view = df.copy()
 
-# filtro de período (robusto)
-if isinstance(periodo, (list, tuple)) and len(periodo) == 2:
-    d1, d2 = periodo
-    df_view["Data"] = pd.to_datetime(df_view["Data"], errors="coerce").dt.date
-    df_view = df_view[(df_view["Data"] >= d1) & (df_view["Data"] <= d2)]
+    # Download rápido do XML pela nota (digite o número acima)
+    try:
+        if 'nota_q' in locals() and nota_q:
+            nn = ''.join(ch for ch in str(nota_q).strip() if ch.isdigit())
+            if nn:
+                store = st.session_state.get("xml_store", {})
+                sigs = _sigs_por_numero(store).get(str(nn), [])
+                if sigs:
+                    # Se houver mais de 1 XML com o mesmo número (ex.: séries diferentes), deixa escolher
+                    if len(sigs) > 1:
+                        def _rotulo_sig(s):
+                            meta = store.get(s, {})
+                            chave = meta.get("chave") or ""
+                            src = meta.get("src") or ""
+                            suf = (chave[-6:] if chave else s[-6:])
+                            return f"{nn} • {suf} • {src}"
+                        sig_sel = st.selectbox("XML da nota (para baixar)", options=sigs, index=0, format_func=_rotulo_sig,
+                                               key="dl_xml_by_nnf_pick")
+                    else:
+                        sig_sel = sigs[0]
+
+                    meta = store.get(sig_sel, {})
+                    chave = meta.get("chave") or ""
+                    src = meta.get("src") or ""
+                    fname = f"NFe_{nn}.xml"
+                    if chave:
+                        fname = f"NFe_{nn}_{chave[-6:]}.xml"
+                    st.download_button(
+                        "⬇️ Baixar XML dessa nota (busca)",
+                        data=meta.get("bytes", b""),
+                        file_name=fname,
+                        mime="application/xml",
+                        key=f"dl_xml_by_nnf_{sig_sel}",
+                        help=f"Origem: {src}" if src else None,
+                    )
+    except Exception:
+        pass
 
-# busca
-if q:
-    qq = q.strip().lower()
-    df_view = df_view[df_view["Item/Serviço"].fillna("").str.lower().str.contains(qq, na=False)]
+    # filtro por KPI (clique nos cards); fora do banco já entrou no recorte
+    if recorte is None and selected_kpi != "all":
+        vibs = df_view["vIBS"].fillna(0) if "vIBS" in df_view.columns else None
+        vcbs = df_view["vCBS"].fillna(0) if "vCBS" in df_view.columns else None
 
-# cClassTrib
-if pick and pick != "(Todos)":
-    df_view = df_view[df_view["cClassTrib"].astype(str) == str(pick)]
+        if selected_kpi == "ibs" and vibs is not None:
+            df_view = df_view[vibs != 0]
+        elif selected_kpi == "cbs" and vcbs is not None:
+            df_view = df_view[vcbs != 0]
+        elif selected_kpi == "cred" and (vibs is not None and vcbs is not None):
+            # créditos normalmente aparecem como valores negativos
+            df_view = df_view[(vibs < 0) | (vcbs < 0)]
+        elif selected_kpi == "total" and (vibs is not None and vcbs is not None):
+            df_view = df_view[(vibs != 0) | (vcbs != 0)]
 
-# busca por número da nota (nNF)
-if 'nota_q' in locals() and nota_q:
-    nn = ''.join(ch for ch in str(nota_q).strip() if ch.isdigit())
-    if nn:
-        df_view = df_view[df_view["Numero"].astype(str).str.contains(nn, na=False)]
 
+    # ---------- Validação Premium IBS/CBS (retângulo) ----------
+    try:
+        if recorte is None:
+            df_validado = aplicar_validacao_base_ibscbs(df_view)
+            ordem_div = None
+        else:
+            df_validado = _validado_do_recorte(st.session_state["cache_filtros"], df, recorte)
+            ordem_div = _ordem_do_recorte(st.session_state["cache_filtros"], df, recorte)
+        render_painel_validacao_premium(df_validado, key_prefix="ibscbs", ordem=ordem_div,
+                                        versao=None if recorte is None else versao_df)
+    except Exception as _e:
+        st.warning(f"Não foi possível renderizar a validação IBS/CBS: {_e}")
+
+
+    show_cols = ["Data", "Numero", "Item/Serviço", "cClassTrib", "Valor da operação", "vIBS", "vCBS", "arquivo", "Fonte do valor"]
+    show_cols = [c for c in show_cols if c in df_view.columns]
+
+    # ===== TABELA PREMIUM (igual vídeo) =====
+    st.markdown('<div class="table-wrap">', unsafe_allow_html=True)
+
+    # tabela paginada (HTML de cada página fica no recorte do cache)
+    n_paginas = max(1, -(-len(df_view) // ITENS_POR_PAGINA_TABELA))
+    pagina = 1
+    if n_paginas > 1:
+        if st.session_state.get("pagina_tabela", 1) > n_paginas:
+            st.session_state["pagina_tabela"] = n_paginas
+        pagina = int(st.number_input("Página da tabela", min_value=1, max_value=n_paginas, step=1, key="pagina_tabela",
+                                     help=f"{ITENS_POR_PAGINA_TABELA} itens por página; o CSV traz todos."))
+    ini = (pagina - 1) * ITENS_POR_PAGINA_TABELA
+    df_pagina = df_view[show_cols].iloc[ini:ini + ITENS_POR_PAGINA_TABELA]
+    if recorte is None or df_view.empty:
+        _render_doc_table(df_pagina, total_items=len(df_view))
+    else:
+        if pagina not in recorte["paginas"]:
+            recorte["paginas"][pagina] = _html_doc_table(df_pagina, total_items=len(df_view))
+        st.markdown(recorte["paginas"][pagina], unsafe_allow_html=True)
+    if recorte is None:
+        csv_filtrado = df_view[show_cols].to_csv(index=False).encode("utf-8")
+    else:
+        if recorte["csv"] is None:
+            recorte["csv"] = df_view[show_cols].to_csv(index=False).encode("utf-8")
+        csv_filtrado = recorte["csv"]
+    st.markdown('<div class="table-download-spacer"></div>', unsafe_allow_html=True)
+    st.download_button(
+        "Baixar CSV filtrado",
+        data=csv_filtrado,
+        file_name="itens_filtrados.csv",
+        mime="text/csv",
+    )
 
+    # Exportação colunar: tabela completa (todas as notas, com validação e xml_sig), tipos preservados
+    col_fmt, col_btn = st.columns([2, 1])
+    with col_fmt:
+        formato_label = st.selectbox(
+            "Formato colunar (itens completos + validação)",
+            options=list(FORMATOS_COLUNARES),
+            index=0,
+            help="Parquet/Arrow mantêm Data como data, valores em decimal(18,2) e textos repetidos em dicionário. "
+                 "Exporta todos os itens extraídos (sem os filtros da tela).",
+        )
+    with col_btn:
+        st.markdown('<div class="table-download-spacer"></div>', unsafe_allow_html=True)
+        preparar_colunar = st.button("Preparar exportação", disabled=df.empty)
+    if preparar_colunar:
+        formato, nome_arq, mime_arq = FORMATOS_COLUNARES[formato_label]
+        try:
+            dados_colunar = _exportar_colunar(_itens_validados(df), formato)
+        except Exception as e:
+            st.error("Erro ao exportar. Veja os detalhes abaixo:")
+            st.exception(e)
+        else:
+            st.download_button(
+                f"Baixar {nome_arq}",
+                data=dados_colunar,
+                file_name=nome_arq,
+                mime=mime_arq,
+            )
 
-# Download rápido do XML pela nota (digite o número acima)
-try:
-    if 'nota_q' in locals() and nota_q:
-        nn = ''.join(ch for ch in str(nota_q).strip() if ch.isdigit())
-        if nn:
-            sigs = st.session_state.get("nnf_to_sig", {}).get(str(nn), [])
-            store = st.session_state.get("xml_store", {})
-            sigs = [s for s in sigs if s in store]
-            if sigs:
-                # Se houver mais de 1 XML com o mesmo número (ex.: séries diferentes), deixa escolher
-                if len(sigs) > 1:
-                    opt_labels = []
-                    for s in sigs:
-                        meta = store.get(s, {})
-                        chave = meta.get("chave") or ""
-                        src = meta.get("src") or ""
-                        suf = (chave[-6:] if chave else s[-6:])
-                        opt_labels.append(f"{nn} • {suf} • {src}")
-                    pick_sig = st.selectbox("XML da nota (para baixar)", options=opt_labels, index=0, key="dl_xml_by_nnf_pick")
-                    sig_sel = sigs[opt_labels.index(pick_sig)]
-                else:
-                    sig_sel = sigs[0]
-
-                meta = store.get(sig_sel, {})
-                chave = meta.get("chave") or ""
-                src = meta.get("src") or ""
-                fname = f"NFe_{nn}.xml"
-                if chave:
-                    fname = f"NFe_{nn}_{chave[-6:]}.xml"
-                st.download_button(
-                    "⬇️ Baixar XML dessa nota (busca)",
-                    data=meta.get("bytes", b""),
-                    file_name=fname,
-                    mime="application/xml",
-                    key=f"dl_xml_by_nnf_{sig_sel}",
-                    help=f"Origem: {src}" if src else None,
-                )
-except Exception:
-    pass
+    st.markdown('</div>', unsafe_allow_html=True)
 
-# filtro por KPI (clique nos cards)
-if selected_kpi != "all":
-    vibs = df_view["vIBS"].fillna(0) if "vIBS" in df_view.columns else None
-    vcbs = df_view["vCBS"].fillna(0) if "vCBS" in df_view.columns else None
+    st.session_state["df_view"] = df_view
 
-    if selected_kpi == "ibs" and vibs is not None:
-        df_view = df_view[vibs != 0]
-    elif selected_kpi == "cbs" and vcbs is not None:
-        df_view = df_view[vcbs != 0]
-    elif selected_kpi == "cred" and (vibs is not None and vcbs is not None):
-        # créditos normalmente aparecem como valores negativos
-        df_view = df_view[(vibs < 0) | (vcbs < 0)]
-    elif selected_kpi == "total" and (vibs is not None and vcbs is not None):
-        df_view = df_view[(vibs != 0) | (vcbs != 0)]
 
+# versão do dataset para o cache de filtros: muda com novo upload, novo lote parcial ou outro período do acervo
+versao_df = (
+    job_ingestao["inicio"] if job_ingestao is not None else None,
+    n_itens_all,
+    versao_acervo,
+    len(df),
+)
+_secao_itens(df, usar_banco, resumo_banco, selected_kpi, versao_df)
 
-# ---------- Validação Premium IBS/CBS (retângulo) ----------
-try:
-    df_validado = aplicar_validacao_base_ibscbs(df_view)
-    render_painel_validacao_premium(df_validado, key_prefix="ibscbs")
-except Exception as _e:
-    st.warning(f"Não foi possível renderizar a validação IBS/CBS: {_e}")
+# ---------- Conciliação por nota ----------
+st.markdown('<div class="hr"></div>', unsafe_allow_html=True)
+st.markdown("## Conciliação por nota (itens × ICMSTot)")
 
+@st.fragment
+def _secao_conciliacao(df: pd.DataFrame, notas: list[dict], notas_acervo: pd.DataFrame | None, versao_df=None):
+    """
+    Soma dos itens de cada nota x ICMSTot (vProd, vDesc, vICMS, vPIS, vCOFINS), ver conciliacao.py.
+    Calculada uma vez por versão do dataset (o resultado e o CSV ficam em st.session_state).
+    """
+    conc_cache = st.session_state.get("conciliacao")
+    if conc_cache is None or conc_cache["versao"] != versao_df:
+        df_notas = _tabela_notas(notas)
+        if notas_acervo is not None and not notas_acervo.empty:
+            df_notas = pd.concat([df_notas, notas_acervo], ignore_index=True) if not df_notas.empty else notas_acervo
+        conc = _conciliar_notas(df, df_notas)
+        conc_cache = {"versao": versao_df, "conc": conc, "resumo": _resumo_conciliacao(conc), "csv": None}
+        st.session_state["conciliacao"] = conc_cache
+    conc, r = conc_cache["conc"], conc_cache["resumo"]
+    if conc.empty:
+        st.info("Nenhuma nota para conciliar.")
+        return
 
-show_cols = ["Data", "Numero", "Item/Serviço", "cClassTrib", "Valor da operação", "vIBS", "vCBS", "arquivo", "Fonte do valor"]
-show_cols = [c for c in show_cols if c in df_view.columns]
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("Notas", r["notas"])
+    m2.metric("Batem com o ICMSTot", r["ok"])
+    m3.metric("Divergentes", r["divergentes"])
+    m4.metric("Sem totais", r["sem_totais"], help="Notas do acervo gravadas antes da conciliação (sem vProd/vDesc/vNF).")
 
-# ===== TABELA PREMIUM (igual vídeo) =====
-st.markdown('<div class="table-wrap">', unsafe_allow_html=True)
+    so_div = st.checkbox("Mostrar somente as notas divergentes", value=r["divergentes"] > 0, key="conc_so_div")
+    vista = conc[conc["Status Conciliação"] != "OK"] if so_div else conc
+    if vista.empty:
+        st.success("✅ Todas as notas batem com o ICMSTot.")
+    else:
+        st.dataframe(vista.head(LINHAS_CONCILIACAO), hide_index=True,
+                     column_config={"Data": st.column_config.DateColumn("Data", format="YYYY-MM-DD")})
+        if len(vista) > LINHAS_CONCILIACAO:
+            st.caption(f"Mostrando {LINHAS_CONCILIACAO} de {len(vista)} notas; o CSV traz todas.")
+
+    if conc_cache["csv"] is None:
+        conc_cache["csv"] = conc.to_csv(index=False, sep=";").encode("utf-8")
+    st.download_button(
+        "⬇️ Baixar conciliação por nota (CSV)",
+        data=conc_cache["csv"],
+        file_name="conciliacao_notas.csv",
+        mime="text/csv",
+        key="conc_dl",
+    )
 
-_render_doc_table(df_view[show_cols], total_items=len(df_view))
-st.markdown('<div class="table-download-spacer"></div>', unsafe_allow_html=True)
-st.download_button(
-    "Baixar CSV filtrado",
-    data=df_view[show_cols].to_csv(index=False).encode("utf-8"),
-    file_name="itens_filtrados.csv",
-    mime="text/csv",
-)
 
-st.markdown('</div>', unsafe_allow_html=True)
+_secao_conciliacao(df, notas_all, notas_acervo_incluidas, versao_df)
 
 # ---------- Generate planilha ----------
 st.markdown('<div class="hr"></div>', unsafe_allow_html=True)
 st.markdown("## Gerar planilha preenchida")
 
-if template_bytes is None:
-    st.error("Não encontrei **planilha_modelo.xlsx** na mesma pasta do app.py.")
-else:
-    if st.button("Gerar planilha", type="primary"):
-        try:
-            # 🔵 IBS
-            show_spinner(tipo="ibs", titulo="Processando IBS…", subtitulo="Organizando bases", speed="1.6s")
-            time.sleep(0.25)
-
-            # 🟢 CBS
-            show_spinner(tipo="cbs", titulo="Processando CBS…", subtitulo="Calculando valores", speed="1.4s")
-            time.sleep(0.25)
+@st.fragment
+def _secao_planilha(template_bytes: bytes | None):
+    """Geração da planilha (fragmento): o botão roda só esta seção, com o recorte atual dos filtros."""
+    df_view = st.session_state.get("df_view", pd.DataFrame())
 
-            # 🟠 Créditos
-            show_spinner(tipo="cred", titulo="Aplicando créditos…", subtitulo="Ajustando compensações", speed="1.2s")
-            time.sleep(0.25)
+    if template_bytes is None:
+        st.error("Não encontrei **planilha_modelo.xlsx** na mesma pasta do app.py.")
+    else:
+        modo_label = st.radio(
+            "Modo de geração",
+            options=list(MODOS_PLANILHA),
+            index=0,
+            horizontal=True,
+            help="XML direto: altera só a aba LANCAMENTOS dentro do .xlsx (o resto do arquivo é copiado como está). "
+                 "Streaming: reescreve a aba inteira linha a linha, memória constante. "
+                 "openpyxl: writer antigo, abre o workbook inteiro (lento em lotes grandes).",
+        )
+        modo_planilha = MODOS_PLANILHA[modo_label]
+        saida_label = st.radio(
+            "Saída",
+            options=list(SAIDAS_PLANILHA),
+            index=0,
+            horizontal=True,
+            help="Arquivo único: no modo XML direto, o que passar do limite de linhas do Excel "
+                 "vai para abas LANCAMENTOS_2, LANCAMENTOS_3... "
+                 "Por competência: um .xlsx por mês da Data (filtro de período já aplicado). "
+                 "Por CNPJ: um .xlsx por emitente. Nos dois casos as planilhas são geradas em paralelo "
+                 "a partir do modelo e vêm num único ZIP.",
+        )
+        particao = SAIDAS_PLANILHA[saida_label]
+        if st.button("Gerar planilha", type="primary"):
+            try:
+                # 🔵 IBS
+                show_spinner(tipo="ibs", titulo="Processando IBS…", subtitulo="Organizando bases", speed="1.6s")
+                time.sleep(0.25)
+
+                # 🟢 CBS
+                show_spinner(tipo="cbs", titulo="Processando CBS…", subtitulo="Calculando valores", speed="1.4s")
+                time.sleep(0.25)
+
+                # 🟠 Créditos
+                show_spinner(tipo="cred", titulo="Aplicando créditos…", subtitulo="Ajustando compensações", speed="1.2s")
+                time.sleep(0.25)
+
+                # 🟣 Total / exportação
+                show_spinner(tipo="total", titulo="Gerando planilha…", subtitulo="Aplicando fórmulas e estilos", speed="1.0s")
+
+                relatorio_part = None
+                if particao:
+                    t0_part = time.perf_counter()
+                    out_bytes, relatorio_part = _gerar_zip_particoes(template_bytes, df_view, por=particao)
+                    tempo_part = time.perf_counter() - t0_part
+                elif modo_planilha == "xml":
+                    out_bytes = _append_to_workbook_xml(template_bytes, df_view)
+                elif modo_planilha == "streaming":
+                    out_bytes = _append_to_workbook_streaming(template_bytes, df_view)
+                else:
+                    out_bytes = _append_to_workbook(template_bytes, df_view)
 
-            # 🟣 Total / exportação
-            show_spinner(tipo="total", titulo="Gerando planilha…", subtitulo="Aplicando fórmulas e estilos", speed="1.0s")
+            except Exception as e:
+                # Garante que o overlay não esconda o erro
+                hide_spinner()
+                st.error("Erro ao gerar a planilha. Veja os detalhes abaixo:")
+                st.exception(e)
+            else:
+                hide_spinner()
+                if relatorio_part is not None:
+                    st.success(f"{len(relatorio_part)} planilha(s) gerada(s)! Abra no Excel para ver as fórmulas calculando.")
+                    rel_df = pd.DataFrame(relatorio_part).rename(columns={
+                        "particao": "Competência" if particao == "mes" else "CNPJ emitente",
+                        "arquivo": "Arquivo",
+                        "linhas": "Itens",
+                        "segundos": "Tempo (s)",
+                    })
+                    st.dataframe(rel_df, hide_index=True)
+                    st.caption(
+                        f"Total: {int(rel_df['Itens'].sum())} itens em {tempo_part:.1f}s "
+                        f"(soma dos tempos por arquivo: {rel_df['Tempo (s)'].sum():.1f}s; os arquivos são gerados em paralelo)"
+                    )
+                    st.download_button(
+                        "Baixar planilhas_preenchidas.zip",
+                        data=out_bytes,
+                        file_name="planilhas_preenchidas.zip",
+                        mime="application/zip",
+                    )
+                else:
+                    st.success("Planilha gerada! Abra no Excel para ver as fórmulas calculando.")
 
-            out_bytes = _append_to_workbook(template_bytes, df_view)
+                    st.download_button(
+                        "Baixar planilha_preenchida.xlsx",
+                        data=out_bytes,
+                        file_name="planilha_preenchida.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    )
 
-        except Exception as e:
-            # Garante que o overlay não esconda o erro
-            hide_spinner()
-            st.error("Erro ao gerar a planilha. Veja os detalhes abaixo:")
-            st.exception(e)
-        else:
-            hide_spinner()
-            st.success("Planilha gerada! Abra no Excel para ver as fórmulas calculando.")
 
-            st.download_button(
-                "Baixar planilha_preenchida.xlsx",
-                data=out_bytes,
-                file_name="planilha_preenchida.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            )
\ No newline at end of file
+_secao_planilha(template_bytes)
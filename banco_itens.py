@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Banco local de itens (SQLite) para consultas indexadas entre sessões
+
+- Tabelas notas (1 linha por XML, chave = xml_sig) e itens, com índices em chave, nNF,
+  data de emissão, cClassTrib e arquivo
+- Busca de texto em Item/Serviço via FTS5 (unicode61 sem acentos: "servico" acha "SERVIÇO");
+  se o SQLite não tiver FTS5, cai para LIKE
+- Ingestão em lote (executemany numa transação só); nota já gravada é ignorada, também entre processos
+  gravando ao mesmo tempo (app e vigia): INSERT OR IGNORE da nota dentro de BEGIN IMMEDIATE
+- WAL: leitores (outras abas/sessões) não bloqueiam enquanto um lote é gravado
+
+Uso:
+    with _conectar() as con:
+        _gravar_banco(con, df_itens, notas)
+        df = _consultar_itens(con, inicio, fim, busca="servico", cclass="000001")
+"""
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import date, datetime
+from pathlib import Path
+
+import pandas as pd
+
+from campos_nfe import _datas
+
+BANCO_PATH = Path(os.environ.get("EXTRATOR_BANCO") or (Path(__file__).parent / "banco_itens.sqlite3"))
+
+# coluna do app -> coluna no banco
+COLUNAS_ITENS = {
+    "Data": "data",
+    "Numero": "nnf",
+    "Item/Serviço": "item",
+    "cClassTrib": "cclass",
+    "Valor da operação": "valor",
+    "vIBS": "vibs",
+    "vCBS": "vcbs",
+    "vProd": "vprod",
+    "vDesc": "vdesc",
+    "vICMS_item": "vicms",
+    "vPIS_item": "vpis",
+    "vCOFINS_item": "vcofins",
+    "arquivo": "arquivo",
+    "Fonte do valor": "fonte",
+    "CNPJ Emitente": "cnpj",
+    "xml_sig": "xml_sig",
+}
+COLUNAS_NOTAS = {
+    "xml_sig": "xml_sig",
+    "chave": "chave",
+    "Numero": "nnf",
+    "Data": "data",
+    "CNPJ Emitente": "cnpj",
+    "vICMS": "vicms",
+    "vPIS": "vpis",
+    "vCOFINS": "vcofins",
+    "itens": "itens",
+    "arquivo": "arquivo",
+}
+
+# Quantos parâmetros por consulta "IN (...)" (limite antigo do SQLite é 999)
+_LOTE_IN = 500
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS notas (
+    xml_sig    TEXT PRIMARY KEY,
+    chave      TEXT,
+    nnf        TEXT,
+    data       TEXT,
+    cnpj       TEXT,
+    vicms      REAL,
+    vpis       REAL,
+    vcofins    REAL,
+    itens      INTEGER,
+    arquivo    TEXT,
+    gravado_em TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_notas_chave ON notas(chave);
+CREATE INDEX IF NOT EXISTS ix_notas_nnf ON notas(nnf);
+CREATE INDEX IF NOT EXISTS ix_notas_data ON notas(data);
+
+CREATE TABLE IF NOT EXISTS itens (
+    id      INTEGER PRIMARY KEY,
+    xml_sig TEXT NOT NULL,
+    chave   TEXT,
+    nnf     TEXT,
+    data    TEXT,
+    item    TEXT,
+    cclass  TEXT,
+    valor   REAL,
+    vibs    REAL,
+    vcbs    REAL,
+    vprod   REAL,
+    vdesc   REAL,
+    vicms   REAL,
+    vpis    REAL,
+    vcofins REAL,
+    arquivo TEXT,
+    fonte   TEXT,
+    cnpj    TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_itens_sig ON itens(xml_sig);
+CREATE INDEX IF NOT EXISTS ix_itens_chave ON itens(chave);
+CREATE INDEX IF NOT EXISTS ix_itens_nnf ON itens(nnf);
+CREATE INDEX IF NOT EXISTS ix_itens_data ON itens(data);
+CREATE INDEX IF NOT EXISTS ix_itens_cclass ON itens(cclass, data);
+CREATE INDEX IF NOT EXISTS ix_itens_arquivo ON itens(arquivo);
+"""
+
+_ESQUEMA_FTS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS itens_fts USING fts5(
+    item, content='itens', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+
+def _tem_fts(con: sqlite3.Connection) -> bool:
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = 'itens_fts'").fetchone() is not None
+
+
+@contextmanager
+def _conectar(caminho: Path | str | None = None):
+    """Abre (e cria, se preciso) o banco em modo WAL. Fecha a conexão na saída do with."""
+    caminho = Path(caminho or BANCO_PATH)
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(str(caminho), timeout=30, check_same_thread=False)
+    try:
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.executescript(_ESQUEMA)
+        try:
+            con.executescript(_ESQUEMA_FTS)
+        except sqlite3.OperationalError:
+            pass  # SQLite sem FTS5: busca de texto usa LIKE
+        yield con
+    finally:
+        con.close()
+
+
+def _texto_data(v) -> str | None:
+    if v is None or (isinstance(v, float) and pd.isna(v)) or v is pd.NaT:
+        return None
+    if isinstance(v, (date, datetime)):
+        return v.strftime("%Y-%m-%d")
+    return str(v)[:10] or None
+
+
+def _valor_sql(v):
+    if v is None:
+        return None
+    try:
+        if pd.isna(v):
+            return None
+    except (TypeError, ValueError):
+        pass
+    return v.item() if hasattr(v, "item") else v
+
+
+def _sigs_existentes(con: sqlite3.Connection, sigs: list[str]) -> set[str]:
+    achados: set[str] = set()
+    for i in range(0, len(sigs), _LOTE_IN):
+        parte = sigs[i:i + _LOTE_IN]
+        marc = ",".join("?" * len(parte))
+        achados.update(r[0] for r in con.execute(f"SELECT xml_sig FROM notas WHERE xml_sig IN ({marc})", parte))
+    return achados
+
+
+def _sigs_do_banco(con: sqlite3.Connection) -> set[str]:
+    """Todos os xml_sig já gravados (pré-deduplicação de quem ingere continuamente)."""
+    return {r[0] for r in con.execute("SELECT xml_sig FROM notas")}
+
+
+def _gravar_banco(con: sqlite3.Connection, df_itens: pd.DataFrame, notas: list[dict]) -> dict:
+    """
+    Grava notas/itens novos numa transação (executemany). Notas já presentes são ignoradas.
+    A transação é BEGIN IMMEDIATE e a nota entra por INSERT OR IGNORE (xml_sig é a chave primária):
+    os itens só vão junto das notas cujo INSERT gravou de fato, então dois processos gravando o
+    mesmo lote (ex.: app e vigia) não duplicam itens.
+    Retorna {"notas_novas", "notas_existentes", "itens_gravados"}.
+    """
+    vistos: dict[str, dict] = {}
+    for n in notas:
+        vistos.setdefault(n["xml_sig"], n)
+    # pré-filtro (fora do lock) só para não montar linhas de notas conhecidas; quem decide é o INSERT
+    existentes = _sigs_existentes(con, list(vistos))
+    candidatas = [n for s, n in vistos.items() if s not in existentes]
+    chave_por_sig = {n["xml_sig"]: n.get("chave") or "" for n in candidatas}
+
+    agora = datetime.now().isoformat(timespec="seconds")
+    # Data das notas vem em texto do XML (dhEmi/dEmi): todas convertidas numa chamada só
+    datas = _datas([n.get("Data") for n in candidatas]).tolist()
+    linhas_notas = [
+        (
+            n["xml_sig"], n.get("chave") or "", _valor_sql(n.get("Numero")), _texto_data(d),
+            _valor_sql(n.get("CNPJ Emitente")), n.get("vICMS"), n.get("vPIS"), n.get("vCOFINS"),
+            n.get("itens"), n.get("arquivo"), agora,
+        )
+        for n, d in zip(candidatas, datas)
+    ]
+
+    linhas_itens = []
+    if not df_itens.empty and chave_por_sig:
+        sel = df_itens[df_itens["xml_sig"].isin(chave_por_sig.keys())]
+        cols = [c for c in COLUNAS_ITENS if c in sel.columns]
+        for valores in sel[cols].itertuples(index=False, name=None):
+            reg = dict(zip(cols, valores))
+            linhas_itens.append(
+                (reg["xml_sig"], chave_por_sig.get(reg["xml_sig"], ""))
+                + tuple(
+                    _texto_data(reg.get(c)) if c == "Data" else _valor_sql(reg.get(c))
+                    for c in COLUNAS_ITENS if c != "xml_sig"
+                )
+            )
+
+    cols_sql = ["xml_sig", "chave"] + [COLUNAS_ITENS[c] for c in COLUNAS_ITENS if c != "xml_sig"]
+    gravadas: set[str] = set()
+    with con:
+        # trava de escrita já no início: entre o INSERT da nota e o dos itens ninguém mais grava
+        con.execute("BEGIN IMMEDIATE")
+        ultimo_id = con.execute("SELECT COALESCE(MAX(id), 0) FROM itens").fetchone()[0]
+        inserir_nota = (
+            "INSERT OR IGNORE INTO notas (xml_sig, chave, nnf, data, cnpj, vicms, vpis, vcofins, itens, arquivo, "
+            "gravado_em) VALUES (?,?,?,?,?,?,?,?,?,?,?)"
+        )
+        for linha in linhas_notas:
+            # rowcount = changes(): 0 quando outra gravação já inseriu a nota
+            if con.execute(inserir_nota, linha).rowcount:
+                gravadas.add(linha[0])
+        if len(gravadas) < len(linhas_notas):
+            linhas_itens = [li for li in linhas_itens if li[0] in gravadas]
+        con.executemany(
+            f"INSERT INTO itens ({', '.join(cols_sql)}) VALUES ({','.join('?' * len(cols_sql))})",
+            linhas_itens,
+        )
+        if _tem_fts(con):
+            con.execute("INSERT INTO itens_fts(rowid, item) SELECT id, item FROM itens WHERE id > ?", (ultimo_id,))
+
+    return {
+        "notas_novas": len(gravadas),
+        "notas_existentes": len(vistos) - len(gravadas),
+        "itens_gravados": len(linhas_itens),
+    }
+
+
+def _consulta_fts(busca: str) -> str:
+    """'servico limp' -> '"servico"* AND "limp"*' (termos com prefixo, todos obrigatórios)."""
+    termos = [t for t in "".join(ch if ch.isalnum() else " " for ch in busca).split() if t]
+    return " AND ".join(f'"{t}"*' for t in termos)
+
+
+def _consultar_itens(con: sqlite3.Connection, inicio: date | None = None, fim: date | None = None,
+                     busca: str = "", cclass: str | None = None, numero: str = "", chave: str = "",
+                     arquivo: str = "") -> pd.DataFrame:
+    """Filtros do app como uma consulta indexada. Retorna os itens com os nomes de coluna do app."""
+    where, params = [], []
+    if inicio is not None:
+        where.append("i.data >= ?")
+        params.append(_texto_data(inicio))
+    if fim is not None:
+        where.append("i.data <= ?")
+        params.append(_texto_data(fim))
+    if cclass:
+        where.append("i.cclass = ?")
+        params.append(str(cclass))
+    if numero:
+        where.append("i.nnf = ?")
+        params.append(str(numero))
+    if chave:
+        where.append("i.chave = ?")
+        params.append(str(chave))
+    if arquivo:
+        where.append("i.arquivo = ?")
+        params.append(str(arquivo))
+
+    origem = "itens i"
+    busca = (busca or "").strip()
+    if busca:
+        fts = _consulta_fts(busca)
+        if fts and _tem_fts(con):
+            origem = "itens_fts f JOIN itens i ON i.id = f.rowid"
+            where.append("itens_fts MATCH ?")
+            params.append(fts)
+        else:
+            where.append("LOWER(i.item) LIKE ?")
+            params.append(f"%{busca.lower()}%")
+
+    sel = ", ".join(f'i.{sql} AS "{app}"' for app, sql in COLUNAS_ITENS.items())
+    sql = f"SELECT {sel} FROM {origem}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY i.id"
+
+    df = pd.read_sql_query(sql, con, params=params)
+    df["Data"] = pd.to_datetime(df["Data"], format="%Y-%m-%d", errors="coerce")
+    return df
+
+
+def _resumo_banco(con: sqlite3.Connection) -> dict:
+    """Totais para montar os filtros: qtd. de itens, período e lista de cClassTrib (via índices)."""
+    total, dmin, dmax = con.execute("SELECT COUNT(*), MIN(data), MAX(data) FROM itens").fetchone()
+    classes = [r[0] for r in con.execute("SELECT DISTINCT cclass FROM itens WHERE cclass <> '' ORDER BY cclass")]
+    return {
+        "itens": total,
+        "data_min": date.fromisoformat(dmin) if dmin else None,
+        "data_max": date.fromisoformat(dmax) if dmax else None,
+        "classes": classes,
+    }
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Índice de busca de itens (Item/Serviço) em memória
+
+- Texto normalizado: NFKD sem acentos, minúsculo, só letras/números ("SERVIÇO" -> "servico")
+- Consulta com vários termos = E lógico; cada termo casa por prefixo ("serv lim" acha "SERVIÇO DE LIMPEZA")
+- Descrições repetidas (comum em NFC-e) são indexadas uma vez só; cada descrição guarda
+  as posições dos itens que a usam -> custo da busca proporcional ao resultado, não ao total
+- Incremental: _indexar só processa os itens novos (posições a partir de indice["n"]); _indice_para
+  decide pela identidade da lista (ex.: o job do upload), sem comparar item a item
+
+Uso:
+    indice = _indice_novo()
+    _indexar(indice, df["Item/Serviço"])
+    posicoes = _buscar(indice, "servico limp")      # posições (iloc) em ordem crescente
+    indice = _indice_para(indice, df["Item/Serviço"], (job, None))   # a cada rerun: só indexa o que chegou
+"""
+import re
+import bisect
+import unicodedata
+
+import numpy as np
+
+_RE_NAO_ALNUM = re.compile(r"[^0-9a-z]+")
+
+
+def _normalizar(texto) -> str:
+    if texto is None or texto != texto:  # None / NaN
+        return ""
+    s = unicodedata.normalize("NFKD", str(texto))
+    s = "".join(ch for ch in s if not unicodedata.combining(ch)).lower()
+    return _RE_NAO_ALNUM.sub(" ", s).strip()
+
+
+def _indice_novo() -> dict:
+    return {
+        "n": 0,             # itens indexados (posições 0..n-1)
+        "desc_id": {},      # descrição normalizada -> id
+        "desc_itens": [],   # id -> lista de posições de itens
+        "termos": {},       # termo -> set de ids de descrição
+        "vocab": [],        # termos ordenados (busca por prefixo), refeito só quando surge termo novo
+        "vocab_ok": True,
+        "lista": None,      # identidade da lista indexada (usada por _indice_para)
+    }
+
+
+def _indexar(indice: dict, textos) -> int:
+    """Acrescenta ao índice os textos (na ordem das posições seguintes). Retorna quantos entraram."""
+    desc_id, desc_itens, termos = indice["desc_id"], indice["desc_itens"], indice["termos"]
+    pos = indice["n"]
+    cache: dict[object, int] = {}  # texto cru -> id (evita normalizar a mesma descrição de novo)
+    for texto in textos:
+        did = cache.get(texto)
+        if did is None:
+            norm = _normalizar(texto)
+            did = desc_id.get(norm)
+            if did is None:
+                did = len(desc_itens)
+                desc_id[norm] = did
+                desc_itens.append([])
+                for t in set(norm.split()):
+                    ids = termos.get(t)
+                    if ids is None:
+                        termos[t] = {did}
+                        indice["vocab_ok"] = False
+                    else:
+                        ids.add(did)
+            if texto == texto:  # NaN não serve de chave de dict
+                cache[texto] = did
+        desc_itens[did].append(pos)
+        pos += 1
+    novos = pos - indice["n"]
+    indice["n"] = pos
+    return novos
+
+
+def _ids_prefixo(indice: dict, prefixo: str) -> set[int]:
+    if not indice["vocab_ok"]:
+        indice["vocab"] = sorted(indice["termos"])
+        indice["vocab_ok"] = True
+    vocab, termos = indice["vocab"], indice["termos"]
+    i = bisect.bisect_left(vocab, prefixo)
+    j = i
+    while j < len(vocab) and vocab[j].startswith(prefixo):
+        j += 1
+    if j - i == 1:
+        return termos[vocab[i]]  # termo único: usa o set do índice (só leitura)
+    return set().union(*(termos[t] for t in vocab[i:j]))
+
+
+def _buscar(indice: dict, consulta: str) -> np.ndarray:
+    """Posições dos itens que têm TODOS os termos (por prefixo). Consulta vazia -> todas."""
+    partes = _normalizar(consulta).split()
+    if not partes:
+        return np.arange(indice["n"])
+    conjuntos = sorted((_ids_prefixo(indice, p) for p in set(partes)), key=len)
+    # intersecção começando pelo menor conjunto
+    ids = conjuntos[0]
+    for c in conjuntos[1:]:
+        if not ids:
+            break
+        ids = ids & c
+    desc_itens = indice["desc_itens"]
+    posicoes = np.fromiter((x for d in ids for x in desc_itens[d]), dtype=np.int64)
+    posicoes.sort()
+    return posicoes
+
+
+def _indice_para(indice: dict | None, textos, lista) -> dict:
+    """
+    Índice atualizado para os textos atuais (lista, ndarray ou Series, na ordem das posições).
+    `lista` identifica uma lista que só cresce no fim (ex.: o job do upload em andamento): com a mesma
+    identidade, só os textos novos são indexados; outra identidade (ou lista menor) refaz o índice.
+    O custo de um rerun sem itens novos é O(1).
+    """
+    if indice is None or indice["lista"] != lista or indice["n"] > len(textos):
+        indice = _indice_novo()
+        indice["lista"] = lista
+    n = indice["n"]
+    if len(textos) > n:
+        _indexar(indice, textos.iloc[n:].tolist() if hasattr(textos, "iloc") else textos[n:])
+    return indice
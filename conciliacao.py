@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Conciliação por nota: soma dos itens x totais da nota (ICMSTot)
+
+- Soma vProd, vDesc, vICMS_item, vPIS_item e vCOFINS_item dos itens de cada nota (xml_sig) numa
+  passada só (pd.factorize + np.bincount, sem groupby/apply) e compara com vProd, vDesc, vICMS,
+  vPIS e vCOFINS do ICMSTot
+- Mesma regra da validação da base: diferença arredondada em centavos, ZERO tolerância
+- Diagnóstico curto por nota; det sem IBSCBS (não vira item) aparece como causa provável
+- vNF vai junto no relatório (informativo: depende de frete/seguro/IPI/ST, que não estão nos itens)
+
+Uso:
+    conc = _conciliar_notas(df_itens, notas)      # notas = lista de resumos (_registro_nota) ou DataFrame
+    divergentes = conc[conc["Status Conciliação"] != "OK"]
+    python conciliacao.py pasta_xmls/ notas.zip --csv conciliacao.csv
+"""
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from extrator import _tabela_notas
+
+# Diferença máxima aceita (R$) entre soma dos itens e total da nota
+TOLERANCIA_CONCILIACAO = 0.0
+
+# coluna do item -> campo do ICMSTot
+CAMPOS_CONCILIACAO = {
+    "vProd": "vProd",
+    "vDesc": "vDesc",
+    "vICMS_item": "vICMS",
+    "vPIS_item": "vPIS",
+    "vCOFINS_item": "vCOFINS",
+}
+
+_COLUNAS_NOTA = ["xml_sig", "Numero", "Data", "CNPJ Emitente", "arquivo"]
+
+
+def _somas_por_nota(df_itens: pd.DataFrame, sigs_notas: pd.Series) -> tuple[np.ndarray, dict[str, np.ndarray], np.ndarray]:
+    """
+    Um factorize só para notas + itens (o código da nota já é o índice das somas, sem join):
+    (código de cada nota, {coluna: soma dos itens por código}, itens por código).
+    """
+    n_notas = len(sigs_notas)
+    sigs_itens = df_itens["xml_sig"] if "xml_sig" in df_itens.columns else pd.Series([], dtype=object)
+    codigos, uniques = pd.factorize(pd.concat([sigs_notas, sigs_itens], ignore_index=True), sort=False)
+    cod_notas, cod_itens = codigos[:n_notas], codigos[n_notas:]
+    ok = cod_itens >= 0  # item sem xml_sig não entra
+    cod_itens = cod_itens[ok]
+    k = len(uniques)
+    somas = {}
+    for col in CAMPOS_CONCILIACAO:
+        if col in df_itens.columns and len(cod_itens):
+            v = pd.to_numeric(df_itens[col], errors="coerce").to_numpy(dtype=float, na_value=np.nan)[ok]
+            somas[col] = np.bincount(cod_itens, weights=np.nan_to_num(v), minlength=k)
+        else:
+            somas[col] = np.zeros(k)
+    return cod_notas, somas, np.bincount(cod_itens, minlength=k)
+
+
+def _conciliar_notas(df_itens: pd.DataFrame, notas) -> pd.DataFrame:
+    """
+    Uma linha por nota: dados da nota, "Σ <campo> (itens)", "<campo> (ICMSTot)", "Dif <campo>",
+    "Status Conciliação" (OK / Divergente / Sem totais) e "Diagnóstico Conciliação".
+    Notas sem o total (ex.: gravadas no acervo antes da conciliação) ficam como "Sem totais".
+    """
+    notas = notas if isinstance(notas, pd.DataFrame) else _tabela_notas(notas)
+    if notas.empty:
+        return pd.DataFrame()
+    df_itens = df_itens if df_itens is not None else pd.DataFrame()
+    cod_notas, somas, contagem = _somas_por_nota(df_itens, notas["xml_sig"].reset_index(drop=True))
+    # mesma nota duas vezes (ex.: upload + acervo): fica a primeira
+    _, primeira = np.unique(cod_notas, return_index=True)
+    if len(primeira) < len(notas):
+        primeira.sort()
+        notas, cod_notas = notas.iloc[primeira], cod_notas[primeira]
+    notas = notas.reset_index(drop=True)
+
+    out = pd.DataFrame({c: notas[c] if c in notas.columns else None for c in _COLUNAS_NOTA})
+    itens = contagem[cod_notas]
+    out["Itens"] = itens
+    out["Itens no XML"] = pd.to_numeric(notas["itens_xml"], errors="coerce").to_numpy() \
+        if "itens_xml" in notas.columns else np.nan
+
+    divergente = np.zeros(len(notas), dtype=bool)
+    sem_total = np.zeros(len(notas), dtype=bool)
+    campos_div = []
+    for col, campo in CAMPOS_CONCILIACAO.items():
+        soma = np.round(somas[col][cod_notas], 2)
+        total = pd.to_numeric(notas[campo], errors="coerce").to_numpy(dtype=float, na_value=np.nan) \
+            if campo in notas.columns else np.full(len(notas), np.nan)
+        dif = np.round(soma - total, 2)
+        falta = np.isnan(total)
+        div = ~falta & (np.abs(dif) > TOLERANCIA_CONCILIACAO)
+        sem_total |= falta
+        divergente |= div
+        campos_div.append(np.where(div, campo, ""))
+        out[f"Σ {campo} (itens)"] = soma
+        out[f"{campo} (ICMSTot)"] = np.round(total, 2)
+        out[f"Dif {campo}"] = dif
+    out["vNF (ICMSTot)"] = pd.to_numeric(notas["vNF"], errors="coerce").round(2).to_numpy() \
+        if "vNF" in notas.columns else np.nan
+
+    out["Status Conciliação"] = np.select([divergente, sem_total], ["Divergente", "Sem totais"], default="OK")
+
+    # Diagnóstico (texto montado só para as divergentes): campos que não bateram + det sem IBSCBS
+    faltando = np.nan_to_num(out["Itens no XML"].to_numpy(dtype=float), nan=0) - itens
+    diag = np.full(len(out), "✓ Itens batem com o ICMSTot", dtype=object)
+    diag[sem_total & ~divergente] = "Nota sem totais gravados (reprocessar o XML)"
+    for i in np.flatnonzero(divergente):
+        texto = "Soma dos itens ≠ ICMSTot em: " + ", ".join(c[i] for c in campos_div if c[i])
+        if faltando[i] > 0:
+            texto += f" ({int(faltando[i])} item(ns) sem IBS/CBS fora da soma)"
+        diag[i] = texto
+    out["Diagnóstico Conciliação"] = diag
+    return out
+
+
+def _resumo_conciliacao(conc: pd.DataFrame) -> dict:
+    if conc.empty:
+        return {"notas": 0, "ok": 0, "divergentes": 0, "sem_totais": 0}
+    st = conc["Status Conciliação"]
+    return {
+        "notas": len(conc),
+        "ok": int((st == "OK").sum()),
+        "divergentes": int((st == "Divergente").sum()),
+        "sem_totais": int((st == "Sem totais").sum()),
+    }
+
+
+def main(argv=None) -> int:
+    from extrator import _extrair_lote
+
+    ap = argparse.ArgumentParser(description="Confere a soma dos itens de cada nota com o ICMSTot.")
+    ap.add_argument("entradas", nargs="+", help="arquivos .xml/.zip/.gz/.tar ou pastas")
+    ap.add_argument("--csv", help="grava a conciliação (todas as notas) em CSV")
+    ap.add_argument("--processos", type=int, default=0, help="processos para o parse (padrão: um por CPU)")
+    args = ap.parse_args(argv)
+
+    lote = _extrair_lote(args.entradas, max_workers=args.processos or None)
+    conc = _conciliar_notas(lote["itens"], lote["notas"])
+    r = _resumo_conciliacao(conc)
+    print(f"{r['notas']} nota(s): {r['ok']} OK, {r['divergentes']} divergente(s), "
+          f"{r['sem_totais']} sem totais", file=sys.stderr)
+    if r["divergentes"]:
+        for _, linha in conc[conc["Status Conciliação"] == "Divergente"].head(20).iterrows():
+            print(f"  ! {linha['Numero']} ({linha['arquivo']}): {linha['Diagnóstico Conciliação']}", file=sys.stderr)
+    if args.csv:
+        conc.to_csv(args.csv, index=False, sep=";", encoding="utf-8")
+    return 1 if r["divergentes"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
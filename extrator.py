@@ -0,0 +1,1020 @@
+# -*- coding: utf-8 -*-
+"""
+Núcleo do extrator (sem Streamlit): parse dos XMLs NF-e/NFC-e, validação da base IBS/CBS
+e exportação colunar (Parquet / Arrow)
+
+- Usado pelo app.py (interface) e pela linha de comando (lotes sem abrir o navegador)
+- Mesmas regras do app: deduplicação por chave/conteúdo, totais por nota (ICMSTot),
+  eventos de cancelamento separados dos itens
+
+Uso (lote):
+    python extrator.py pasta_xmls/ notas.zip --parquet itens.parquet
+    python extrator.py pasta_xmls/ --arrow itens.arrow --planilha planilha_preenchida.xlsx
+    python extrator.py /dados/xmls_2026/ --parquet itens.parquet --memoria-mb 512   # lotes de vários GB
+"""
+import io
+import os
+import re
+import sys
+import gzip
+import mmap
+import struct
+import tarfile
+import zipfile
+import hashlib
+import argparse
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+from campos_nfe import (
+    CAMPOS_NFE, CAMPOS_ITEM, CAMPOS_ITEM_DETALHE, _compilar_campos, _extrair_campos, _converter_colunas, _datas,
+)
+from formato_br import _moeda_br_valor
+
+
+# -----------------------------
+# XML helpers
+# -----------------------------
+def _local(tag: str) -> str:
+    # "{ns}Tag" -> "Tag"
+    return tag.split("}", 1)[-1] if "}" in tag else tag
+
+def _find_text(elem: ET.Element, path: str) -> str | None:
+    x = elem.find(path)
+    if x is None or x.text is None:
+        return None
+    return x.text.strip()
+
+def _extract_nfe_key(xml_bytes: bytes) -> str:
+    """Tenta extrair a chave (44 dígitos) da NFe/NFCe.
+    - Prioriza Id do infNFe (ex.: Id="NFe3519...")
+    - Fallback para tags chNFe comuns em protNFe/infProt ou eventos.
+    Retorna "" se não encontrar.
+    """
+    try:
+        root = ET.fromstring(xml_bytes)
+    except Exception:
+        return ""
+
+    # 1) infNFe @Id (mais comum)
+    inf = root.find(".//{*}infNFe")
+    if inf is not None:
+        idv = inf.attrib.get("Id") or inf.attrib.get("id") or ""
+        digits = "".join(ch for ch in idv if ch.isdigit())
+        if len(digits) >= 44:
+            return digits[-44:]
+
+    # 2) chNFe em protocolos
+    ch = (
+        _find_text(root, ".//{*}protNFe/{*}infProt/{*}chNFe")
+        or _find_text(root, ".//{*}infProt/{*}chNFe")
+        or _find_text(root, ".//{*}chNFe")
+        or ""
+    )
+    ch_digits = "".join(chh for chh in ch if chh.isdigit())
+    if len(ch_digits) >= 44:
+        return ch_digits[-44:]
+    return ""
+
+
+# Id do infNFe achado numa busca nos bytes (sem parse): <infNFe ... Id="NFe3519...">
+_RE_ID_INFNFE = re.compile(rb"<(?:[\w.-]+:)?infNFe\b[^>]*?\s[Ii]d\s*=\s*[\"']([^\"'<>]*)")
+_RE_NAO_DIGITO = re.compile(rb"\D")
+
+
+def _chave_rapida(xml_bytes: bytes) -> str:
+    """Chave pelo Id do infNFe, direto nos bytes; "" quando não dá (evento, Id curto, UTF-16...)."""
+    m = _RE_ID_INFNFE.search(xml_bytes)
+    if m is None:
+        return ""
+    digitos = _RE_NAO_DIGITO.sub(b"", m.group(1))
+    return digitos[-44:].decode("ascii") if len(digitos) >= 44 else ""
+
+
+def _xml_signature(xml_bytes: bytes) -> str:
+    """Assinatura estável para deduplicação:
+    - Se achar chave, usa chave (melhor): primeiro pelo Id do infNFe nos bytes, sem parse; só o que
+      não tem Id (eventos, protocolos) passa pelo _extract_nfe_key
+    - Senão, usa hash do conteúdo (sha1)
+    """
+    chave = _chave_rapida(xml_bytes) or _extract_nfe_key(xml_bytes)
+    if chave:
+        return f"ch:{chave}"
+    return "sha1:" + hashlib.sha1(xml_bytes).hexdigest()
+
+# Especificação compilada uma vez por processo (campos_nfe.CAMPOS_NFE); det sem IBSCBS não vira item
+_CAMPOS_NFE = _compilar_campos(CAMPOS_NFE, exige="IBSCBS")
+
+_TOTAIS_NOTA = ("vICMS", "vPIS", "vCOFINS", "vProd", "vDesc", "vNF", "itens_xml")
+
+# Ordem das colunas da tabela de itens (o detalhe IBS/CBS, xml_sig e id_item vêm depois)
+_COLUNAS_INICIAIS = (
+    ["Data", "Numero"] + [c[0] for c in CAMPOS_ITEM if c[0] != "IBSCBS"] + ["arquivo", "Fonte do valor", "CNPJ Emitente"]
+)
+
+
+def _parse_nfe(xml_bytes: bytes, filename: str) -> tuple[dict | None, dict[str, list]]:
+    """
+    Uma passada pelo XML (ver campos_nfe): (campos da nota, colunas dos itens com IBSCBS).
+    Item sem IBSCBS não vira linha (continua contado em itens_xml). XML inválido -> (None, {}).
+    Os valores dos itens ficam em texto: a conversão é feita por lote (_colunas_tabela).
+    """
+    nota, colunas = _extrair_campos(_CAMPOS_NFE, xml_bytes)
+    if nota is None:
+        return None, {}
+    n = _n_itens(colunas)
+    return nota, {
+        "Data": [nota["Data"]] * n,
+        "Numero": [nota["Numero"]] * n,
+        **colunas,
+        "arquivo": [filename] * n,
+        "CNPJ Emitente": [nota["CNPJ Emitente"]] * n,
+    }
+
+
+def _n_itens(colunas: dict) -> int:
+    return len(next(iter(colunas.values()), ()))
+
+
+def _juntar_colunas(destino: dict, colunas: dict) -> None:
+    for nome, valores in colunas.items():
+        destino.setdefault(nome, []).extend(valores)
+
+
+def _colunas_tabela(colunas: dict) -> dict:
+    """
+    Colunas brutas de um lote -> colunas da tabela de itens, convertidas de uma vez (coluna inteira,
+    ver campos_nfe._converter_colunas). "Fonte do valor" sai da máscara de vBC válido.
+    """
+    valores, validos = _converter_colunas(_CAMPOS_NFE["item"], colunas)
+    tabela = {**colunas, **valores}
+    if "Data" in colunas:
+        # texto do dhEmi/dEmi repetido por item: _datas lê cada nota uma vez
+        tabela["Data"] = _datas(colunas["Data"])
+    if "Valor da operação" in validos:
+        # Fonte do valor (base)
+        tabela["Fonte do valor"] = np.where(validos["Valor da operação"], "IBSCBS/vBC", "")
+    ordem = [c for c in _COLUNAS_INICIAIS if c in tabela]
+    return {c: tabela[c] for c in ordem + [c for c in tabela if c not in ordem]}
+
+
+def _tabela_itens(colunas: dict) -> pd.DataFrame:
+    """Colunas brutas do lote (estado["colunas_itens"]) -> DataFrame de itens (Data em datetime64)."""
+    if not _n_itens(colunas):
+        return pd.DataFrame()
+    return pd.DataFrame(_colunas_tabela(colunas))
+
+
+def _linhas_itens(colunas: dict) -> list[dict]:
+    """Como _tabela_itens, mas uma lista de dicts (ex.: JSONL do serviço, Data como date), sem montar DataFrame."""
+    tabela = _colunas_tabela(colunas)
+    nomes = list(tabela)
+    valores = [v.tolist() if isinstance(v, np.ndarray) else v for v in tabela.values()]
+    return [dict(zip(nomes, linha)) for linha in zip(*valores)]
+
+
+def _tabela_notas(notas) -> pd.DataFrame:
+    """Resumos das notas (_registro_nota, Data em texto do XML) -> DataFrame com Data em datetime64."""
+    df = pd.DataFrame(list(notas))
+    if "Data" in df.columns:
+        df["Data"] = _datas(df["Data"].to_numpy(dtype=object))
+    return df
+
+
+def _totais_nota(nota: dict | None) -> dict:
+    """Totais do ICMSTot (0 quando ausentes) + itens_xml: quantidade de det (inclusive os sem IBSCBS)."""
+    if nota is None:
+        return {k: 0 if k == "itens_xml" else 0.0 for k in _TOTAIS_NOTA}
+    return {k: nota[k] for k in _TOTAIS_NOTA}
+
+
+def _parse_items_from_xml(xml_bytes: bytes, filename: str) -> list[dict]:
+    """
+    Extrai itens (det) e IBS/CBS:
+      - Item/Serviço: det/prod/xProd
+      - cClassTrib: imposto/IBSCBS/cClassTrib
+      - Base (vBC): imposto/IBSCBS/vBC
+      - vIBS / vCBS: imposto/IBSCBS/vIBS, vCBS (se existirem)
+      - detalhe IBS/CBS, CFOP, NCM e CST (campos_nfe.CAMPOS_ITEM_DETALHE)
+    """
+    return _linhas_itens(_parse_nfe(xml_bytes, filename)[1])
+
+
+def _parse_tax_totals_from_xml(xml_bytes: bytes) -> dict:
+    """Extrai totais do XML (por NOTA) via ICMSTot:
+    - vICMS (ICMS próprio)
+    - vPIS
+    - vCOFINS
+    - vProd, vDesc, vNF (conciliação com a soma dos itens)
+    - itens_xml: quantidade de det (inclusive os sem IBSCBS, que não viram item)
+    """
+    return _totais_nota(_extrair_campos(_CAMPOS_NFE, xml_bytes)[0])
+
+
+# ============================
+# Validação Premium IBS/CBS
+# Regra: Base Calc = vProd − vDesc − vICMS_item − vPIS_item − vCOFINS_item
+# Zero tolerância: precisa bater exatamente (0,00).
+# ============================
+
+TOLERANCIA_BASE_IBSCBS = 0.0  # ZERO TOLERÂNCIA
+
+def _safe_num(x) -> float:
+    try:
+        if x in (None, ""):
+            return 0.0
+        if isinstance(x, str):
+            x = x.strip().replace(".", "").replace(",", ".")
+        return float(x)
+    except Exception:
+        return 0.0
+
+def _serie_num(df: pd.DataFrame, col: str) -> pd.Series:
+    """Coluna como float (ausente/vazio -> 0). Coluna já numérica não passa por _safe_num."""
+    if col not in df.columns:
+        return pd.Series(0.0, index=df.index)
+    s = df[col]
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        return s.fillna(0).astype(float)
+    return s.fillna(0).apply(_safe_num).astype(float)
+
+def _colunas_validacao_base_ibscbs(df_itens: pd.DataFrame) -> pd.DataFrame:
+    """Só as colunas de validação IBS/CBS (mesmo índice de df_itens), para calcular uma vez e juntar por índice."""
+    # Base do XML já vem em 'Valor da operação' (IBSCBS/vBC) no seu app
+    base_xml = _serie_num(df_itens, "Valor da operação")
+
+    base_calc = (
+        _serie_num(df_itens, "vProd") - _serie_num(df_itens, "vDesc") - _serie_num(df_itens, "vICMS_item")
+        - _serie_num(df_itens, "vPIS_item") - _serie_num(df_itens, "vCOFINS_item")
+    ).round(2)
+    dif = (base_calc - base_xml).round(2)
+    base_xml = base_xml.round(2)
+
+    ok = (dif.abs() <= TOLERANCIA_BASE_IBSCBS).to_numpy()
+    # Diagnóstico curto (premium); calc zerado com XML > 0: normalmente faltam tributos por item (ou vProd não veio)
+    diag = np.select(
+        [ok, (base_calc == 0).to_numpy() & (base_xml > 0).to_numpy()],
+        ["✓ Base bateu exatamente (0,00)", "Componentes do item vieram 0,00 (ver vProd/vDesc/tributos por item)"],
+        default="Base do XML não bate com a decomposição do item (subtração)",
+    )
+    return pd.DataFrame({
+        "Base IBS/CBS (XML)": base_xml,
+        "Base IBS/CBS (Calc)": base_calc,
+        "Dif Base IBS/CBS": dif,
+        "Status Base IBS/CBS": np.where(ok, "OK", "Divergente"),
+        "Diagnóstico Base IBS/CBS": diag,
+    }, index=df_itens.index)
+
+def _ordem_divergencia(dif) -> np.ndarray:
+    """
+    Posições por |Dif Base IBS/CBS| decrescente: primeiro as divergentes (só elas são ordenadas, costumam
+    ser poucas), depois as OK na ordem original. As `Status != "OK"` são exatamente o começo da lista.
+    """
+    absdif = np.abs(np.asarray(dif, dtype=float))
+    divergente = ~(absdif <= TOLERANCIA_BASE_IBSCBS)
+    pos_div = np.flatnonzero(divergente)
+    pos_div = pos_div[np.argsort(-absdif[pos_div], kind="stable")]
+    return np.concatenate([pos_div, np.flatnonzero(~divergente)])
+
+def aplicar_validacao_base_ibscbs(df_itens: pd.DataFrame) -> pd.DataFrame:
+    """Adiciona colunas de validação IBS/CBS (por item)."""
+    validacao = _colunas_validacao_base_ibscbs(df_itens)
+    return df_itens.assign(**{c: validacao[c] for c in validacao.columns})
+
+
+
+def _detect_cancel_event(xml_bytes: bytes) -> dict | None:
+    """Detecta XML de evento de cancelamento (procEventoNFe / evento).
+    Retorna dict com dados úteis ou None se não for cancelamento.
+    """
+    try:
+        root = ET.fromstring(xml_bytes)
+    except Exception:
+        return None
+
+    # Procura tpEvento=110111 (Cancelamento)
+    tp = _find_text(root, ".//{*}detEvento/{*}tpEvento") or _find_text(root, ".//{*}tpEvento")
+    if tp != "110111":
+        return None
+
+    ch = _find_text(root, ".//{*}infEvento/{*}chNFe") or _find_text(root, ".//{*}chNFe") or ""
+    dh = _find_text(root, ".//{*}infEvento/{*}dhEvento") or _find_text(root, ".//{*}dhEvento") or ""
+    nprot = _find_text(root, ".//{*}infEvento/{*}nProt") or _find_text(root, ".//{*}nProt") or ""
+    xjust = _find_text(root, ".//{*}detEvento/{*}xJust") or _find_text(root, ".//{*}xJust") or ""
+
+    return {"chNFe": ch, "dhEvento": dh, "nProt": nprot, "xJust": xjust}
+
+
+
+
+def _registro_nota(sig: str, src: str, nota: dict | None, tot: dict, n_itens: int) -> dict:
+    """Resumo da nota (acervo/ledger): chave, número, data (texto do XML), emitente, totais ICMSTot e qtd. de itens."""
+    nota = nota or {}
+    return {
+        "xml_sig": sig,
+        "chave": sig[3:] if sig.startswith("ch:") else "",
+        "Numero": nota.get("Numero"),
+        "Data": nota.get("Data"),
+        "CNPJ Emitente": nota.get("CNPJ Emitente"),
+        "vICMS": tot["vICMS"],
+        "vPIS": tot["vPIS"],
+        "vCOFINS": tot["vCOFINS"],
+        "vProd": tot["vProd"],
+        "vDesc": tot["vDesc"],
+        "vNF": tot["vNF"],
+        "itens": n_itens,
+        "itens_xml": tot["itens_xml"],
+        "arquivo": src,
+    }
+
+
+# -----------------------------
+# Lote: arquivos / pastas / ZIPs (mesmas regras do upload do app)
+# -----------------------------
+# Extensões aceitas como entrada (XML solto ou pacotes, inclusive aninhados)
+EXTENSOES_ENTRADA = (".xml", ".zip", ".gz", ".tgz", ".tar")
+
+# Limites do percurso em pacotes (proteção contra zip bomb)
+PROFUNDIDADE_MAX = 5                     # zip dentro de zip dentro de ... (o arquivo enviado é nível 0)
+LIMITE_MEMBRO = 256 * 1024 * 1024        # bytes descompactados de um único membro
+LIMITE_DESCOMPACTADO = 4 * 1024 ** 3     # bytes descompactados somando tudo de um arquivo enviado
+
+# Documentos em voo por processo no parse paralelo (_ingerir_paralelo)
+JANELA_PARALELA = 16
+
+
+def _arquivos_de_entrada(caminhos) -> list[Path]:
+    """Pastas viram seus .xml/.zip/.gz/.tar (recursivo, ordem alfabética); arquivos entram como foram passados."""
+    saida: list[Path] = []
+    for c in caminhos:
+        p = Path(c)
+        if p.is_dir():
+            saida.extend(sorted(x for x in p.rglob("*") if x.is_file() and x.suffix.lower() in EXTENSOES_ENTRADA))
+        else:
+            saida.append(p)
+    return saida
+
+
+def _novo_estado_lote(guardar_xml: bool = False) -> dict:
+    """Acumuladores de uma ingestão (lote da linha de comando ou upload do app)."""
+    return {
+        "colunas_itens": {},  # coluna -> valores dos itens (texto bruto; ver _tabela_itens)
+        "notas": [],
+        "cancelados": [],
+        "erros": [],
+        "totais": {"vICMS": 0.0, "vPIS": 0.0, "vCOFINS": 0.0},
+        "vistos": set(),
+        "duplicados": 0,
+        "processados": 0,
+        # sig -> {bytes, src, Numero, Data, chave} (download do XML no app); None = não guarda
+        "xml_store": {} if guardar_xml else None,
+    }
+
+
+def _tipo_pacote(nome: str) -> str | None:
+    """"xml", "zip", "tar" (inclusive .tar.gz/.tgz), "gz" ou None (membro ignorado)."""
+    n = nome.lower()
+    if n.endswith(".xml"):
+        return "xml"
+    if n.endswith(".zip"):
+        return "zip"
+    if n.endswith((".tar", ".tar.gz", ".tgz")):
+        return "tar"
+    if n.endswith(".gz"):
+        return "gz"
+    return None
+
+
+def _membros_zip(z: zipfile.ZipFile) -> list[zipfile.ZipInfo]:
+    """Membros úteis (XML ou pacote), ordem alfabética, sem nomes repetidos."""
+    por_nome = {}
+    for info in z.infolist():
+        if not info.is_dir() and _tipo_pacote(info.filename) is not None:
+            por_nome.setdefault(info.filename, info)
+    return [por_nome[n] for n in sorted(por_nome)]
+
+
+def _contar_documentos(nome: str, dados: bytes) -> int:
+    """
+    Estimativa de quantos documentos o arquivo tem, para a barra de progresso (no ZIP lê só o
+    diretório central; pacote dentro de pacote e .gz/.tar contam como 1).
+    """
+    if _tipo_pacote(nome) != "zip":
+        return 1
+    with zipfile.ZipFile(io.BytesIO(dados)) as z:
+        return len(_membros_zip(z))
+
+
+def _ler_limitado(f, nome: str, orcamento: dict) -> bytes:
+    """Lê um membro sem confiar no tamanho declarado no cabeçalho (zip bomb)."""
+    limite = min(LIMITE_MEMBRO, orcamento["restante"])
+    dados = f.read(limite + 1)
+    if len(dados) > limite:
+        raise ValueError(f"{nome}: excede o limite de descompactação ({limite // (1024 * 1024)} MB)")
+    orcamento["restante"] -= len(dados)
+    return dados
+
+
+def _fatia_membro_zip(mm: mmap.mmap, info: zipfile.ZipInfo) -> memoryview | None:
+    """
+    Membro ZIP sem compressão (ZIP_STORED) direto do arquivo mapeado, sem cópia.
+    None quando não dá (comprimido, criptografado, cabeçalho local inválido): lê pelo zipfile.
+    """
+    if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+        return None
+    ini = info.header_offset
+    cab = mm[ini:ini + 30]
+    if len(cab) < 30 or cab[:4] != b"PK\x03\x04":
+        return None
+    tam_nome, tam_extra = struct.unpack("<HH", cab[26:30])
+    ini += 30 + tam_nome + tam_extra
+    if ini + info.file_size > len(mm):
+        return None
+    return memoryview(mm)[ini:ini + info.file_size]
+
+
+class _LeitorMapa(io.RawIOBase):
+    """
+    Arquivo (read/seek/tell) sobre um mmap, sem cópia: o zipfile do Python 3.11 exige seekable(),
+    que o mmap só ganhou no 3.13.
+    """
+
+    def __init__(self, mm: mmap.mmap):
+        self._mm = mm
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._mm)}[whence]
+        if base + pos < 0:
+            raise ValueError("posição negativa")
+        self._pos = base + pos
+        return self._pos
+
+    def readinto(self, b) -> int:
+        n = max(0, min(len(b), len(self._mm) - self._pos))
+        b[:n] = self._mm[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+
+def _percorrer_pacote(nome: str, origem: str, conteudo, profundidade: int, orcamento: dict):
+    """
+    (origem, bytes) de cada XML em `conteudo` (bytes, arquivo mapeado em memória ou arquivo aberto,
+    lido em fluxo). ZIP precisa de acesso aleatório (o membro é lido inteiro, dentro do limite);
+    gzip e tar são descompactados em fluxo, membro a membro.
+    Com mmap, o XML solto e os membros ZIP sem compressão saem como memoryview do próprio mapa
+    (sem cópia); a fatia é liberada quando o consumidor pede o próximo documento.
+    """
+    mapeado = isinstance(conteudo, mmap.mmap)
+    tipo = _tipo_pacote(nome)
+    if tipo == "xml" or (tipo is None and profundidade == 0):
+        # o arquivo enviado vale como XML mesmo sem extensão (comportamento antigo)
+        if mapeado:
+            with memoryview(conteudo) as vista:
+                yield origem, vista
+        elif isinstance(conteudo, (bytes, memoryview)):
+            yield origem, conteudo
+        else:
+            yield origem, _ler_limitado(conteudo, origem, orcamento)
+        return
+    if tipo is None:
+        return
+    if profundidade >= PROFUNDIDADE_MAX:
+        raise ValueError(f"{origem}: pacotes aninhados além de {PROFUNDIDADE_MAX} níveis")
+
+    if mapeado:
+        # leitura direto do mapa: nada é copiado para ler o diretório central
+        f = io.BufferedReader(_LeitorMapa(conteudo))
+    elif isinstance(conteudo, (bytes, memoryview)):
+        f = io.BytesIO(conteudo)
+    elif tipo == "zip":
+        f = io.BytesIO(_ler_limitado(conteudo, origem, orcamento))
+    else:
+        f = conteudo
+
+    if tipo == "zip":
+        with zipfile.ZipFile(f) as z:
+            for info in _membros_zip(z):
+                sub = f"{origem}:{info.filename}"
+                vista = _fatia_membro_zip(conteudo, info) if mapeado else None
+                if vista is not None:
+                    with vista:
+                        yield from _percorrer_pacote(info.filename, sub, vista, profundidade + 1, orcamento)
+                    continue
+                with z.open(info) as m:
+                    yield from _percorrer_pacote(info.filename, sub, m, profundidade + 1, orcamento)
+        return
+
+    if tipo == "gz":
+        # nota.xml.gz -> nota.xml (a origem continua sendo o .gz: um membro só)
+        with gzip.GzipFile(fileobj=f) as g:
+            yield from _percorrer_pacote(nome[:-3], origem, g, profundidade + 1, orcamento)
+        return
+
+    # tar / tar.gz / tgz em modo fluxo ("r|*"): cada membro tem que ser consumido antes do próximo
+    with tarfile.open(fileobj=f, mode="r|*") as t:
+        for info in t:
+            if not info.isfile() or _tipo_pacote(info.name) is None:
+                continue
+            m = t.extractfile(info)
+            if m is not None:
+                yield from _percorrer_pacote(info.name, f"{origem}:{info.name}", m, profundidade + 1, orcamento)
+
+
+def _documentos_do_arquivo(nome: str, dados):
+    """
+    (origem, bytes) de cada XML do arquivo: o próprio XML ou os XMLs de dentro de ZIP/gzip/tar,
+    inclusive aninhados ("externo.zip:interno.zip:nota.xml"), um a um.
+    `dados` pode ser bytes ou um mmap (ver _arquivo_mapeado); com mmap, parte dos documentos sai
+    como memoryview válida só até o próximo documento: quem guarda o XML copia (bytes(xb)).
+    Estoura ValueError ao passar de PROFUNDIDADE_MAX, LIMITE_MEMBRO ou LIMITE_DESCOMPACTADO.
+    """
+    yield from _percorrer_pacote(nome, nome, dados, 0, {"restante": LIMITE_DESCOMPACTADO})
+
+
+@contextmanager
+def _arquivo_mapeado(caminho: Path):
+    """
+    Arquivo local mapeado em memória (mmap somente leitura) em vez de read(): o SO pagina sob demanda,
+    sem a cópia inteira em bytes. Arquivo vazio vira b"" (mmap não aceita tamanho 0).
+    """
+    with open(caminho, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mm
+        finally:
+            try:
+                mm.close()
+            except BufferError:
+                pass  # alguém ainda segura uma fatia; o mapa fecha quando ela for coletada
+
+
+def _processar_documento(src: str, xb: bytes, sig: str | None = None) -> dict:
+    """
+    Parse de 1 XML (sem estado: pode rodar em outro processo).
+    Retorna {"sig", "tot", "colunas_itens", "cancelado", "nota", "erro"} para _juntar_documento.
+    XML que não abre (vazio, truncado, outro formato) ou que não é NF-e/NFC-e (sem nNF nem det) não vira
+    nota: só o erro (acervo, banco, serviço e conciliação nunca recebem nota sem dados).
+    """
+    sig = sig or _xml_signature(xb)
+    nota_xml, colunas = _parse_nfe(xb, src)  # itens e totais numa passada só
+    tot = _totais_nota(nota_xml)
+    n = _n_itens(colunas)
+    if colunas:
+        colunas["xml_sig"] = [sig] * n
+
+    ce, erro = None, None
+    if nota_xml is None:
+        erro = f"{src}: XML inválido (não consegui ler o documento)"
+    elif not n:
+        ce = _detect_cancel_event(xb)
+        if ce is not None:
+            # evento de cancelamento não possui itens/IBSCBS
+            ce["arquivo"] = src
+        elif nota_xml["Numero"] is None and not nota_xml["itens_xml"]:
+            erro = f"{src}: não é uma NF-e/NFC-e (sem nNF nem itens)"
+            nota_xml = None
+        else:
+            erro = f"{src}: não encontrei itens com IBSCBS"
+    nota = _registro_nota(sig, src, nota_xml, tot, n) if nota_xml is not None and ce is None else None
+    return {"sig": sig, "tot": tot, "colunas_itens": colunas, "cancelado": ce, "nota": nota, "erro": erro}
+
+
+def _juntar_documento(estado: dict, doc: dict, src: str, xb: bytes) -> None:
+    estado["processados"] += 1
+    for k in estado["totais"]:
+        estado["totais"][k] += doc["tot"][k]
+    if doc["cancelado"] is not None:
+        estado["cancelados"].append(doc["cancelado"])
+    if doc["erro"] is not None:
+        estado["erros"].append(doc["erro"])
+    nota = doc["nota"]
+    if nota is not None:
+        estado["notas"].append(nota)
+    _juntar_colunas(estado["colunas_itens"], doc["colunas_itens"])
+
+    if estado["xml_store"] is not None:
+        estado["xml_store"][doc["sig"]] = {
+            "bytes": xb if isinstance(xb, bytes) else bytes(xb),
+            "src": src,
+            "Numero": (nota or {}).get("Numero") or "",
+            "Data": (nota or {}).get("Data"),
+            "chave": doc["sig"][3:] if doc["sig"].startswith("ch:") else "",
+        }
+
+
+def _ingerir_documento(estado: dict, src: str, xb: bytes) -> None:
+    """
+    Processa 1 XML no estado do lote:
+      - deduplica por chave (ou sha1 do conteúdo)
+      - soma ICMSTot por nota
+      - separa eventos de cancelamento
+    """
+    sig = _xml_signature(xb)
+    if sig in estado["vistos"]:
+        estado["duplicados"] += 1
+        return
+    estado["vistos"].add(sig)
+    _juntar_documento(estado, _processar_documento(src, xb, sig), src, xb)
+
+
+def _ingerir_paralelo(estado: dict, documentos, max_workers: int | None = None, ao_juntar=None,
+                      janela_bytes: int | None = None) -> None:
+    """
+    Como _ingerir_documento para uma sequência de (origem, bytes), com o parse num pool de processos.
+    A deduplicação fica no processo principal, antes de enviar (assinatura pelo Id nos bytes, sem parse:
+    o parse só roda no pool); a ordem do resultado é a ordem de entrada. Com 1 processo (ou 1 CPU)
+    roda sequencial; se o pool cair, o resto também.
+    ao_juntar() é chamado depois de cada documento entrar no estado (ex.: despejar itens em disco).
+    Em voo ficam até JANELA_PARALELA documentos por processo e, com janela_bytes, no máximo esse total
+    de XML (o mais antigo é juntado antes de enviar o próximo; sempre cabe pelo menos um).
+    """
+    ao_juntar = ao_juntar or (lambda: None)
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers <= 1:
+        for src, xb in documentos:
+            _ingerir_documento(estado, src, xb)
+            ao_juntar()
+        return
+
+    pendentes: deque = deque()
+    em_voo = [0]  # bytes de XML em pendentes
+
+    def _juntar_primeiro():
+        fut, src, xb, sig = pendentes.popleft()
+        em_voo[0] -= len(xb)
+        try:
+            doc = fut.result()
+        except (BrokenProcessPool, OSError):
+            doc = _processar_documento(src, xb, sig)
+        _juntar_documento(estado, doc, src, xb)
+        ao_juntar()
+
+    ex = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        for src, xb in documentos:
+            sig = _xml_signature(xb)
+            if sig in estado["vistos"]:
+                estado["duplicados"] += 1
+                continue
+            estado["vistos"].add(sig)
+            if not isinstance(xb, bytes):
+                xb = bytes(xb)  # fatia de mmap: o pool precisa de bytes (e a fatia morre no próximo documento)
+            if janela_bytes is not None:
+                while pendentes and em_voo[0] + len(xb) > janela_bytes:
+                    _juntar_primeiro()
+            try:
+                fut = ex.submit(_processar_documento, src, xb, sig)
+            except (BrokenProcessPool, RuntimeError):
+                while pendentes:
+                    _juntar_primeiro()
+                _juntar_documento(estado, _processar_documento(src, xb, sig), src, xb)
+                ao_juntar()
+                continue
+            pendentes.append((fut, src, xb, sig))
+            em_voo[0] += len(xb)
+            if len(pendentes) >= JANELA_PARALELA * max_workers:
+                _juntar_primeiro()
+        while pendentes:
+            _juntar_primeiro()
+    finally:
+        ex.shutdown(cancel_futures=True)
+
+
+def _documentos_dos_caminhos(estado: dict, caminhos):
+    """(origem, bytes) de todos os arquivos/pastas; falhas de leitura vão para estado["erros"]."""
+    for caminho in _arquivos_de_entrada(caminhos):
+        nome = caminho.name
+        n = 0
+        try:
+            with _arquivo_mapeado(caminho) as dados:
+                for src, xb in _documentos_do_arquivo(nome, dados):
+                    n += 1
+                    yield src, xb
+        except Exception as e:
+            estado["erros"].append(f"{nome}: erro ao ler ({e})")
+            continue
+        if n == 0:
+            estado["erros"].append(f"{nome}: pacote sem .xml")
+
+
+def _extrair_lote(caminhos, max_workers: int | None = 1) -> dict:
+    """
+    Lê XMLs/ZIPs/gzip/tar/pastas como o upload do app (ver _ingerir_documento).
+    max_workers > 1 faz o parse em paralelo (None = um processo por CPU).
+    Retorna dict com itens (DataFrame), notas (resumo por nota), cancelados, erros, duplicados,
+    processados e totais.
+    """
+    estado = _novo_estado_lote()
+    _ingerir_paralelo(estado, _documentos_dos_caminhos(estado, caminhos), max_workers)
+
+    return {
+        "itens": _tabela_itens(estado["colunas_itens"]),
+        "notas": estado["notas"],
+        "cancelados": estado["cancelados"],
+        "erros": estado["erros"],
+        "duplicados": estado["duplicados"],
+        "processados": estado["processados"],
+        "totais": estado["totais"],
+    }
+
+
+# -----------------------------
+# Exportação colunar (Parquet / Arrow IPC)
+# -----------------------------
+# Texto repetitivo -> dictionary encoding (vira categoria no pandas / BI)
+COLUNAS_DICIONARIO = [
+    "Numero", "Item/Serviço", "cClassTrib", "arquivo", "Fonte do valor", "CNPJ Emitente", "xml_sig",
+    "CFOP", "NCM", "CST_IBSCBS",
+    "Status Base IBS/CBS", "Diagnóstico Base IBS/CBS",
+]
+# Valores em R$ -> decimal(18,2) (no CSV/float a escala se perde)
+COLUNAS_MONETARIAS = [
+    "Valor da operação", "vIBS", "vCBS", "vProd", "vDesc", "vICMS_item", "vPIS_item", "vCOFINS_item",
+    "Base IBS/CBS (XML)", "Base IBS/CBS (Calc)", "Dif Base IBS/CBS",
+] + [c[0] for c in CAMPOS_ITEM_DETALHE if c[2] == "valor" and c[0].startswith("v")]
+# Alíquotas/percentuais do detalhe IBS/CBS (pIBSUF, pCBS, pRedAliq...) -> float
+COLUNAS_ALIQUOTAS = [c[0] for c in CAMPOS_ITEM_DETALHE if c[2] == "valor" and c[0].startswith("p")]
+# Linhas por row group do Parquet (leitura por partes / filtro por estatística de coluna)
+PARQUET_LINHAS_POR_GRUPO = 128_000
+
+FORMATOS_COLUNARES = {
+    "Parquet": ("parquet", "itens.parquet", "application/vnd.apache.parquet"),
+    "Arrow IPC (Feather)": ("arrow", "itens.arrow", "application/vnd.apache.arrow.file"),
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError as e:  # dependência só da exportação colunar
+        raise RuntimeError("Exportação Parquet/Arrow precisa do pacote pyarrow (pip install pyarrow).") from e
+    return pa, pc
+
+
+def _tabela_arrow(df: pd.DataFrame):
+    """DataFrame de itens -> pyarrow.Table com Data como date32, R$ em decimal e texto em dicionário."""
+    pa, pc = _pyarrow()
+    tabela = pa.Table.from_pandas(df, preserve_index=False)
+    for i, nome in enumerate(tabela.column_names):
+        col = tabela.column(i)
+        if nome == "Data" and pa.types.is_timestamp(col.type):
+            col = pc.cast(col, pa.date32())
+        elif nome in COLUNAS_MONETARIAS and (pa.types.is_floating(col.type) or pa.types.is_integer(col.type)):
+            col = pc.cast(pc.round(col, 2), pa.decimal128(18, 2))
+        elif nome in COLUNAS_DICIONARIO and (pa.types.is_string(col.type) or pa.types.is_large_string(col.type)):
+            col = pc.dictionary_encode(col)
+        else:
+            continue
+        tabela = tabela.set_column(i, nome, col)
+    return tabela
+
+
+def _exportar_parquet(df: pd.DataFrame, destino=None, linhas_por_grupo: int = PARQUET_LINHAS_POR_GRUPO,
+                      compressao: str = "zstd"):
+    """Grava df em Parquet. destino: caminho ou arquivo binário; se None, retorna os bytes."""
+    _pyarrow()
+    import pyarrow.parquet as pq
+
+    out = destino if destino is not None else io.BytesIO()
+    pq.write_table(_tabela_arrow(df), out, row_group_size=linhas_por_grupo, compression=compressao)
+    if destino is None:
+        return out.getvalue()
+    return None
+
+
+def _exportar_arrow(df: pd.DataFrame, destino=None, compressao: str = "zstd"):
+    """Grava df em Arrow IPC (Feather v2). destino: caminho ou arquivo binário; se None, retorna os bytes."""
+    _pyarrow()
+    import pyarrow.feather as feather
+
+    out = destino if destino is not None else io.BytesIO()
+    feather.write_feather(_tabela_arrow(df), out, compression=compressao)
+    if destino is None:
+        return out.getvalue()
+    return None
+
+
+def _exportar_colunar(df: pd.DataFrame, formato: str, destino=None):
+    if formato == "parquet":
+        return _exportar_parquet(df, destino)
+    if formato == "arrow":
+        return _exportar_arrow(df, destino)
+    raise ValueError(f"Formato desconhecido: {formato}")
+
+
+def _itens_validados(df: pd.DataFrame) -> pd.DataFrame:
+    """Tabela completa de itens + colunas de validação da base (o que vai para Parquet/Arrow)."""
+    if df.empty:
+        return df
+    return aplicar_validacao_base_ibscbs(df)
+
+
+# -----------------------------
+# Memória limitada (lotes de vários GB)
+# -----------------------------
+# Orçamento padrão de RAM do modo memória limitada e custo estimado de 1 item no caminho
+# linha (dict) -> DataFrame -> validação -> Arrow (medido ~2,2 KB; folga para descrições longas)
+ORCAMENTO_MEMORIA_MB = 512
+BYTES_POR_ITEM = 4096
+# Parte do orçamento para o bloco de itens; o resto fica para o XML em leitura, notas e pyarrow
+FRACAO_BLOCO = 0.5
+# Parte do orçamento para os documentos em voo no parse paralelo; cada um conta FATOR_EM_VOO vezes o
+# tamanho do XML (bytes no processo principal + cópia enviada ao filho + resultado esperando ser juntado)
+FRACAO_JANELA = 0.25
+FATOR_EM_VOO = 3
+
+
+def _itens_por_bloco(memoria_mb: float) -> int:
+    return max(1_000, int(memoria_mb * 1024 * 1024 * FRACAO_BLOCO / BYTES_POR_ITEM))
+
+
+def _janela_bytes(memoria_mb: float) -> int:
+    """Bytes de XML em voo no parse paralelo dentro do orçamento (ver FRACAO_JANELA)."""
+    return int(memoria_mb * 1024 * 1024 * FRACAO_JANELA / FATOR_EM_VOO)
+
+
+def _esquema_itens(tabela):
+    """
+    Esquema fixo para todos os blocos: o do primeiro bloco, com as colunas que vieram vazias
+    (tipo null) trocadas pelo tipo que teriam (data, decimal, dicionário ou texto).
+    """
+    pa, _ = _pyarrow()
+    campos = []
+    for campo in tabela.schema:
+        tipo = campo.type
+        if pa.types.is_null(tipo):
+            if campo.name == "Data":
+                tipo = pa.date32()
+            elif campo.name in COLUNAS_MONETARIAS:
+                tipo = pa.decimal128(18, 2)
+            elif campo.name in COLUNAS_ALIQUOTAS:
+                tipo = pa.float64()
+            elif campo.name in COLUNAS_DICIONARIO:
+                tipo = pa.dictionary(pa.int32(), pa.large_string())
+            else:
+                tipo = pa.large_string()
+        campos.append(pa.field(campo.name, tipo))
+    return pa.schema(campos)
+
+
+def _kpis_novos() -> dict:
+    return {"itens": 0, "ok": 0, "divergentes": 0, "soma_base_xml": 0.0, "soma_base_calc": 0.0}
+
+
+def _acumular_kpis(kpis: dict, df_validado: pd.DataFrame) -> None:
+    """Mesmos números do painel de validação do app, somados bloco a bloco."""
+    ok = int((df_validado["Status Base IBS/CBS"] == "OK").sum())
+    kpis["itens"] += len(df_validado)
+    kpis["ok"] += ok
+    kpis["divergentes"] += len(df_validado) - ok
+    kpis["soma_base_xml"] += float(df_validado["Base IBS/CBS (XML)"].sum())
+    kpis["soma_base_calc"] += float(df_validado["Base IBS/CBS (Calc)"].sum())
+
+
+def _extrair_lote_limitado(caminhos, destino, memoria_mb: float = ORCAMENTO_MEMORIA_MB,
+                           max_workers: int | None = 1,
+                           linhas_por_grupo: int = PARQUET_LINHAS_POR_GRUPO) -> dict:
+    """
+    Como _extrair_lote, mas sem montar a tabela inteira em memória: os itens são validados e
+    gravados em Parquet (destino) a cada bloco de _itens_por_bloco(memoria_mb) itens, e os KPIs
+    da validação são somados bloco a bloco. Os arquivos são lidos um por vez (mmap); no parse
+    paralelo, os XMLs em voo (e os resultados ainda não juntados) ficam dentro de _janela_bytes(memoria_mb).
+    Retorna dict com destino, blocos, kpis, notas, cancelados, erros, duplicados, processados e totais.
+    """
+    _pyarrow()
+    import pyarrow.parquet as pq
+
+    limite = _itens_por_bloco(memoria_mb)
+    estado = _novo_estado_lote()
+    kpis = _kpis_novos()
+    gravacao = {"writer": None, "esquema": None, "blocos": 0}
+
+    def _despejar():
+        if not _n_itens(estado["colunas_itens"]):
+            return
+        bloco = _tabela_itens(estado["colunas_itens"])
+        estado["colunas_itens"].clear()
+        bloco = aplicar_validacao_base_ibscbs(bloco)
+        _acumular_kpis(kpis, bloco)
+        tabela = _tabela_arrow(bloco)
+        del bloco
+        if gravacao["writer"] is None:
+            gravacao["esquema"] = _esquema_itens(tabela)
+            gravacao["writer"] = pq.ParquetWriter(destino, gravacao["esquema"], compression="zstd")
+        gravacao["writer"].write_table(tabela.cast(gravacao["esquema"]), row_group_size=linhas_por_grupo)
+        gravacao["blocos"] += 1
+
+    def _ao_juntar():
+        if _n_itens(estado["colunas_itens"]) >= limite:
+            _despejar()
+
+    try:
+        _ingerir_paralelo(estado, _documentos_dos_caminhos(estado, caminhos), max_workers, ao_juntar=_ao_juntar,
+                          janela_bytes=_janela_bytes(memoria_mb))
+        _despejar()
+    finally:
+        if gravacao["writer"] is not None:
+            gravacao["writer"].close()
+
+    kpis["soma_base_xml"] = round(kpis["soma_base_xml"], 2)
+    kpis["soma_base_calc"] = round(kpis["soma_base_calc"], 2)
+    return {
+        "destino": destino if gravacao["blocos"] else None,
+        "blocos": gravacao["blocos"],
+        "itens_por_bloco": limite,
+        "kpis": kpis,
+        "notas": estado["notas"],
+        "cancelados": estado["cancelados"],
+        "erros": estado["erros"],
+        "duplicados": estado["duplicados"],
+        "processados": estado["processados"],
+        "totais": estado["totais"],
+    }
+
+
+# -----------------------------
+# Linha de comando
+# -----------------------------
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Extrator XML IBS/CBS em lote (sem interface).")
+    ap.add_argument("entradas", nargs="+", help="arquivos .xml/.zip/.gz/.tar ou pastas (lidas recursivamente)")
+    ap.add_argument("--parquet", help="grava os itens (com validação e xml_sig) em Parquet")
+    ap.add_argument("--arrow", help="grava os itens (com validação e xml_sig) em Arrow IPC / Feather")
+    ap.add_argument("--linhas-por-grupo", type=int, default=PARQUET_LINHAS_POR_GRUPO,
+                    help=f"linhas por row group do Parquet (padrão {PARQUET_LINHAS_POR_GRUPO})")
+    ap.add_argument("--planilha", help="grava também a planilha preenchida (.xlsx)")
+    ap.add_argument("--modelo", default=str(Path(__file__).with_name("planilha_modelo.xlsx")),
+                    help="planilha modelo (padrão: planilha_modelo.xlsx ao lado deste arquivo)")
+    ap.add_argument("--processos", type=int, default=0,
+                    help="processos para o parse (padrão: um por CPU; 1 = sequencial)")
+    ap.add_argument("--memoria-mb", type=float,
+                    help="modo memória limitada: grava os itens em blocos no --parquet sem montar a tabela "
+                         f"inteira (orçamento de RAM em MB; ex.: {ORCAMENTO_MEMORIA_MB}). Metade do orçamento vai "
+                         "para o bloco de itens e um quarto para os XMLs em voo no parse paralelo (com --processos "
+                         "acima de 1, a janela de documentos é limitada por esse quarto)")
+    args = ap.parse_args(argv)
+
+    if args.memoria_mb is not None:
+        if not args.parquet or args.arrow or args.planilha:
+            ap.error("--memoria-mb grava só em --parquet (sem --arrow/--planilha)")
+        res = _extrair_lote_limitado(args.entradas, args.parquet, memoria_mb=args.memoria_mb,
+                                     max_workers=args.processos or None, linhas_por_grupo=args.linhas_por_grupo)
+        k = res["kpis"]
+        print(
+            f"{res['processados']} XML(s) lidos, {k['itens']} itens em {res['blocos']} bloco(s) "
+            f"de até {res['itens_por_bloco']}, {res['duplicados']} duplicado(s), "
+            f"{len(res['cancelados'])} cancelamento(s)\n"
+            f"base IBS/CBS: {k['ok']} OK, {k['divergentes']} divergente(s); "
+            f"XML {_moeda_br_valor(k['soma_base_xml'], 'R$ ')} x calc. {_moeda_br_valor(k['soma_base_calc'], 'R$ ')}",
+            file=sys.stderr,
+        )
+        for erro in res["erros"]:
+            print(f"  ! {erro}", file=sys.stderr)
+        return 0
+
+    lote = _extrair_lote(args.entradas, max_workers=args.processos or None)
+    df = _itens_validados(lote["itens"])
+
+    print(
+        f"{lote['processados']} XML(s) lidos, {len(df)} itens, "
+        f"{lote['duplicados']} duplicado(s), {len(lote['cancelados'])} cancelamento(s)",
+        file=sys.stderr,
+    )
+    for erro in lote["erros"]:
+        print(f"  ! {erro}", file=sys.stderr)
+
+    if args.parquet:
+        _exportar_parquet(df, args.parquet, linhas_por_grupo=args.linhas_por_grupo)
+    if args.arrow:
+        _exportar_arrow(df, args.arrow)
+    if args.planilha:
+        from planilha_export import _append_to_workbook_xml
+
+        _append_to_workbook_xml(Path(args.modelo).read_bytes(), df, destino=args.planilha)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
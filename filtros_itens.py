@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Cache (LRU) dos filtros da tabela de itens
+
+- Chave = assinatura do filtro: (versão do dataset, período, busca, cClassTrib, nNF, KPI)
+- Cada entrada guarda as posições (iloc) do recorte e, sob demanda, o df validado,
+  o CSV e as páginas HTML já renderizadas da tabela
+- Rerun com os mesmos filtros (ex.: clique em "Gerar planilha") não refaz nada
+- Filtro mais estreito que um já calculado (busca que só cresceu, período contido, nNF que
+  contém o anterior, cClassTrib/KPI fixados) parte do recorte largo em vez da tabela inteira
+- Colunas usadas nos filtros são convertidas uma vez por versão do dataset (datas em datetime64,
+  nNF/cClassTrib como texto, vIBS/vCBS como float)
+- Validação IBS/CBS também é calculada uma vez por versão (só as colunas novas) e juntada ao recorte
+  pelo índice; a tabela base nunca é copiada nem alterada
+- Ranking de divergência (|Dif Base IBS/CBS|) também uma vez por versão; o de cada recorte sai dele
+  em O(n), sem ordenar de novo
+
+Uso:
+    cache = _cache_filtros_novo()
+    assin = _assinatura(versao, periodo, busca, cclass, nnf, kpi)
+    entrada = _recorte(cache, df, indice_busca, assin)     # {"pos": ndarray, "validado": ..., ...}
+"""
+from collections import OrderedDict
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from busca_itens import _normalizar, _buscar
+from extrator import _colunas_validacao_base_ibscbs, _ordem_divergencia
+
+# Recortes guardados por sessão (o menos usado recentemente sai primeiro)
+CAPACIDADE_CACHE_FILTROS = 16
+
+
+def _cache_filtros_novo() -> dict:
+    return {
+        "lru": OrderedDict(),   # assinatura -> entrada
+        "versao": None,         # versão do dataset das colunas abaixo
+        "colunas": None,        # arrays dos filtros (ver _colunas_filtro)
+        "validacao": None,      # colunas de validação IBS/CBS da tabela inteira (mesmo índice)
+        "ordem_div": None,      # posições da tabela inteira por divergência (ver _ordem_divergencia)
+        "acertos": 0,
+        "refinados": 0,
+        "calculados": 0,
+    }
+
+
+def _assinatura(versao, periodo, busca: str, cclass: str | None, nnf: str, kpi: str) -> tuple:
+    """Forma canônica dos filtros (ex.: "Serviço " e "servico" são a mesma busca)."""
+    d1 = d2 = None
+    if isinstance(periodo, (list, tuple)) and len(periodo) == 2:
+        d1, d2 = periodo
+    cclass = None if not cclass or cclass == "(Todos)" else str(cclass)
+    nnf = "".join(ch for ch in str(nnf or "") if ch.isdigit())
+    return (versao, d1, d2, _normalizar(busca or ""), cclass, nnf, kpi or "all")
+
+
+def _contem(larga: tuple, estreita: tuple) -> bool:
+    """True se todo item do filtro `estreita` também passa no filtro `larga`."""
+    v1, a1, b1, q1, c1, n1, k1 = larga
+    v2, a2, b2, q2, c2, n2, k2 = estreita
+    if v1 != v2:
+        return False
+    if a1 is not None and (a2 is None or a2 < a1):
+        return False
+    if b1 is not None and (b2 is None or b2 > b1):
+        return False
+    # busca por prefixo com E lógico: "serv" -> "servico lim" só restringe
+    if not q2.startswith(q1):
+        return False
+    if c1 is not None and c1 != c2:
+        return False
+    if n1 not in n2:
+        return False
+    return k1 == "all" or k1 == k2
+
+
+def _colunas_filtro(cache: dict, df: pd.DataFrame, versao) -> dict:
+    if cache["versao"] != versao or cache["colunas"] is None:
+        def _num(c):
+            if c not in df.columns:
+                return None
+            return pd.to_numeric(df[c], errors="coerce").fillna(0).to_numpy(dtype=float)
+
+        cache["colunas"] = {
+            "data": pd.to_datetime(df["Data"], errors="coerce").to_numpy(dtype="datetime64[D]"),
+            "cclass": df["cClassTrib"].astype(str).to_numpy(),
+            "numero": df["Numero"].astype(str),
+            "vibs": _num("vIBS"),
+            "vcbs": _num("vCBS"),
+        }
+        cache["validacao"] = None
+        cache["ordem_div"] = None
+        cache["versao"] = versao
+        # recortes de outra versão não servem mais
+        cache["lru"] = OrderedDict((k, v) for k, v in cache["lru"].items() if k[0] == versao)
+    return cache["colunas"]
+
+
+def _aplicar(cols: dict, indice: dict | None, assin: tuple, pos: np.ndarray) -> np.ndarray:
+    """Filtra as posições `pos` (ordem crescente) pela assinatura."""
+    _, d1, d2, busca, cclass, nnf, kpi = assin
+    if busca and indice is not None and len(pos):
+        pos = pos[np.isin(pos, _buscar(indice, busca), assume_unique=True)]
+    if (d1 is not None or d2 is not None) and len(pos):
+        datas = cols["data"][pos]
+        ok = ~np.isnat(datas)
+        if d1 is not None:
+            ok &= datas >= np.datetime64(d1 if isinstance(d1, date) else pd.Timestamp(d1).date(), "D")
+        if d2 is not None:
+            ok &= datas <= np.datetime64(d2 if isinstance(d2, date) else pd.Timestamp(d2).date(), "D")
+        pos = pos[ok]
+    if cclass is not None and len(pos):
+        pos = pos[cols["cclass"][pos] == cclass]
+    if nnf and len(pos):
+        pos = pos[cols["numero"].iloc[pos].str.contains(nnf, regex=False, na=False).to_numpy()]
+    vibs, vcbs = cols["vibs"], cols["vcbs"]
+    if kpi != "all" and len(pos):
+        if kpi == "ibs" and vibs is not None:
+            pos = pos[vibs[pos] != 0]
+        elif kpi == "cbs" and vcbs is not None:
+            pos = pos[vcbs[pos] != 0]
+        elif kpi == "cred" and vibs is not None and vcbs is not None:
+            # créditos normalmente aparecem como valores negativos
+            pos = pos[(vibs[pos] < 0) | (vcbs[pos] < 0)]
+        elif kpi == "total" and vibs is not None and vcbs is not None:
+            pos = pos[(vibs[pos] != 0) | (vcbs[pos] != 0)]
+    return pos
+
+
+def _recorte(cache: dict, df: pd.DataFrame, indice: dict | None, assin: tuple) -> dict:
+    """
+    Entrada do cache para a assinatura: {"pos", "validado", "ordem", "csv", "paginas"}.
+    "pos" sempre preenchido; o resto é preenchido por quem usa (_validado_do_recorte etc.).
+    """
+    cols = _colunas_filtro(cache, df, assin[0])
+    lru = cache["lru"]
+    entrada = lru.get(assin)
+    if entrada is not None:
+        lru.move_to_end(assin)
+        cache["acertos"] += 1
+        return entrada
+
+    # o recorte mais estreito que contém este (menos linhas para filtrar)
+    base = None
+    for k, e in lru.items():
+        if _contem(k, assin) and (base is None or len(e["pos"]) < len(base)):
+            base = e["pos"]
+    if base is not None:
+        cache["refinados"] += 1
+    else:
+        cache["calculados"] += 1
+        base = np.arange(len(df))
+
+    entrada = {"pos": _aplicar(cols, indice, assin, base), "validado": None, "ordem": None, "csv": None, "paginas": {}}
+    lru[assin] = entrada
+    while len(lru) > CAPACIDADE_CACHE_FILTROS:
+        lru.popitem(last=False)
+    return entrada
+
+
+def _validado_do_recorte(cache: dict, df: pd.DataFrame, entrada: dict) -> pd.DataFrame:
+    """Recorte + colunas de validação (aplicar_validacao_base_ibscbs sem revalidar a cada filtro)."""
+    if entrada["validado"] is None:
+        if cache["validacao"] is None:
+            cache["validacao"] = _colunas_validacao_base_ibscbs(df)
+        pos = entrada["pos"]
+        entrada["validado"] = df.iloc[pos].join(cache["validacao"].iloc[pos])
+    return entrada["validado"]
+
+
+def _ordem_do_recorte(cache: dict, df: pd.DataFrame, entrada: dict) -> np.ndarray:
+    """Posições (iloc) dentro do recorte validado, por divergência decrescente (sai do ranking da versão)."""
+    if entrada["ordem"] is None:
+        _validado_do_recorte(cache, df, entrada)
+        if cache["ordem_div"] is None:
+            cache["ordem_div"] = _ordem_divergencia(cache["validacao"]["Dif Base IBS/CBS"])
+        pos, ordem = entrada["pos"], cache["ordem_div"]
+        no_recorte = np.zeros(len(df), dtype=bool)
+        no_recorte[pos] = True
+        entrada["ordem"] = np.searchsorted(pos, ordem[no_recorte[ordem]])
+    return entrada["ordem"]
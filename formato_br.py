@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Formatação em lote para tabelas e painéis: R$ no padrão brasileiro e texto escapado para HTML
+
+- _moeda_br: coluna inteira de números -> "1.234,56" sem format/replace por valor. Os caracteres
+  são escritos numa matriz de bytes (três dígitos por divisão, via tabela 000..999) que vira um
+  array de texto no NumPy. Mesmo resultado do "{:,.2f}" com os separadores trocados, inclusive no
+  arredondamento de meio centavo (esses poucos valores saem pelo format do Python)
+- _html_escapar: coluna de texto -> html.escape (aspas inclusive). Coluna repetitiva (número da nota,
+  arquivo, cClassTrib, descrição do item) escapa uma vez por texto distinto (pd.factorize); coluna
+  quase toda distinta só escapa os textos que têm & < > " ' (achados numa busca em lote)
+- Vazio/NaN/inválido -> "0,00" (moeda) ou "" (HTML), como os helpers antigos do app
+- _moeda_br_valor / _html_valor: um valor só (KPIs, painel de um item), mesmas regras
+
+Uso:
+    _moeda_br(df["vIBS"]).tolist()                 # ["1.234,56", "-0,01", ...]
+    _moeda_br(df["vIBS"], prefixo="R$ ")
+    _html_escapar(df["Item/Serviço"]).tolist()
+    python formato_br.py --valores 1000000         # micro-benchmark: em lote x função por valor
+"""
+import sys
+import html
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# 000..999 -> 3 códigos ASCII (linha 0 = centena, 1 = dezena, 2 = unidade)
+_TRIOS = (np.arange(1000)[None, :] // np.array([100, 10, 1])[:, None] % 10 + 48).astype(np.uint8)
+
+# Até aqui um loop com html.escape sai mais barato que as operações em lote do pandas
+_HTML_LOTE_MINIMO = 2_000
+
+# Acima disso (R$ 10 trilhões) o centavo não cabe com folga no int64: sai pelo format do Python
+_MAX_CENTAVOS = 1e15
+
+
+# -----------------------------
+# Um valor
+# -----------------------------
+def _moeda_br_valor(x, prefixo: str = "") -> str:
+    try:
+        v = float(x)
+    except (TypeError, ValueError):
+        return f"{prefixo}0,00"
+    if not np.isfinite(v):
+        return f"{prefixo}0,00"
+    return prefixo + f"{v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def _html_valor(x) -> str:
+    if x is None or (isinstance(x, float) and np.isnan(x)):
+        return ""
+    return html.escape(str(x))
+
+
+# -----------------------------
+# Coluna inteira
+# -----------------------------
+def _numeros(valores) -> np.ndarray:
+    v = np.asarray(valores)
+    if v.dtype.kind in "fiub":
+        return v.astype(float, copy=False).ravel()
+    return pd.to_numeric(pd.Series(v.ravel(), dtype=object), errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+
+def _moeda_br(valores, prefixo: str = "") -> np.ndarray:
+    """Números (lista, ndarray ou Series) -> ndarray de texto "1.234,56" (prefixo opcional, ex.: "R$ ")."""
+    v = _numeros(valores)
+    v = np.where(np.isfinite(v), v, 0.0)
+    esc = np.abs(v) * 100
+    grande = esc >= _MAX_CENTAVOS
+    if grande.any():
+        esc = np.where(grande, 0.0, esc)
+    centavos = np.rint(esc).astype(np.int64)
+    # meio centavo (ou quase, pelo erro da multiplicação): decide o format do Python, como antes
+    duvida = np.flatnonzero(np.abs(esc - np.floor(esc) - 0.5) <= esc * 1e-15 + 1e-9)
+    if len(duvida):
+        centavos[duvida] = [int(f"{x:.2f}".replace(".", "")) for x in np.abs(v[duvida]).tolist()]
+    n = len(centavos)
+    reais, cents = np.divmod(centavos, 100)
+
+    # matriz (caractere, valor) alinhada à direita: [prefixo][-]ddd.ddd,cc
+    nd_max = len(str(int(reais.max()))) if n else 1
+    grupos = -(-nd_max // 3)
+    larg = len(prefixo) + 1 + 4 * grupos - 1 + 3
+    m = np.empty((larg, n), dtype=np.uint8)
+    m[-3] = 44  # ","
+    np.take(_TRIOS[1], cents, out=m[-2])
+    np.take(_TRIOS[2], cents, out=m[-1])
+    resto = reais
+    for k in range(grupos):
+        ini = larg - 6 - 4 * k
+        if k:
+            m[ini + 3] = 46  # "."
+        resto, trio = np.divmod(resto, 1000)
+        for i in range(3):
+            np.take(_TRIOS[i], trio, out=m[ini + i])
+
+    # primeira coluna de cada valor: antes dela, espaço; sinal e prefixo logo à esquerda
+    nd = np.searchsorted(10 ** np.arange(1, nd_max, dtype=np.int64), reais, side="right") + 1
+    primeira = larg - 3 - nd - (nd - 1) // 3
+    np.putmask(m, np.arange(larg)[:, None] < primeira, 32)
+    neg = np.flatnonzero(np.signbit(v))
+    m[primeira[neg] - 1, neg] = 45  # "-"
+    if prefixo:
+        primeira = primeira - np.signbit(v) - len(prefixo)
+        todos = np.arange(n)
+        for i, ch in enumerate(prefixo):
+            m[primeira + i, todos] = ord(ch)
+
+    texto = np.ascontiguousarray(m.T, dtype=np.uint32).view(f"U{larg}").ravel()
+    texto = np.strings.lstrip(texto, " ") if not prefixo.startswith(" ") else texto
+    if grande.any():
+        texto = texto.astype(object)
+        texto[grande] = [_moeda_br_valor(x, prefixo) for x in v[grande]]
+    return texto
+
+
+def _html_escapar(valores) -> np.ndarray:
+    """Textos (lista, ndarray ou Series) -> ndarray de str com html.escape; None/NaN -> ""."""
+    if len(valores) <= _HTML_LOTE_MINIMO:
+        lista = valores.tolist() if hasattr(valores, "tolist") else list(valores)
+        return np.array([_html_valor(x) for x in lista], dtype=object)
+    s = valores if isinstance(valores, pd.Series) else pd.Series(valores)
+    # repetição estimada numa amostra: com ~1000 valores, 10% repetidos já indica poucos milhares de distintos
+    amostra = s.iloc[::max(1, len(s) // 1024)]
+    if amostra.nunique(dropna=False) < 0.9 * len(amostra):
+        # coluna repetitiva: html.escape uma vez por texto distinto
+        codigos, distintos = pd.factorize(s, sort=False)
+        escapados = np.array([html.escape(str(t)) for t in distintos.tolist()] + [""], dtype=object)
+        # código -1 (None/NaN) cai no "" do fim
+        return escapados[codigos]
+    # quase tudo distinto: só os textos com & < > " ' passam pelo html.escape (busca em lote)
+    texto = s.where(s.notna(), "").astype(str)
+    especiais = np.flatnonzero(texto.str.contains(r"[&<>\"']", regex=True).to_numpy(dtype=bool))
+    saida = texto.to_numpy(dtype=object, copy=True)
+    saida[especiais] = [html.escape(t) for t in saida[especiais].tolist()]
+    return saida
+
+
+# -----------------------------
+# Micro-benchmark (python formato_br.py)
+# -----------------------------
+def _melhor(f, repeticoes: int) -> tuple[float, object]:
+    melhor, saida = float("inf"), None
+    for _ in range(repeticoes):
+        t0 = time.perf_counter()
+        saida = f()
+        melhor = min(melhor, time.perf_counter() - t0)
+    return melhor, saida
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Micro-benchmark: formatação em lote x função por valor.")
+    ap.add_argument("--valores", type=int, default=1_000_000, help="tamanho das colunas")
+    ap.add_argument("--repeticoes", type=int, default=3, help="passadas por medida (vale a melhor)")
+    args = ap.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    n = args.valores
+    # valores de item (centavos; 1 em 10 negativo, como créditos) e textos com repetição típica de um lote
+    valores = np.round(rng.lognormal(5, 2, n), 2) * np.where(rng.random(n) < 0.1, -1, 1)
+    descricoes = np.array([f"SERVIÇO DE LIMPEZA & CONSERVAÇÃO <{i}>" for i in range(2_000)], dtype=object)
+    textos = {
+        "texto repetido (2 mil distintos)": pd.Series(descricoes[rng.integers(0, len(descricoes), n)]),
+        "texto distinto (2% com aspas)": pd.Series([f"ITEM {i} D'ÁGUA" if i % 50 == 0 else f"ITEM {i} ÁGUA"
+                                                     for i in range(n)]),
+    }
+
+    print(f"{n} valores; melhor de {args.repeticoes} passadas")
+    casos = [
+        ("R$ (1.234,56)", lambda: _moeda_br(valores).tolist(),
+         lambda: [_moeda_br_valor(x) for x in valores.tolist()]),
+    ] + [
+        (f"HTML, {nome}", lambda s=s: _html_escapar(s).tolist(), lambda s=s: [_html_valor(x) for x in s.tolist()])
+        for nome, s in textos.items()
+    ]
+    for nome, em_lote, por_valor in casos:
+        t_lote, a = _melhor(em_lote, args.repeticoes)
+        t_valor, b = _melhor(por_valor, args.repeticoes)
+        print(f"  {nome:<36} em lote {t_lote * 1e3:8.1f} ms | por valor {t_valor * 1e3:8.1f} ms | "
+              f"{t_valor / t_lote:4.1f}x | {'iguais' if a == b else 'DIFERENTES'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Ingestão em segundo plano (upload do app)
+
+- Uma thread por job processa os arquivos (XML/ZIP) com as regras de extrator._ingerir_documento
+  (deduplicação, totais por nota, cancelamentos)
+- A cada LOTE_PARCIAL documentos (ou INTERVALO_PARCIAL segundos) a thread põe numa fila só o que
+  é novo; a interface drena a fila (_coletar_ingestao) e já mostra os itens parciais
+- Progresso (feitos/total, docs/s, ETA, erros) e cancelamento (threading.Event) sem travar a página
+- A thread termina pondo um marcador de fim na fila, depois do último parcial: o job só conta como
+  concluído (_ingestao_concluida) quando a interface já coletou esse marcador, ou seja, com tudo
+  no resultado (job["fim"] sozinho não garante que o último parcial foi coletado)
+- Cada item recebe "id_item" (inteiro sequencial do job) ao entrar no resultado: é a posição dele na
+  lista e não muda com os lotes seguintes (seletores/detalhes/downloads do app usam esse id)
+
+Uso:
+    job = _iniciar_ingestao([(nome, bytes), ...])
+    _coletar_ingestao(job)           # a cada rerun / tick: junta o que já foi processado
+    p = _progresso_ingestao(job)     # {"feitos", "total", "docs_s", "eta_s", "erros", "status", ...}
+    _ingestao_concluida(job)         # True só depois de coletado o último parcial
+    _cancelar_ingestao(job)
+"""
+import time
+import queue
+import threading
+
+from extrator import (
+    _novo_estado_lote, _contar_documentos, _documentos_do_arquivo, _ingerir_documento, _n_itens, _juntar_colunas,
+)
+
+# Documentos por mensagem na fila (e intervalo máximo entre mensagens)
+LOTE_PARCIAL = 200
+INTERVALO_PARCIAL = 0.5
+
+# Última mensagem da thread na fila (vem depois do último parcial)
+_FIM_INGESTAO = None
+
+
+def _novo_parcial(vistos: set) -> dict:
+    parcial = _novo_estado_lote(guardar_xml=True)
+    parcial["vistos"] = vistos  # deduplicação vale para o job inteiro
+    return parcial
+
+
+def _trabalhador(job: dict, arquivos: list[tuple[str, bytes]]) -> None:
+    fila, cancelar = job["fila"], job["cancelar"]
+    try:
+        job["total"] = sum(_contar_documentos(nome, dados) for nome, dados in arquivos)
+        vistos: set[str] = set()
+        parcial = _novo_parcial(vistos)
+        n_parcial, t_parcial = 0, time.perf_counter()
+
+        for nome, dados in arquivos:
+            if cancelar.is_set():
+                break
+            n = 0
+            try:
+                for src, xb in _documentos_do_arquivo(nome, dados):
+                    if cancelar.is_set():
+                        break
+                    _ingerir_documento(parcial, src, xb)
+                    n += 1
+                    n_parcial += 1
+                    job["feitos"] += 1
+                    if n_parcial >= LOTE_PARCIAL or time.perf_counter() - t_parcial >= INTERVALO_PARCIAL:
+                        fila.put(parcial)
+                        parcial = _novo_parcial(vistos)
+                        n_parcial, t_parcial = 0, time.perf_counter()
+                if n == 0 and not cancelar.is_set():
+                    parcial["erros"].append(f"{nome}: pacote sem .xml")
+            except Exception as e:
+                parcial["erros"].append(f"{nome}: erro ao ler ({e})")
+
+        fila.put(parcial)
+        job["status"] = "cancelado" if cancelar.is_set() else "concluido"
+    except Exception as e:  # falha fora de um arquivo específico (não deveria acontecer)
+        job["falha"] = str(e)
+        job["status"] = "erro"
+    finally:
+        job["fim"] = time.perf_counter()
+        fila.put(_FIM_INGESTAO)
+
+
+def _iniciar_ingestao(arquivos: list[tuple[str, bytes]], chave=None) -> dict:
+    """Dispara a thread e retorna o job (guardar em st.session_state)."""
+    job = {
+        "chave": chave,
+        "total": None,          # definido pela thread (conta os .xml dos ZIPs)
+        "feitos": 0,
+        "inicio": time.perf_counter(),
+        "fim": None,
+        "coletado": False,      # marcador de fim já coletado: resultado completo
+        "status": "rodando",    # rodando | concluido | cancelado | erro
+        "falha": None,
+        "fila": queue.Queue(),
+        "cancelar": threading.Event(),
+        "resultado": _novo_estado_lote(guardar_xml=True),  # só a interface mexe (via _coletar_ingestao)
+    }
+    job["thread"] = threading.Thread(target=_trabalhador, args=(job, arquivos), name="ingestao-xml", daemon=True)
+    job["thread"].start()
+    return job
+
+
+def _coletar_ingestao(job: dict) -> int:
+    """Junta no resultado do job tudo o que a thread já mandou. Retorna quantas mensagens leu."""
+    res = job["resultado"]
+    lidas = 0
+    while True:
+        try:
+            parcial = job["fila"].get_nowait()
+        except queue.Empty:
+            break
+        if parcial is _FIM_INGESTAO:
+            job["coletado"] = True
+            break
+        lidas += 1
+        colunas = parcial["colunas_itens"]
+        n = _n_itens(colunas)
+        if n:
+            inicio = _n_itens(res["colunas_itens"])
+            colunas["id_item"] = list(range(inicio, inicio + n))
+        _juntar_colunas(res["colunas_itens"], colunas)
+        for k in ("notas", "cancelados", "erros"):
+            res[k].extend(parcial[k])
+        for k, v in parcial["totais"].items():
+            res["totais"][k] += v
+        res["duplicados"] += parcial["duplicados"]
+        res["processados"] += parcial["processados"]
+        res["xml_store"].update(parcial["xml_store"])
+    return lidas
+
+
+def _aguardar_ingestao(job: dict, timeout: float | None = None) -> bool:
+    """Espera a thread (até timeout) e coleta. True se o job terminou e o resultado está completo."""
+    job["thread"].join(timeout)
+    _coletar_ingestao(job)
+    return _ingestao_concluida(job)
+
+
+def _ingestao_concluida(job: dict) -> bool:
+    """True quando a thread terminou e tudo o que ela mandou já está em job["resultado"]."""
+    return job["coletado"]
+
+
+def _cancelar_ingestao(job: dict) -> None:
+    job["cancelar"].set()
+
+
+def _progresso_ingestao(job: dict) -> dict:
+    fim = job["fim"] or time.perf_counter()
+    decorrido = max(fim - job["inicio"], 1e-9)
+    feitos, total = job["feitos"], job["total"]
+    docs_s = feitos / decorrido
+    eta = None
+    if total and job["fim"] is None and docs_s > 0:
+        eta = max(total - feitos, 0) / docs_s
+    return {
+        "status": job["status"],
+        "feitos": feitos,
+        "total": total,
+        "fracao": (feitos / total) if total else 0.0,
+        "docs_s": docs_s,
+        "eta_s": eta,
+        "decorrido_s": decorrido,
+        "erros": len(job["resultado"]["erros"]),
+        "itens": _n_itens(job["resultado"]["colunas_itens"]),
+    }
@@ -0,0 +1,1155 @@
+# -*- coding: utf-8 -*-
+"""
+Exportação da planilha sem openpyxl (aba LANCAMENTOS)
+
+- Não abre o template no openpyxl: a aba LANCAMENTOS é reescrita direto no XML (xl/worksheets/sheetN.xml)
+- Cabeçalho, seções e linhas já preenchidas do modelo são copiados como estão
+- Cada item vira uma <row> gerada a partir da linha-modelo (mesmos estilos + fórmulas traduzidas)
+- As demais abas/partes do .xlsx são copiadas sem alteração
+- Memória constante no número de linhas: as linhas são geradas e gravadas no ZIP em blocos
+
+Uso:
+    out_bytes = _append_to_workbook_streaming(template_bytes, df)   # reescreve a aba
+    out_bytes = _append_to_workbook_xml(template_bytes, df)         # patch da aba (resto intacto)
+    zip_bytes, relatorio = _gerar_zip_particoes(template_bytes, df, por="cnpj")  # 1 .xlsx por CNPJ
+"""
+import io
+import os
+import re
+import json
+import hashlib
+import zipfile
+import threading
+import tempfile
+import time
+import multiprocessing
+import posixpath
+import xml.etree.ElementTree as ET
+from datetime import datetime, date
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+from openpyxl.formula.translate import Translator
+from openpyxl.utils import get_column_letter, column_index_from_string
+
+NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+ABA_LANCAMENTOS = "LANCAMENTOS"
+
+# Campos de ENTRADA gravados pelo app (o resto da linha vem da linha-modelo)
+CAMPOS_ENTRADA = [
+    "Data", "Numero", "Item/Serviço", "cClassTrib",
+    "Valor da operação", "vIBS", "vCBS", "arquivo", "Fonte do valor"
+]
+
+# Quantas linhas geradas acumular antes de gravar no ZIP
+LINHAS_POR_BLOCO = 2000
+
+_EXCEL_EPOCH = date(1899, 12, 30)
+_DATE_NUMFMT_IDS = {14, 15, 16, 17, 22}
+_TIPOS_TEXTO = ("s", "inlineStr", "str")
+
+_RE_ROW = re.compile(r"<row\b([^>]*?)(?:/>|>(.*?)</row>)", re.S)
+_RE_CELL = re.compile(r"<c\b([^>]*?)(?:/>|>(.*?)</c>)", re.S)
+_RE_ATTR = re.compile(r'([\w:]+)="([^"]*)"')
+_RE_F = re.compile(r"<f\b([^>]*?)(?:/>|>(.*?)</f>)", re.S)
+_RE_V = re.compile(r"<v>(.*?)</v>", re.S)
+_RE_T = re.compile(r"<t\b[^>]*>(.*?)</t>", re.S)
+_RE_COORD = re.compile(r"([A-Z]+)(\d+)")
+_RE_FORMULA_TEXTO = re.compile(r"(\"(?:[^\"]|\"\")*\"|'(?:[^']|'')*')")
+_RE_FORMULA_REF = re.compile(
+    r"(?<![\w.$])(?:"
+    r"(?P<col>\$?[A-Za-z]{1,3})(?P<d>\$?)(?P<row>\d+)(?![\w(.])"
+    r"|(?P<d1>\$?)(?P<r1>\d+):(?P<d2>\$?)(?P<r2>\d+)(?![\w.])"
+    r")"
+)
+# caracteres de controle não permitidos em XML 1.0
+_RE_ILLEGAL = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+# -----------------------------
+# Helpers de XML cru
+# -----------------------------
+def _unescape(s: str) -> str:
+    return (
+        s.replace("&lt;", "<").replace("&gt;", ">")
+        .replace("&quot;", '"').replace("&apos;", "'").replace("&amp;", "&")
+    )
+
+
+def _attrs(raw: str) -> dict[str, str]:
+    return dict(_RE_ATTR.findall(raw or ""))
+
+
+def _parse_cell(attr_raw: str, inner: str | None) -> dict:
+    """Quebra um <c> cru em: coluna, estilo, tipo, fórmula e valor (ainda em XML)."""
+    a = _attrs(attr_raw)
+    m = _RE_COORD.fullmatch(a.get("r", ""))
+    col = column_index_from_string(m.group(1)) if m else 0
+    cell = {
+        "col": col,
+        "s": a.get("s"),
+        "t": a.get("t"),
+        "f": None,        # texto da fórmula (sem escape)
+        "f_attrs": {},
+        "inner": inner or "",
+    }
+    if inner:
+        fm = _RE_F.search(inner)
+        if fm:
+            cell["f_attrs"] = _attrs(fm.group(1))
+            cell["f"] = _unescape(fm.group(2)) if fm.group(2) else None
+    return cell
+
+
+def _cell_text(cell: dict, shared_strings: list[str]) -> str | None:
+    """Valor de texto de uma célula (shared string, inline ou número)."""
+    inner = cell["inner"]
+    if not inner:
+        return None
+    if cell["t"] == "s":
+        vm = _RE_V.search(inner)
+        try:
+            return shared_strings[int(vm.group(1))] if vm else None
+        except (ValueError, IndexError):
+            return None
+    if cell["t"] == "inlineStr":
+        return _unescape("".join(_RE_T.findall(inner)))
+    vm = _RE_V.search(inner)
+    return _unescape(vm.group(1)) if vm and vm.group(1) else None
+
+
+def _read_shared_strings(z: zipfile.ZipFile) -> list[str]:
+    try:
+        root = ET.fromstring(z.read("xl/sharedStrings.xml"))
+    except KeyError:
+        return []
+    out = []
+    for si in root.findall(f"{{{NS_MAIN}}}si"):
+        out.append("".join(t.text or "" for t in si.iter(f"{{{NS_MAIN}}}t")))
+    return out
+
+
+def _localizar_aba(z: zipfile.ZipFile, nome: str = ABA_LANCAMENTOS) -> str:
+    """Retorna o caminho da parte XML da aba (ex.: xl/worksheets/sheet3.xml).
+    Se a aba não existir, usa a aba ativa (mesmo fallback do writer openpyxl).
+    """
+    wb = ET.fromstring(z.read("xl/workbook.xml"))
+    rels = ET.fromstring(z.read("xl/_rels/workbook.xml.rels"))
+    targets = {r.get("Id"): r.get("Target") for r in rels.findall(f"{{{NS_PKG_REL}}}Relationship")}
+
+    sheets = wb.findall(f"{{{NS_MAIN}}}sheets/{{{NS_MAIN}}}sheet")
+    if not sheets:
+        raise ValueError("template sem abas")
+    escolhida = next((s for s in sheets if s.get("name") == nome), None)
+    if escolhida is None:
+        view = wb.find(f"{{{NS_MAIN}}}bookViews/{{{NS_MAIN}}}workbookView")
+        idx = int(view.get("activeTab", 0)) if view is not None else 0
+        escolhida = sheets[min(idx, len(sheets) - 1)]
+
+    target = targets[escolhida.get(f"{{{NS_REL}}}id")]
+    if target.startswith("/"):
+        return target.lstrip("/")
+    return posixpath.normpath(posixpath.join("xl", target))
+
+
+# -----------------------------
+# Fórmulas: tradução pré-compilada (linha-modelo -> linha N)
+# -----------------------------
+def _compilar_formula(formula: str, origem_row: int) -> tuple[str, tuple[int, ...]]:
+    """Pré-processa uma fórmula da linha-modelo.
+
+    Retorna (fmt, deltas): fmt é o XML já escapado com "{0}", "{1}"... no lugar das
+    linhas RELATIVAS, e deltas é o deslocamento de cada uma em relação à linha-modelo.
+    Assim cada linha nova custa só um str.format (sem tokenizar a fórmula de novo).
+    Referências absolutas ($4), colunas inteiras ($E:$E) e textos entre aspas ficam intactos.
+
+    Obs.: não usa o Tokenizer do openpyxl porque ele falha em fórmulas com quebra de linha
+    (as validações do modelo têm), e aí o writer antigo copiava a fórmula sem traduzir.
+    """
+    partes: list[str] = []
+    deltas: list[int] = []
+
+    def _lit(s: str):
+        if s:
+            partes.append(escape(s).replace("{", "{{").replace("}", "}}"))
+
+    def _linha(dollar: str, num: str):
+        if dollar:
+            _lit(dollar + num)
+        else:
+            partes.append("{%d}" % len(deltas))
+            deltas.append(int(num) - origem_row)
+
+    for i, trecho in enumerate(_RE_FORMULA_TEXTO.split(formula)):
+        if i % 2:
+            # literal "..." ou nome de aba '...'
+            _lit(trecho)
+            continue
+        pos = 0
+        for m in _RE_FORMULA_REF.finditer(trecho):
+            _lit(trecho[pos:m.start()])
+            if m.group("col") is not None:
+                _lit(m.group("col"))
+                _linha(m.group("d"), m.group("row"))
+            else:
+                _linha(m.group("d1"), m.group("r1"))
+                _lit(":")
+                _linha(m.group("d2"), m.group("r2"))
+            pos = m.end()
+        _lit(trecho[pos:])
+
+    return "".join(partes), tuple(deltas)
+
+
+def _traduzir(formula_fmt: str, deltas: tuple[int, ...], row: int) -> str:
+    if not deltas:
+        return formula_fmt.replace("{{", "{").replace("}}", "}")
+    return formula_fmt.format(*[row + d for d in deltas])
+
+
+# -----------------------------
+# Análise do template (LANCAMENTOS)
+# -----------------------------
+def _analisar_template(template_bytes: bytes) -> dict:
+    """Lê o template (ZIP) e devolve o "perfil" da aba LANCAMENTOS.
+
+    Mesmas regras do writer openpyxl:
+      - header_row: primeira linha (1..25) com >= 3 cabeçalhos esperados
+      - headers: nome -> coluna (até 200 colunas)
+      - template_row = header_row + 2 (linha-modelo com fórmulas/estilos)
+      - next_row: primeira linha livre após o último "Data" preenchido
+    """
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as z:
+        sheet_path = _localizar_aba(z)
+        shared = _read_shared_strings(z)
+        sheet_xml = z.read(sheet_path).decode("utf-8")
+
+    i0 = sheet_xml.find("<sheetData")
+    i1 = sheet_xml.find("</sheetData>")
+    if i0 < 0:
+        raise ValueError("aba LANCAMENTOS sem <sheetData>")
+    if i1 < 0:
+        # <sheetData/> vazio
+        i1 = sheet_xml.find(">", i0) + 1
+    body_start = sheet_xml.find(">", i0) + 1
+
+    expected = {"Data", "Numero", "Item/Serviço", "cClassTrib", "Valor da operação"}
+    header_row = None
+    first_rows: dict[int, list[dict]] = {}
+    rows_meta: list[tuple[int, dict]] = []
+    col_styles: dict[int, str] = {}
+
+    for cm in re.finditer(r"<col\b([^>]*)/>", sheet_xml[:i0]):
+        a = _attrs(cm.group(1))
+        if "style" in a:
+            for c in range(int(a.get("min", 0)), min(int(a.get("max", 0)), 200) + 1):
+                col_styles[c] = a["style"]
+
+    for m in _RE_ROW.finditer(sheet_xml, body_start, i1):
+        ra = _attrs(m.group(1))
+        r = int(ra.get("r", len(rows_meta) + 1))
+        rows_meta.append((r, ra))
+        if r <= 27:
+            first_rows[r] = [_parse_cell(c.group(1), c.group(2)) for c in _RE_CELL.finditer(m.group(2) or "")]
+        if header_row is None and r <= 25:
+            values = []
+            for c in first_rows[r]:
+                if 1 <= c["col"] <= 100 and c["t"] in _TIPOS_TEXTO:
+                    v = _cell_text(c, shared)
+                    if isinstance(v, str):
+                        values.append(v.strip())
+            if len(expected.intersection(values)) >= 3:
+                header_row = r
+
+    if header_row is None:
+        header_row = 1
+
+    headers: dict[str, int] = {}
+    last_col = 0
+    for c in first_rows.get(header_row, []):
+        if 1 <= c["col"] <= 200 and c["t"] in _TIPOS_TEXTO:
+            v = _cell_text(c, shared)
+            if isinstance(v, str) and v.strip():
+                headers[v.strip()] = c["col"]
+                last_col = max(last_col, c["col"])
+    if last_col == 0:
+        last_col = max([c["col"] for cells in first_rows.values() for c in cells if c["col"] <= 200] or [1])
+
+    template_row = header_row + 2
+
+    # fórmulas compartilhadas (t="shared"): guarda o "mestre" para resolver dependentes
+    shared_masters: dict[str, tuple[str, str]] = {}
+    for r in sorted(first_rows):
+        if r > template_row:
+            break
+        for c in first_rows[r]:
+            fa = c["f_attrs"]
+            if fa.get("t") == "shared" and c["f"] and "si" in fa:
+                shared_masters[fa["si"]] = (c["f"], f"{get_column_letter(c['col'])}{r}")
+
+    row_attrs = {}
+    cells_modelo: dict[int, dict] = {}
+    for r, ra in rows_meta:
+        if r == template_row:
+            row_attrs = {k: v for k, v in ra.items() if k not in ("r", "spans")}
+            break
+    for c in first_rows.get(template_row, []):
+        if 1 <= c["col"] <= last_col:
+            cells_modelo[c["col"]] = c
+
+    # célula da linha-modelo -> (estilo, fórmula compilada | valor cru)
+    modelo: list[dict] = []
+    input_cols = {headers[f]: f for f in CAMPOS_ENTRADA if f in headers}
+    for col in range(1, last_col + 1):
+        c = cells_modelo.get(col)
+        style = (c or {}).get("s") or col_styles.get(col)
+        item = {"col": col, "letter": get_column_letter(col), "s": style, "field": input_cols.get(col)}
+        if item["field"] is None and c is not None:
+            formula = c["f"]
+            fa = c["f_attrs"]
+            if formula is None and fa.get("t") == "shared" and fa.get("si") in shared_masters:
+                mf, mcoord = shared_masters[fa["si"]]
+                formula = Translator("=" + mf, origin=mcoord).translate_formula(
+                    f"{item['letter']}{template_row}"
+                )[1:]
+            if formula is not None:
+                item["formula"] = _compilar_formula(formula, template_row)
+            elif c["inner"] and c["t"] != "str":
+                vm = _RE_V.search(c["inner"])
+                if c["t"] == "inlineStr" or vm:
+                    item["t"] = c["t"]
+                    item["inner"] = c["inner"]
+        if c is None and item["s"] is None and item["field"] is None:
+            continue
+        modelo.append(item)
+
+    # próxima linha vazia olhando a coluna "Data"
+    last_row = rows_meta[-1][0] if rows_meta else 0
+    next_row = last_row + 1
+    if "Data" in headers:
+        col_data = get_column_letter(headers["Data"])
+        re_data = re.compile(r'<c r="%s(\d+)"([^>]*?)(?:/>|>(.*?)</c>)' % col_data, re.S)
+        ultimo = template_row - 1
+        for m in re_data.finditer(sheet_xml, body_start, i1):
+            r = int(m.group(1))
+            if r < template_row or not m.group(3):
+                continue
+            cell = _parse_cell(f' r="{col_data}{r}"{m.group(2)}', m.group(3))
+            if cell["f_attrs"] or _cell_text(cell, shared) not in (None, ""):
+                ultimo = r
+        next_row = max(ultimo + 1, template_row)
+
+    return {
+        "sheet_path": sheet_path,
+        "header_row": header_row,
+        "headers": headers,
+        "last_col": last_col,
+        "template_row": template_row,
+        "next_row": next_row,
+        "last_row": last_row,
+        "row_attrs": row_attrs,
+        "modelo": modelo,
+        "max_si": max((int(x) for x in re.findall(r'\bsi="(\d+)"', sheet_xml)), default=-1),
+        "date_style": None,
+    }
+
+
+# -----------------------------
+# Cache do perfil do template (por hash do arquivo)
+# -----------------------------
+# O template não muda durante a vida do processo: a análise (cabeçalho, mapa de colunas,
+# estilos e fórmulas compiladas da linha-modelo, próxima linha livre) é feita 1x por
+# conteúdo de arquivo e reaproveitada por todas as sessões. Também vai para disco (JSON),
+# para execuções em lote/CLI e reinícios do app.
+PERFIL_VERSAO = 1
+CACHE_DIR = Path(os.environ.get("EXTRATOR_CACHE_DIR") or (Path(__file__).parent / ".cache"))
+
+_PERFIS: dict[str, dict] = {}
+_PERFIS_LOCK = threading.Lock()
+
+
+def _perfil_do_json(d: dict) -> dict:
+    for item in d["modelo"]:
+        if "formula" in item:
+            fmt, deltas = item["formula"]
+            item["formula"] = (fmt, tuple(deltas))
+    return d
+
+
+def _perfil_template(template_bytes: bytes) -> dict:
+    """Perfil da aba LANCAMENTOS com cache em memória + disco (chave = sha256 do template).
+    Retorna sempre o mesmo dict para o mesmo arquivo: quem for alterar, copie (dict(perfil)).
+    """
+    chave = hashlib.sha256(template_bytes).hexdigest()
+    perfil = _PERFIS.get(chave)
+    if perfil is not None:
+        return perfil
+
+    with _PERFIS_LOCK:
+        perfil = _PERFIS.get(chave)
+        if perfil is not None:
+            return perfil
+
+        arq = CACHE_DIR / f"perfil_template_{chave[:16]}.json"
+        try:
+            d = json.loads(arq.read_text(encoding="utf-8"))
+            if d.get("versao") == PERFIL_VERSAO and d.get("sha256") == chave:
+                perfil = _perfil_do_json(d["perfil"])
+        except (OSError, ValueError, KeyError, TypeError):
+            perfil = None
+
+        if perfil is None:
+            perfil = _analisar_template(template_bytes)
+            try:
+                CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                tmp = arq.with_suffix(f".{os.getpid()}.tmp")
+                tmp.write_text(
+                    json.dumps({"versao": PERFIL_VERSAO, "sha256": chave, "perfil": perfil}, ensure_ascii=False),
+                    encoding="utf-8",
+                )
+                os.replace(tmp, arq)
+            except OSError:
+                # sem permissão de escrita: fica só o cache em memória
+                pass
+
+        _PERFIS[chave] = perfil
+        return perfil
+
+
+# -----------------------------
+# Estilo de data (dd/mm/yyyy)
+# -----------------------------
+def _estilo_e_data(styles_xml: str, s_idx: str | None) -> bool:
+    if s_idx is None:
+        return False
+    i = styles_xml.find("<cellXfs")
+    j = styles_xml.find("</cellXfs>")
+    xfs = re.findall(r"<xf\b[^>]*>", styles_xml[i:j])
+    try:
+        num_fmt = int(_attrs(xfs[int(s_idx)]).get("numFmtId", 0))
+    except (ValueError, IndexError):
+        return False
+    if num_fmt in _DATE_NUMFMT_IDS:
+        return True
+    m = re.search(r'<numFmt numFmtId="%d" formatCode="([^"]*)"' % num_fmt, styles_xml)
+    code = _unescape(m.group(1)).lower() if m else ""
+    code = re.sub(r'"[^"]*"|\[[^\]]*\]', "", code)
+    return "d" in code and "y" in code
+
+
+def _garantir_estilo_data(styles_xml: str, base_idx: str | None) -> tuple[str, str]:
+    """Garante um xf com formato dd/mm/yyyy (copiando o estilo da coluna Data).
+    Retorna (styles_xml, indice_do_xf).
+    """
+    if _estilo_e_data(styles_xml, base_idx):
+        return styles_xml, base_idx
+
+    ids = [int(x) for x in re.findall(r'<numFmt numFmtId="(\d+)"', styles_xml)]
+    fmt_id = max(ids + [163]) + 1
+    num_fmt = f'<numFmt numFmtId="{fmt_id}" formatCode="dd/mm/yyyy"/>'
+    if "<numFmts" in styles_xml:
+        styles_xml = re.sub(
+            r'<numFmts count="(\d+)">',
+            lambda m: f'<numFmts count="{int(m.group(1)) + 1}">',
+            styles_xml, count=1,
+        ).replace("</numFmts>", num_fmt + "</numFmts>", 1)
+    else:
+        styles_xml = re.sub(r"(<styleSheet\b[^>]*>)", r'\1<numFmts count="1">' + num_fmt + "</numFmts>", styles_xml, count=1)
+
+    i = styles_xml.find("<cellXfs")
+    j = styles_xml.find("</cellXfs>")
+    bloco = styles_xml[i:j]
+    xfs = re.findall(r"<xf\b[^>]*?(?:/>|>.*?</xf>)", bloco, re.S)
+    base = xfs[int(base_idx)] if base_idx is not None and int(base_idx) < len(xfs) else '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    novo = re.sub(r'numFmtId="\d+"', f'numFmtId="{fmt_id}"', base, count=1)
+    if "applyNumberFormat" not in novo:
+        novo = novo.replace("<xf ", '<xf applyNumberFormat="1" ', 1)
+    novo_idx = len(xfs)
+    bloco = re.sub(r'<cellXfs count="\d+"', f'<cellXfs count="{novo_idx + 1}"', bloco, count=1)
+    styles_xml = styles_xml[:i] + bloco + novo + styles_xml[j:]
+    return styles_xml, str(novo_idx)
+
+
+# -----------------------------
+# Geração das linhas
+# -----------------------------
+def _cell_xml_valor(ref: str, s: str | None, val) -> str:
+    s_attr = f' s="{s}"' if s is not None else ""
+    if val is None:
+        return f'<c r="{ref}"{s_attr}/>'
+    if isinstance(val, (datetime, date)):
+        d = val.date() if isinstance(val, datetime) else val
+        return f'<c r="{ref}"{s_attr}><v>{(d - _EXCEL_EPOCH).days}</v></c>'
+    if isinstance(val, bool):
+        return f'<c r="{ref}"{s_attr} t="b"><v>{int(val)}</v></c>'
+    if isinstance(val, (int, float)):
+        return f'<c r="{ref}"{s_attr}><v>{val!r}</v></c>'
+    txt = escape(_RE_ILLEGAL.sub("", str(val)))
+    sp = ' xml:space="preserve"' if txt[:1].isspace() or txt[-1:].isspace() else ""
+    return f'<c r="{ref}"{s_attr} t="inlineStr"><is><t{sp}>{txt}</t></is></c>'
+
+
+def _normaliza_valor(val):
+    if val is None:
+        return None
+    try:
+        if pd.isna(val):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if isinstance(val, np.generic):
+        # numpy scalar -> python
+        return val.item()
+    return val
+
+
+def _gerar_linhas(perfil: dict, df: pd.DataFrame, start_row: int, shared_si: dict[int, str] | None = None):
+    """Gera o XML das novas <row>, em blocos de LINHAS_POR_BLOCO linhas.
+
+    shared_si (coluna -> si): grava as fórmulas como fórmula compartilhada do Excel
+    (mestre na primeira linha com ref="M10:M500", demais linhas só <f t="shared" si=".."/>).
+    """
+    modelo = perfil["modelo"]
+    fim = start_row + len(df) - 1
+    if fim <= start_row:
+        shared_si = None
+    headers = perfil["headers"]
+    date_style = perfil.get("date_style")
+    row_attr_xml = "".join(f' {k}="{v}"' for k, v in perfil["row_attrs"].items())
+    spans = f' spans="1:{perfil["last_col"]}"'
+
+    campos = [f for f in CAMPOS_ENTRADA if f in headers]
+    cols_df = [f for f in campos if f in df.columns]
+    bloco: list[str] = []
+    r = start_row
+    for valores in df[cols_df].itertuples(index=False, name=None) if cols_df else ((),) * len(df):
+        linha = dict(zip(cols_df, valores))
+        cells = []
+        for item in modelo:
+            ref = f"{item['letter']}{r}"
+            field = item["field"]
+            if field is not None:
+                val = _normaliza_valor(linha.get(field))
+                s = item["s"]
+                if field == "Data" and isinstance(val, date):
+                    s = date_style or s
+                cells.append(_cell_xml_valor(ref, s, val))
+            elif "formula" in item:
+                s_attr = f' s="{item["s"]}"' if item["s"] is not None else ""
+                si = shared_si.get(item["col"]) if shared_si else None
+                if si is not None and r != start_row:
+                    cells.append(f'<c r="{ref}"{s_attr}><f t="shared" si="{si}"/></c>')
+                    continue
+                fmt, deltas = item["formula"]
+                texto = _traduzir(fmt, deltas, r)
+                if si is not None:
+                    f_attr = f' t="shared" ref="{ref}:{item["letter"]}{fim}" si="{si}"'
+                else:
+                    f_attr = ""
+                cells.append(f'<c r="{ref}"{s_attr}><f{f_attr}>{texto}</f></c>')
+            elif "inner" in item:
+                s_attr = f' s="{item["s"]}"' if item["s"] is not None else ""
+                t_attr = f' t="{item["t"]}"' if item.get("t") else ""
+                cells.append(f'<c r="{ref}"{s_attr}{t_attr}>{item["inner"]}</c>')
+            else:
+                cells.append(f'<c r="{ref}" s="{item["s"]}"/>')
+        bloco.append(f'<row r="{r}"{spans}{row_attr_xml}>{"".join(cells)}</row>')
+        r += 1
+        if len(bloco) >= LINHAS_POR_BLOCO:
+            yield "".join(bloco)
+            bloco = []
+    if bloco:
+        yield "".join(bloco)
+
+
+def _resolver_shared_orfao(row_xml: str, masters: dict[str, tuple[str, str]], removidos: set[str]) -> str:
+    """Linha mantida que depende de fórmula compartilhada cujo mestre foi removido:
+    troca o <f t="shared" si=".."/> pela fórmula explícita traduzida.
+    """
+    if 't="shared"' not in row_xml:
+        return row_xml
+
+    def _fix_cell(cm: re.Match) -> str:
+        inner = cm.group(2)
+        if not inner or 't="shared"' not in inner:
+            return cm.group(0)
+        fm = _RE_F.search(inner)
+        fa = _attrs(fm.group(1))
+        si = fa.get("si")
+        if fm.group(2) or si not in removidos or si not in masters:
+            return cm.group(0)
+        mf, mcoord = masters[si]
+        coord = _attrs(cm.group(1)).get("r", "")
+        try:
+            novo = Translator("=" + mf, origin=mcoord).translate_formula(coord)[1:]
+        except Exception:
+            novo = mf
+        inner2 = inner[:fm.start()] + f"<f>{escape(novo)}</f>" + inner[fm.end():]
+        return f"<c{cm.group(1)}>{inner2}</c>"
+
+    return _RE_CELL.sub(_fix_cell, row_xml)
+
+
+# -----------------------------
+# Partes auxiliares (workbook.xml, calcChain, content types)
+# -----------------------------
+def _forcar_recalculo(workbook_xml: str) -> str:
+    """Excel recalcula tudo ao abrir (as linhas novas não têm valor em cache)."""
+    if "<calcPr" in workbook_xml:
+        if "fullCalcOnLoad" in workbook_xml:
+            return re.sub(r'fullCalcOnLoad="\w+"', 'fullCalcOnLoad="1"', workbook_xml)
+        return workbook_xml.replace("<calcPr", '<calcPr fullCalcOnLoad="1"', 1)
+    return workbook_xml.replace("</workbook>", '<calcPr fullCalcOnLoad="1"/></workbook>', 1)
+
+
+def _remover_calc_chain(content_types: str, wb_rels: str) -> tuple[str, str]:
+    content_types = re.sub(r'<Override PartName="/xl/calcChain.xml"[^>]*/>', "", content_types)
+    wb_rels = re.sub(r'<Relationship\b[^>]*Target="[^"]*calcChain.xml"[^>]*/>', "", wb_rels)
+    return content_types, wb_rels
+
+
+# -----------------------------
+# Writer streaming
+# -----------------------------
+def _append_to_workbook_streaming(template_bytes: bytes, df: pd.DataFrame, destino=None, perfil: dict | None = None):
+    """
+    Grava df na aba LANCAMENTOS sem carregar o workbook no openpyxl.
+
+    - Linhas do template antes da "próxima linha livre" são mantidas (cabeçalho, seções, dados já existentes)
+    - As novas linhas substituem as linhas pré-formatadas vazias a partir de next_row
+    - Linhas pré-formatadas depois do bloco gerado continuam no arquivo
+    - calcChain.xml é removido (Excel reconstrói) e o workbook é marcado para recalcular ao abrir
+
+    destino: caminho ou arquivo binário aberto; se None, retorna os bytes do .xlsx.
+    """
+    perfil = dict(perfil or _perfil_template(template_bytes))
+    sheet_path = perfil["sheet_path"]
+    n = len(df)
+    _checar_limite_excel(perfil, n)
+    start = perfil["next_row"]
+    fim_gerado = start + n - 1
+    ultima_linha = max(perfil["last_row"], fim_gerado)
+
+    out = destino if destino is not None else io.BytesIO()
+
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as zin, \
+            zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zout:
+
+        styles_xml = zin.read("xl/styles.xml").decode("utf-8") if "xl/styles.xml" in zin.namelist() else None
+        if styles_xml is not None and "Data" in perfil["headers"] and n:
+            data_item = next((m for m in perfil["modelo"] if m["field"] == "Data"), None)
+            styles_xml, perfil["date_style"] = _garantir_estilo_data(styles_xml, data_item["s"] if data_item else None)
+
+        content_types, wb_rels = _remover_calc_chain(
+            zin.read("[Content_Types].xml").decode("utf-8"),
+            zin.read("xl/_rels/workbook.xml.rels").decode("utf-8"),
+        )
+
+        for info in zin.infolist():
+            name = info.filename
+            if name == "xl/calcChain.xml":
+                continue
+            if name == sheet_path:
+                _escrever_aba(zin.read(name).decode("utf-8"), zout, info, perfil, df, start, fim_gerado, ultima_linha)
+                continue
+            if name == "xl/styles.xml" and styles_xml is not None:
+                data = styles_xml.encode("utf-8")
+            elif name == "xl/workbook.xml":
+                data = _forcar_recalculo(zin.read(name).decode("utf-8")).encode("utf-8")
+            elif name == "[Content_Types].xml":
+                data = content_types.encode("utf-8")
+            elif name == "xl/_rels/workbook.xml.rels":
+                data = wb_rels.encode("utf-8")
+            else:
+                data = zin.read(name)
+            zout.writestr(info, data, compress_type=info.compress_type)
+
+    if destino is None:
+        return out.getvalue()
+    return None
+
+
+def _escrever_aba(sheet_xml: str, zout: zipfile.ZipFile, info: zipfile.ZipInfo, perfil: dict,
+                  df: pd.DataFrame, start: int, fim_gerado: int, ultima_linha: int) -> None:
+    i0 = sheet_xml.find("<sheetData")
+    body_start = sheet_xml.find(">", i0) + 1
+    auto_fechado = sheet_xml[body_start - 2] == "/"
+    i1 = body_start if auto_fechado else sheet_xml.find("</sheetData>")
+    tail_start = body_start if auto_fechado else i1 + len("</sheetData>")
+
+    head = sheet_xml[:i0]
+    head = re.sub(
+        r'(<dimension ref="[A-Z]+\d+:[A-Z]+)\d+"',
+        lambda m: f'{m.group(1)}{ultima_linha}"',
+        head, count=1,
+    )
+
+    masters: dict[str, tuple[str, str]] = {}
+    removidos: set[str] = set()
+
+    zi = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    zi.compress_type = zipfile.ZIP_DEFLATED
+    with zout.open(zi, "w", force_zip64=True) as fh:
+        fh.write(head.encode("utf-8"))
+        fh.write(b"<sheetData>")
+
+        gerado = False
+        for m in _RE_ROW.finditer(sheet_xml, body_start, i1):
+            ra = _attrs(m.group(1))
+            r = int(ra.get("r", 0))
+            row_xml = m.group(0)
+
+            if 't="shared"' in row_xml:
+                for cm in _RE_CELL.finditer(m.group(2) or ""):
+                    inner = cm.group(2) or ""
+                    fm = _RE_F.search(inner) if "<f" in inner else None
+                    if fm and fm.group(2):
+                        fa = _attrs(fm.group(1))
+                        if fa.get("t") == "shared" and "si" in fa:
+                            masters[fa["si"]] = (_unescape(fm.group(2)), _attrs(cm.group(1)).get("r", ""))
+                            if start <= r <= fim_gerado:
+                                removidos.add(fa["si"])
+
+            if r < start:
+                fh.write(row_xml.encode("utf-8"))
+                continue
+            if not gerado:
+                for bloco in _gerar_linhas(perfil, df, start):
+                    fh.write(bloco.encode("utf-8"))
+                gerado = True
+            if r <= fim_gerado:
+                continue
+            fh.write(_resolver_shared_orfao(row_xml, masters, removidos).encode("utf-8"))
+
+        if not gerado:
+            for bloco in _gerar_linhas(perfil, df, start):
+                fh.write(bloco.encode("utf-8"))
+
+        fh.write(b"</sheetData>")
+        fh.write(sheet_xml[tail_start:].encode("utf-8"))
+
+
+# -----------------------------
+# Writer "patch" (XML direto, sem reescrever o resto do arquivo)
+# -----------------------------
+_RE_ROW_B = re.compile(rb"<row\b([^>]*?)(?:/>|>(.*?)</row>)", re.S)
+_RE_ROW_NUM_B = re.compile(rb'\br="(\d+)"')
+
+
+def _patch_linha(row_xml: str, r: int, novas: dict[int, str]) -> str:
+    """Substitui/insere as células de ENTRADA numa linha já existente do template.
+    Fórmulas e estilos da própria linha ficam intactos (calcChain continua válido).
+    """
+    m = _RE_ROW.fullmatch(row_xml)
+    ra = m.group(1)
+    cells: dict[int, str] = {}
+    for cm in _RE_CELL.finditer(m.group(2) or ""):
+        cr = _RE_COORD.fullmatch(_attrs(cm.group(1)).get("r", ""))
+        if cr:
+            cells[column_index_from_string(cr.group(1))] = cm.group(0)
+    cells.update(novas)
+    cols = sorted(cells)
+    if "spans=" in ra:
+        ra = re.sub(r'spans="[^"]*"', f'spans="{cols[0]}:{cols[-1]}"', ra)
+    return f"<row{ra}>" + "".join(cells[c] for c in cols) + "</row>"
+
+
+def _append_to_workbook_xml(template_bytes: bytes, df: pd.DataFrame, destino=None, perfil: dict | None = None):
+    """
+    Writer "patch": trata o template como ZIP e altera SOMENTE a aba LANCAMENTOS.
+
+    - Linhas pré-formatadas já existentes (a partir de next_row) recebem só as células de entrada;
+      fórmulas/estilos de cada linha ficam como estão (calcChain continua válido)
+    - Linhas além do fim do template são geradas da linha-modelo, com fórmulas compartilhadas
+      (t="shared": uma fórmula-mestre por coluna, sem traduzir célula a célula)
+    - O trecho do XML depois da última linha alterada é copiado em bytes, sem parse
+    - Demais partes do .xlsx são copiadas sem alteração; em workbook.xml só liga fullCalcOnLoad
+      (o estilo de data só é criado em styles.xml se o template não tiver nenhum)
+    - Se passar do limite de linhas do Excel, o excedente vai para abas LANCAMENTOS_2, LANCAMENTOS_3...
+      (cópias da aba do template, com as mesmas fórmulas), adicionadas no fim do workbook e na lista
+      de planilhas de docProps/app.xml
+
+    O custo cresce com as linhas gravadas, não com o tamanho/complexidade do template.
+    destino: caminho ou arquivo binário aberto; se None, retorna os bytes do .xlsx.
+    """
+    perfil = dict(perfil or _perfil_template(template_bytes))
+    sheet_path = perfil["sheet_path"]
+    n = len(df)
+    capacidade = _capacidade_aba(perfil)
+    blocos = [df.iloc[i:i + capacidade] for i in range(0, n, capacidade)] or [df]
+
+    out = destino if destino is not None else io.BytesIO()
+
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as zin, \
+            zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zout:
+
+        styles_xml = zin.read("xl/styles.xml").decode("utf-8") if "xl/styles.xml" in zin.namelist() else None
+        styles_novo = None
+        if styles_xml is not None and "Data" in perfil["headers"] and n:
+            data_item = next((m for m in perfil["modelo"] if m["field"] == "Data"), None)
+            base = data_item["s"] if data_item else None
+            if not _estilo_e_data(styles_xml, base):
+                base = _primeiro_estilo_data(styles_xml)
+            styles_novo, perfil["date_style"] = _garantir_estilo_data(styles_xml, base)
+            if styles_novo == styles_xml:
+                styles_novo = None
+        perfil["_styles_xml"] = styles_novo or styles_xml
+
+        extras = _planejar_abas_extras(zin, sheet_path, len(blocos) - 1)
+        sheet_rels = posixpath.join(posixpath.dirname(sheet_path), "_rels", posixpath.basename(sheet_path) + ".rels")
+
+        for info in zin.infolist():
+            name = info.filename
+            if name == sheet_path:
+                sheet = zin.read(name)
+                _patch_aba(sheet, zout, name, info.date_time, perfil, blocos[0])
+                for extra, bloco in zip(extras, blocos[1:]):
+                    _patch_aba(sheet, zout, extra["part"], info.date_time, perfil, bloco, clone=True)
+                continue
+            data = zin.read(name)
+            if name == "xl/styles.xml" and styles_novo is not None:
+                data = styles_novo.encode("utf-8")
+            elif name == "xl/workbook.xml":
+                data = _forcar_recalculo(_registrar_abas_extras_wb(data.decode("utf-8"), extras)).encode("utf-8")
+            elif extras and name == "xl/_rels/workbook.xml.rels":
+                rels = "".join(
+                    f'<Relationship Id="{e["rid"]}" Type="{NS_REL}/worksheet" Target="{e["target"]}"/>'
+                    for e in extras
+                )
+                data = data.decode("utf-8").replace("</Relationships>", rels + "</Relationships>", 1).encode("utf-8")
+            elif extras and name == "docProps/app.xml":
+                data = _registrar_abas_extras_app(data.decode("utf-8"), extras).encode("utf-8")
+            elif extras and name == "[Content_Types].xml":
+                ov = "".join(
+                    f'<Override PartName="/{e["part"]}" '
+                    f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                    for e in extras
+                )
+                data = data.decode("utf-8").replace("</Types>", ov + "</Types>", 1).encode("utf-8")
+            elif extras and name == sheet_rels:
+                for e in extras:
+                    zout.writestr(
+                        posixpath.join(posixpath.dirname(e["part"]), "_rels", posixpath.basename(e["part"]) + ".rels"),
+                        data,
+                    )
+            zout.writestr(info, data, compress_type=info.compress_type)
+
+    if destino is None:
+        return out.getvalue()
+    return None
+
+
+# -----------------------------
+# Limite de linhas do Excel (1.048.576) -> abas extras
+# -----------------------------
+EXCEL_MAX_LINHAS = 1_048_576
+
+
+def _capacidade_aba(perfil: dict) -> int:
+    """Quantos itens cabem numa aba LANCAMENTOS a partir da próxima linha livre."""
+    return max(1, EXCEL_MAX_LINHAS - perfil["next_row"] + 1)
+
+
+def _checar_limite_excel(perfil: dict, n: int) -> None:
+    """Writers de aba única (openpyxl/streaming) não dividem: falha cedo e com mensagem clara."""
+    cap = _capacidade_aba(perfil)
+    if n > cap:
+        raise ValueError(
+            f"{n} itens não cabem numa aba do Excel (máx. {cap} a partir da linha {perfil['next_row']}). "
+            "Use o modo 'XML direto' (cria abas LANCAMENTOS_2, LANCAMENTOS_3...) ou gere um arquivo por partição."
+        )
+
+
+def _planejar_abas_extras(zin: zipfile.ZipFile, sheet_path: str, qtd: int) -> list[dict]:
+    """Define nome/parte/rId das abas LANCAMENTOS_2..N (sem colidir com o que já existe)."""
+    if qtd <= 0:
+        return []
+    wb = zin.read("xl/workbook.xml").decode("utf-8")
+    rels = zin.read("xl/_rels/workbook.xml.rels").decode("utf-8")
+    nomes = {_unescape(x) for x in re.findall(r'<sheet\b[^>]*\bname="([^"]*)"', wb)}
+    ids = [int(x) for x in re.findall(r'<sheet\b[^>]*\bsheetId="(\d+)"', wb)]
+    rids = set(re.findall(r'\bId="([^"]*)"', rels))
+    partes = set(zin.namelist())
+    pasta = posixpath.dirname(sheet_path)
+
+    extras = []
+    num_aba, num_parte, num_rid = 2, 1, 1
+    prox_id = max(ids + [0]) + 1
+    for _ in range(qtd):
+        while f"{ABA_LANCAMENTOS}_{num_aba}" in nomes:
+            num_aba += 1
+        while f"{pasta}/sheet{num_parte}.xml" in partes:
+            num_parte += 1
+        while f"rIdLanc{num_rid}" in rids:
+            num_rid += 1
+        part = f"{pasta}/sheet{num_parte}.xml"
+        extras.append({
+            "nome": f"{ABA_LANCAMENTOS}_{num_aba}",
+            "part": part,
+            "target": posixpath.relpath(part, "xl"),
+            "rid": f"rIdLanc{num_rid}",
+            "sheet_id": prox_id,
+        })
+        nomes.add(extras[-1]["nome"])
+        partes.add(part)
+        rids.add(extras[-1]["rid"])
+        prox_id += 1
+    return extras
+
+
+def _registrar_abas_extras_wb(workbook_xml: str, extras: list[dict]) -> str:
+    if not extras:
+        return workbook_xml
+    # no fim de <sheets>: não desloca localSheetId de nomes definidos nem a aba ativa
+    novas = "".join(
+        f'<sheet name="{e["nome"]}" sheetId="{e["sheet_id"]}" r:id="{e["rid"]}"/>' for e in extras
+    )
+    return workbook_xml.replace("</sheets>", novas + "</sheets>", 1)
+
+
+_RE_PAR_TITULOS = re.compile(
+    r"(<vt:variant>\s*<vt:lpstr>([^<]*)</vt:lpstr>\s*</vt:variant>\s*<vt:variant>\s*<vt:i4>)(\d+)(</vt:i4>)"
+)
+
+
+def _registrar_abas_extras_app(app_xml: str, extras: list[dict]) -> str:
+    """
+    docProps/app.xml: nomes das abas novas em TitlesOfParts (logo depois das planilhas existentes)
+    e contagem do grupo de planilhas em HeadingPairs. O grupo é o que contém LANCAMENTOS (o rótulo
+    varia com o idioma do Excel: Worksheets, Planilhas...). Sem essas listas, fica como está.
+    """
+    hp = re.search(r"<HeadingPairs>.*?</HeadingPairs>", app_xml, re.S)
+    tp = re.search(r"(<TitlesOfParts>\s*<vt:vector\b[^>]*>)(.*?)(</vt:vector>\s*</TitlesOfParts>)", app_xml, re.S)
+    if not extras or not hp or not tp:
+        return app_xml
+    pares = [(m.group(2), int(m.group(3))) for m in _RE_PAR_TITULOS.finditer(hp.group(0))]
+    titulos = re.findall(r"<vt:lpstr>[^<]*</vt:lpstr>", tp.group(2))
+
+    grupo, inicio = None, 0
+    for i, (_, qtd) in enumerate(pares):
+        if f"<vt:lpstr>{ABA_LANCAMENTOS}</vt:lpstr>" in titulos[inicio:inicio + qtd]:
+            grupo = i
+            break
+        inicio += qtd
+    if grupo is None or sum(q for _, q in pares) != len(titulos):
+        return app_xml  # listas inconsistentes: não arrisca piorar
+    fim = inicio + pares[grupo][1]
+    titulos[fim:fim] = [f"<vt:lpstr>{e['nome']}</vt:lpstr>" for e in extras]
+
+    cont = iter(range(len(pares)))
+    heading = _RE_PAR_TITULOS.sub(
+        lambda m: m.group(1) + str(int(m.group(3)) + (len(extras) if next(cont) == grupo else 0)) + m.group(4),
+        hp.group(0),
+    )
+    abertura = re.sub(r'\bsize="\d+"', f'size="{len(titulos)}"', tp.group(1), count=1)
+    return (
+        app_xml[:hp.start()] + heading + app_xml[hp.end():tp.start()]
+        + abertura + "".join(titulos) + tp.group(3) + app_xml[tp.end():]
+    )
+
+
+def _primeiro_estilo_data(styles_xml: str) -> str | None:
+    i = styles_xml.find("<cellXfs")
+    j = styles_xml.find("</cellXfs>")
+    for k in range(len(re.findall(r"<xf\b", styles_xml[i:j]))):
+        if _estilo_e_data(styles_xml, str(k)):
+            return str(k)
+    return None
+
+
+def _patch_aba(sheet: bytes, zout: zipfile.ZipFile, nome_parte: str, date_time, perfil: dict,
+               df: pd.DataFrame, clone: bool = False) -> None:
+    """Grava uma aba LANCAMENTOS (ou cópia dela, clone=True) com as linhas de df."""
+    start = perfil["next_row"]
+    fim = start + len(df) - 1
+    last_row = perfil["last_row"]
+    i0 = sheet.find(b"<sheetData")
+    body_start = sheet.find(b">", i0) + 1
+    auto_fechado = sheet[body_start - 2:body_start - 1] == b"/"
+    i1 = body_start if auto_fechado else sheet.find(b"</sheetData>")
+
+    # primeira linha existente >= start (o que vem antes é copiado em bytes)
+    rows_it = _RE_ROW_B.finditer(sheet, body_start, i1)
+    atual = None
+    for m in rows_it:
+        rn = _RE_ROW_NUM_B.search(m.group(1))
+        if rn and int(rn.group(1)) >= start:
+            atual = m
+            break
+    corte = atual.start() if atual is not None else i1
+
+    head = sheet[:corte]
+    if fim > last_row:
+        head = re.sub(
+            rb'(<dimension ref="[A-Z]+\d+:[A-Z]+)\d+"',
+            lambda mm: mm.group(1) + str(fim).encode() + b'"',
+            head, count=1,
+        )
+    if auto_fechado:
+        head = head[:i0] + b"<sheetData>"
+    if clone:
+        # só a aba original fica selecionada (várias selecionadas = abas agrupadas no Excel)
+        head = head.replace(b' tabSelected="1"', b"")
+
+    # linhas novas depois do fim do template: fórmulas compartilhadas
+    max_si = perfil["max_si"]
+    cols_formula = [m["col"] for m in perfil["modelo"] if "formula" in m]
+    shared_si = {c: str(max_si + 1 + k) for k, c in enumerate(cols_formula)}
+
+    modelo = perfil["modelo"]
+    date_style = perfil.get("date_style")
+    styles_xml = perfil.get("_styles_xml") or ""
+    cache_data: dict[str | None, bool] = {}
+    headers = perfil["headers"]
+    campos = [f for f in CAMPOS_ENTRADA if f in headers and f in df.columns]
+    itens_entrada = [m for m in modelo if m["field"] in campos]
+
+    zi = zipfile.ZipInfo(nome_parte, date_time=date_time)
+    zi.compress_type = zipfile.ZIP_DEFLATED
+    with zout.open(zi, "w", force_zip64=True) as fh:
+        fh.write(head)
+
+        # 1) linhas dentro do template: patch (ou gera, se a linha não existir)
+        k_template = max(0, min(len(df), last_row - start + 1))
+        bloco: list[str] = []
+        r = start
+        for pos, valores in enumerate(df[campos].iloc[:k_template].itertuples(index=False, name=None)):
+            while atual is not None and int(_RE_ROW_NUM_B.search(atual.group(1)).group(1)) < r:
+                atual = next(rows_it, None)
+            existente = None
+            if atual is not None and int(_RE_ROW_NUM_B.search(atual.group(1)).group(1)) == r:
+                existente = atual.group(0).decode("utf-8")
+                atual = next(rows_it, None)
+            if existente is None:
+                bloco.extend(_gerar_linhas(perfil, df.iloc[pos:pos + 1], r))
+            else:
+                linha = dict(zip(campos, valores))
+                estilos = dict(re.findall(r'<c r="([A-Z]+)%d"[^>]*?\bs="(\d+)"' % r, existente))
+                novas = {}
+                for item in itens_entrada:
+                    val = _normaliza_valor(linha.get(item["field"]))
+                    s = estilos.get(item["letter"], item["s"])
+                    if item["field"] == "Data" and isinstance(val, date):
+                        if s not in cache_data:
+                            cache_data[s] = _estilo_e_data(styles_xml, s)
+                        if not cache_data[s]:
+                            s = date_style or s
+                    novas[item["col"]] = _cell_xml_valor(f"{item['letter']}{r}", s, val)
+                bloco.append(_patch_linha(existente, r, novas))
+            r += 1
+            if len(bloco) >= LINHAS_POR_BLOCO:
+                fh.write("".join(bloco).encode("utf-8"))
+                bloco = []
+        if bloco:
+            fh.write("".join(bloco).encode("utf-8"))
+
+        # 2) resto do template (sem parse) + linhas novas depois do fim
+        resto = atual.start() if atual is not None else i1
+        fh.write(sheet[resto:i1])
+        if len(df) > k_template:
+            for txt in _gerar_linhas(perfil, df.iloc[k_template:], r, shared_si=shared_si):
+                fh.write(txt.encode("utf-8"))
+        if auto_fechado:
+            fh.write(b"</sheetData>")
+            fh.write(sheet[body_start:])
+        else:
+            fh.write(sheet[i1:])
+
+
+# -----------------------------
+# Partições: um .xlsx por mês / CNPJ emitente, gerados em paralelo -> 1 ZIP
+# -----------------------------
+CRITERIOS_PARTICAO = {
+    "mes": "Data",
+    "cnpj": "CNPJ Emitente",
+}
+
+
+def _chave_particao(df: pd.DataFrame, por: str) -> pd.Series:
+    col = CRITERIOS_PARTICAO[por]
+    if col not in df.columns:
+        raise ValueError(f"Coluna '{col}' não existe na tabela; não dá para separar por {por}.")
+    if por == "mes":
+        datas = pd.to_datetime(df[col], errors="coerce")
+        return datas.dt.strftime("%Y-%m").fillna("sem_data")
+    chave = df[col].astype("string").str.replace(r"\D", "", regex=True)
+    return chave.mask(chave.isna() | (chave == ""), "sem_cnpj").astype(str)
+
+
+def _particoes(df: pd.DataFrame, por: str) -> list[tuple[str, pd.DataFrame]]:
+    """Grupos (chave, df) em ordem de chave; a ordem das linhas dentro de cada grupo é mantida."""
+    chaves = _chave_particao(df, por)
+    return [(str(k), g) for k, g in df.groupby(chaves, sort=True)]
+
+
+def _nome_particao(prefixo: str, chave: str) -> str:
+    return f"{prefixo}_{re.sub(r'[^0-9A-Za-z_-]+', '_', chave)}.xlsx"
+
+
+def _gerar_particao(template_bytes: bytes, perfil: dict, df: pd.DataFrame, caminho: str) -> tuple[int, float]:
+    """Roda no processo filho (função de módulo: precisa ser picklável)."""
+    t0 = time.perf_counter()
+    _append_to_workbook_xml(template_bytes, df, destino=caminho, perfil=perfil)
+    return len(df), time.perf_counter() - t0
+
+
+def _gerar_zip_particoes(template_bytes: bytes, df: pd.DataFrame, por: str = "mes", destino=None,
+                         max_workers: int | None = None, prefixo: str = "planilha"):
+    """
+    Gera um .xlsx por partição (mês de Data ou CNPJ emitente) e entrega tudo num ZIP.
+
+    - Cada arquivo é o template com a aba LANCAMENTOS preenchida (writer XML direto);
+      partição acima do limite do Excel ganha abas LANCAMENTOS_2... no próprio arquivo
+    - Partições são gravadas em paralelo (ProcessPoolExecutor, contexto "spawn": não faz fork
+      do servidor do Streamlit e funciona igual no Windows); com 1 partição roda no próprio processo
+    - Os .xlsx já vêm comprimidos, então entram no ZIP sem recompressão (ZIP_STORED)
+
+    Retorna (zip_bytes ou None se destino foi passado, relatorio), onde relatorio é uma lista
+    de dicts {"particao", "arquivo", "linhas", "segundos"} na ordem das partições.
+    """
+    perfil = _perfil_template(template_bytes)
+    grupos = _particoes(df, por)
+    out = destino if destino is not None else io.BytesIO()
+    relatorio = []
+
+    with tempfile.TemporaryDirectory(prefix="extrator_part_") as tmp:
+        tarefas = [(chave, g, os.path.join(tmp, _nome_particao(prefixo, chave))) for chave, g in grupos]
+        resultados: dict[str, tuple[int, float]] = {}
+        workers = max_workers or min(len(tarefas), os.cpu_count() or 1)
+
+        if workers > 1 and len(tarefas) > 1:
+            try:
+                ctx = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+                    futs = {pool.submit(_gerar_particao, template_bytes, perfil, g, caminho): chave
+                            for chave, g, caminho in tarefas}
+                    for fut in as_completed(futs):
+                        resultados[futs[fut]] = fut.result()
+            except (OSError, BrokenProcessPool):
+                # ambiente sem suporte a subprocessos/semáforos: gera em sequência
+                resultados = {}
+        for chave, g, caminho in tarefas:
+            if chave not in resultados:
+                resultados[chave] = _gerar_particao(template_bytes, perfil, g, caminho)
+
+        with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zout:
+            for chave, g, caminho in tarefas:
+                linhas, seg = resultados[chave]
+                zout.write(caminho, arcname=os.path.basename(caminho))
+                relatorio.append({
+                    "particao": chave,
+                    "arquivo": os.path.basename(caminho),
+                    "linhas": linhas,
+                    "segundos": round(seg, 3),
+                })
+
+    if destino is None:
+        return out.getvalue(), relatorio
+    return None, relatorio
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+"""
+Serviço HTTP local do extrator (integração com ERP, sem a interface Streamlit)
+
+- POST /extrair   corpo = 1 XML, 1 pacote (ZIP/gzip/tar, inclusive aninhados) ou multipart/form-data com vários arquivos
+                  resposta em JSON Lines (application/x-ndjson, chunked), uma linha por registro:
+                  {"tipo": "item" | "nota" | "cancelamento" | "erro" | "resumo", ...}
+                  ?validar=1 acrescenta as colunas de validação da base IBS/CBS em cada item
+- POST /planilha  mesmas entradas; devolve a planilha preenchida (.xlsx, writer XML direto)
+- GET  /saude     ocupação do serviço
+
+- Documentos são processados num pool de processos (paralelismo real; parse é CPU)
+- Backpressure: no máximo MAX_REQUISICOES em andamento; acima disso responde 429 na hora
+  (com Retry-After e Connection: close) em vez de enfileirar sem limite. O corpo recusado não é
+  guardado: é descartado em blocos de 64 KB (até DESCARTE_MAX) e a conexão fecha. Cada requisição
+  mantém no máximo JANELA_POR_REQUISICAO documentos no pool ao mesmo tempo.
+- POST sem Content-Length responde 411; corpo vazio, 400; acima de MAX_CORPO, 413
+
+Uso:
+    python servidor.py servir --porta 8765
+    curl -s --data-binary @nota.xml -H "Content-Type: application/xml" http://127.0.0.1:8765/extrair
+    python servidor.py carga --xml pasta_xmls/ --requisicoes 200 --concorrencia 16   # teste de carga local
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+import multiprocessing
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime
+from email.parser import BytesParser
+from email.policy import default as politica_email
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs, quote
+
+import pandas as pd
+
+from extrator import (
+    _novo_estado_lote, _documentos_do_arquivo, _ingerir_documento, _arquivos_de_entrada, _tipo_pacote,
+    aplicar_validacao_base_ibscbs, _n_itens, _tabela_itens, _linhas_itens,
+)
+from campos_nfe import _datas
+
+TEMPLATE_PATH = Path(__file__).parent / "planilha_modelo.xlsx"
+
+# Limites (podem vir do ambiente)
+MAX_REQUISICOES = int(os.environ.get("EXTRATOR_MAX_REQUISICOES", "8"))
+TRABALHADORES = int(os.environ.get("EXTRATOR_TRABALHADORES", "0")) or (os.cpu_count() or 1)
+JANELA_POR_REQUISICAO = 64
+MAX_CORPO = 512 * 1024 * 1024
+# Corpo recusado (429/413): descartado em blocos fixos, até este tamanho (acima disso, só fecha a conexão)
+DESCARTE_MAX = 8 * 1024 * 1024
+_BLOCO_DESCARTE = 64 * 1024
+
+
+# -----------------------------
+# Processamento (roda no processo filho: funções de módulo, picklável)
+# -----------------------------
+def _json_default(v):
+    if isinstance(v, (date, datetime)):
+        return v.isoformat()
+    if hasattr(v, "item"):
+        return v.item()
+    return str(v)
+
+
+def _limpar(reg: dict) -> dict:
+    # NaN não é JSON válido
+    return {k: (None if isinstance(v, float) and math.isnan(v) else v) for k, v in reg.items()}
+
+
+def _extrair_documento(src: str, xb: bytes, validar: bool) -> dict:
+    """Um XML -> estado do lote (sem deduplicação: ela é feita por requisição, pela assinatura)."""
+    estado = _novo_estado_lote()
+    _ingerir_documento(estado, src, xb)
+    colunas = estado.pop("colunas_itens")
+    if validar and _n_itens(colunas):
+        df = aplicar_validacao_base_ibscbs(_tabela_itens(colunas))
+        df["Data"] = df["Data"].dt.date  # no JSON, "AAAA-MM-DD" como nas linhas sem validação
+        estado["rows"] = df.to_dict("records")
+    else:
+        estado["rows"] = _linhas_itens(colunas)
+    for nota, data in zip(estado["notas"], _datas([n["Data"] for n in estado["notas"]]).tolist()):
+        nota["Data"] = data
+    estado["sig"] = next(iter(estado.pop("vistos")))
+    return estado
+
+
+# -----------------------------
+# Entrada: XML, ZIP ou multipart
+# -----------------------------
+def _arquivos_da_requisicao(content_type: str, corpo: bytes, nome_padrao: str) -> list[tuple[str, bytes]]:
+    ct = (content_type or "").lower()
+    if ct.startswith("multipart/form-data"):
+        msg = BytesParser(policy=politica_email).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + corpo
+        )
+        arquivos = []
+        for parte in msg.iter_parts():
+            dados = parte.get_payload(decode=True) or b""
+            nome = parte.get_filename() or parte.get_param("name", header="content-disposition") or nome_padrao
+            arquivos.append((nome, dados))
+        return arquivos
+    if _tipo_pacote(nome_padrao) not in (None, "xml"):
+        return [(nome_padrao, corpo)]
+    if "gzip" in ct or corpo[:2] == b"\x1f\x8b":
+        return [(nome_padrao + ".gz", corpo)]
+    if "zip" in ct or corpo[:4] == b"PK\x03\x04":
+        return [(nome_padrao + ".zip", corpo)]
+    if "tar" in ct:
+        return [(nome_padrao + ".tar", corpo)]
+    return [(nome_padrao, corpo)]
+
+
+def _documentos(arquivos: list[tuple[str, bytes]], erros: list[str]):
+    for nome, dados in arquivos:
+        n = 0
+        try:
+            for src, xb in _documentos_do_arquivo(nome, dados):
+                n += 1
+                yield src, xb
+        except Exception as e:
+            erros.append(f"{nome}: erro ao ler ({e})")
+            continue
+        if n == 0:
+            erros.append(f"{nome}: pacote sem .xml")
+
+
+def _processar(pool, arquivos: list[tuple[str, bytes]], validar: bool):
+    """
+    Gera (tipo, registro) na ordem dos documentos, com no máximo JANELA_POR_REQUISICAO no pool.
+    No fim gera ("resumo", ...) com totais da requisição.
+    """
+    t0 = time.perf_counter()
+    erros_leitura: list[str] = []
+    vistos: set[str] = set()
+    resumo = {"processados": 0, "duplicados": 0, "itens": 0, "cancelamentos": 0, "erros": 0,
+              "totais": {"vICMS": 0.0, "vPIS": 0.0, "vCOFINS": 0.0}}
+    pendentes: deque = deque()
+
+    def _emitir(estado):
+        if estado["sig"] in vistos:
+            resumo["duplicados"] += 1
+            return
+        vistos.add(estado["sig"])
+        resumo["processados"] += 1
+        for k, v in estado["totais"].items():
+            resumo["totais"][k] += v
+        for nota in estado["notas"]:
+            yield "nota", nota
+        for row in estado["rows"]:
+            resumo["itens"] += 1
+            yield "item", row
+        for ce in estado["cancelados"]:
+            resumo["cancelamentos"] += 1
+            yield "cancelamento", ce
+        for e in estado["erros"]:
+            resumo["erros"] += 1
+            yield "erro", {"mensagem": e}
+
+    for src, xb in _documentos(arquivos, erros_leitura):
+        pendentes.append(pool.submit(_extrair_documento, src, xb, validar))
+        if len(pendentes) >= JANELA_POR_REQUISICAO:
+            yield from _emitir(pendentes.popleft().result())
+        while erros_leitura:
+            resumo["erros"] += 1
+            yield "erro", {"mensagem": erros_leitura.pop(0)}
+    while pendentes:
+        yield from _emitir(pendentes.popleft().result())
+    for e in erros_leitura:
+        resumo["erros"] += 1
+        yield "erro", {"mensagem": e}
+
+    resumo["totais"] = {k: round(v, 2) for k, v in resumo["totais"].items()}
+    resumo["segundos"] = round(time.perf_counter() - t0, 3)
+    yield "resumo", resumo
+
+
+# -----------------------------
+# HTTP
+# -----------------------------
+class _Servidor(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, endereco, pool, max_requisicoes: int):
+        super().__init__(endereco, _Handler)
+        self.pool = pool
+        self.vagas = threading.BoundedSemaphore(max_requisicoes)
+        self.capacidade = max_requisicoes
+        self.ocupados = 0
+        self.recusadas = 0
+        self._lock = threading.Lock()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "ExtratorIBSCBS/1.0"
+
+    def log_message(self, fmt, *args):  # silencioso por padrão (carga gera milhares de linhas)
+        if os.environ.get("EXTRATOR_LOG_HTTP"):
+            super().log_message(fmt, *args)
+
+    def handle_expect_100(self):
+        # cliente que pergunta antes de mandar o corpo (Expect: 100-continue, ex.: curl com corpo grande):
+        # sem vaga, o 429 sai antes de qualquer byte do corpo
+        srv = self.server
+        if self.command == "POST" and srv.ocupados >= srv.capacidade:
+            with srv._lock:
+                srv.recusadas += 1
+            self.close_connection = True
+            self._json(429, {"erro": "serviço ocupado, tente novamente"}, {"Retry-After": "1", "Connection": "close"})
+            return False
+        return super().handle_expect_100()
+
+    # ---- respostas simples
+    def _json(self, status: int, obj: dict, extra: dict | None = None):
+        corpo = json.dumps(obj, ensure_ascii=False, default=_json_default).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(corpo)))
+        for k, v in (extra or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _chunk(self, dados: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(dados), dados))
+
+    def _recusar(self, status: int, obj: dict, extra: dict | None = None):
+        """Responde sem ler o corpo (memória constante) e fecha a conexão depois de descartar o que chegou."""
+        self.close_connection = True
+        self._json(status, obj, {**(extra or {}), "Connection": "close"})
+        try:
+            restante = min(int(self.headers.get("Content-Length") or 0), DESCARTE_MAX)
+        except ValueError:
+            restante = 0
+        # lê e joga fora (sem isso o fechamento com dados pendentes vira RST e o cliente pode perder a resposta)
+        while restante > 0:
+            bloco = self.rfile.read(min(restante, _BLOCO_DESCARTE))
+            if not bloco:
+                break
+            restante -= len(bloco)
+
+    def _ler_corpo(self) -> bytes | None:
+        cl = self.headers.get("Content-Length")
+        if cl is None:
+            self._recusar(411, {"erro": "Content-Length obrigatório"})
+            return None
+        try:
+            tamanho = int(cl)
+        except ValueError:
+            tamanho = -1
+        if tamanho < 0:
+            self._recusar(400, {"erro": "Content-Length inválido"})
+            return None
+        if tamanho == 0:
+            self._recusar(400, {"erro": "corpo vazio: envie um XML, pacote ou multipart"})
+            return None
+        if tamanho > MAX_CORPO:
+            self._recusar(413, {"erro": f"corpo maior que {MAX_CORPO} bytes"})
+            return None
+        return self.rfile.read(tamanho)
+
+    # ---- rotas
+    def do_GET(self):
+        if urlsplit(self.path).path == "/saude":
+            srv = self.server
+            self._json(200, {"status": "ok", "ocupados": srv.ocupados, "capacidade": srv.capacidade,
+                             "recusadas": srv.recusadas})
+        else:
+            self._json(404, {"erro": "rota não encontrada"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path not in ("/extrair", "/planilha"):
+            self._json(404, {"erro": "rota não encontrada"})
+            return
+        srv = self.server
+        # backpressure: sem vaga -> 429 imediato, sem guardar o corpo (descartado em blocos) e fechando a conexão
+        if not srv.vagas.acquire(blocking=False):
+            with srv._lock:
+                srv.recusadas += 1
+            self._recusar(429, {"erro": "serviço ocupado, tente novamente"}, {"Retry-After": "1"})
+            return
+        with srv._lock:
+            srv.ocupados += 1
+        try:
+            corpo = self._ler_corpo()
+            if corpo is None:
+                return
+            qs = parse_qs(url.query)
+            nome = (qs.get("nome") or ["upload.xml"])[0]
+            arquivos = _arquivos_da_requisicao(self.headers.get("Content-Type", ""), corpo, nome)
+            if url.path == "/extrair":
+                self._responder_jsonl(arquivos, validar=(qs.get("validar") or ["0"])[0] in ("1", "true", "sim"))
+            else:
+                self._responder_planilha(arquivos)
+        finally:
+            with srv._lock:
+                srv.ocupados -= 1
+            srv.vagas.release()
+
+    def _responder_jsonl(self, arquivos, validar: bool):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        buf: list[bytes] = []
+        tam = 0
+        for tipo, reg in _processar(self.server.pool, arquivos, validar):
+            linha = json.dumps({"tipo": tipo, **_limpar(reg)}, ensure_ascii=False, default=_json_default)
+            buf.append(linha.encode("utf-8") + b"\n")
+            tam += len(buf[-1])
+            if tam >= 64 * 1024 or tipo == "resumo":
+                self._chunk(b"".join(buf))
+                buf, tam = [], 0
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _responder_planilha(self, arquivos):
+        from planilha_export import _append_to_workbook_xml
+
+        rows = [reg for tipo, reg in _processar(self.server.pool, arquivos, False) if tipo == "item"]
+        df = pd.DataFrame(rows)
+        if not df.empty:
+            df["Data"] = pd.to_datetime(df["Data"], errors="coerce")
+        try:
+            xlsx = _append_to_workbook_xml(TEMPLATE_PATH.read_bytes(), df)
+        except Exception as e:
+            self._json(500, {"erro": f"falha ao gerar a planilha: {e}"})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        self.send_header("Content-Disposition", 'attachment; filename="planilha_preenchida.xlsx"')
+        self.send_header("Content-Length", str(len(xlsx)))
+        self.end_headers()
+        self.wfile.write(xlsx)
+
+
+def _criar_servidor(host: str = "127.0.0.1", porta: int = 8765, trabalhadores: int = TRABALHADORES,
+                    max_requisicoes: int = MAX_REQUISICOES, processos: bool = True):
+    """Servidor pronto para serve_forever(); porta 0 = porta livre qualquer (server_address[1])."""
+    if processos:
+        pool = ProcessPoolExecutor(max_workers=trabalhadores, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        pool = ThreadPoolExecutor(max_workers=trabalhadores)
+    return _Servidor((host, porta), pool, max_requisicoes)
+
+
+# -----------------------------
+# Teste de carga (contra localhost)
+# -----------------------------
+def _post_extrair(url: str, nome: str, dados: bytes) -> tuple[int, int, float]:
+    """(status, linhas JSONL, Retry-After) de um POST /extrair."""
+    ct = "application/zip" if nome.lower().endswith(".zip") else "application/xml"
+    req = urllib.request.Request(f"{url}/extrair?nome={quote(nome)}", data=dados, method="POST",
+                                 headers={"Content-Type": ct})
+    try:
+        with urllib.request.urlopen(req, timeout=120) as r:
+            return r.status, sum(1 for _ in r), 0.0
+    except urllib.error.HTTPError as e:
+        return e.code, 0, float(e.headers.get("Retry-After") or 1)
+    except Exception:
+        return -1, 0, 0.0
+
+
+def _carga(url: str, amostras: list[tuple[str, bytes]], requisicoes: int, concorrencia: int,
+           tentativas: int = 5) -> dict:
+    """
+    Dispara N POST /extrair com C clientes simultâneos; mede latência, vazão e 429.
+    Com 429 o cliente espera o Retry-After e tenta de novo (até `tentativas` vezes), como o ERP faria.
+    """
+    resultados: list[tuple[int, float, int]] = []
+    recusas = [0]
+    lock = threading.Lock()
+
+    def _um(i: int):
+        nome, dados = amostras[i % len(amostras)]
+        t = time.perf_counter()
+        for tentativa in range(tentativas + 1):
+            status, linhas, espera = _post_extrair(url, nome, dados)
+            if status != 429:
+                break
+            with lock:
+                recusas[0] += 1
+            if tentativa < tentativas:
+                time.sleep(espera)
+        with lock:
+            resultados.append((status, time.perf_counter() - t, linhas))
+
+    # aquecimento: sobe os processos do pool antes de medir
+    _post_extrair(url, *amostras[0])
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrencia) as ex:
+        list(ex.map(_um, range(requisicoes)))
+    total = time.perf_counter() - t0
+
+    ok = sorted(lat for st, lat, _ in resultados if st == 200)
+
+    def _pct(p):
+        return round(ok[min(len(ok) - 1, int(p * len(ok)))] * 1000, 1) if ok else None
+
+    return {
+        "requisicoes": requisicoes,
+        "concorrencia": concorrencia,
+        "ok": len(ok),
+        "respostas_429": recusas[0],
+        "desistencias_429": sum(1 for st, _, _ in resultados if st == 429),
+        "falhas": sum(1 for st, _, _ in resultados if st != 200),
+        "linhas_jsonl": sum(n for st, _, n in resultados if st == 200),
+        "segundos": round(total, 2),
+        "req_s": round(len(ok) / total, 1) if total else None,
+        "latencia_ms_p50": _pct(0.50),
+        "latencia_ms_p95": _pct(0.95),
+        "latencia_ms_max": round(ok[-1] * 1000, 1) if ok else None,
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Serviço HTTP local do extrator IBS/CBS.")
+    sub = ap.add_subparsers(dest="cmd")
+
+    s = sub.add_parser("servir", help="sobe o serviço (padrão)")
+    s.add_argument("--host", default="127.0.0.1")
+    s.add_argument("--porta", type=int, default=8765)
+    s.add_argument("--trabalhadores", type=int, default=TRABALHADORES, help="processos do pool de extração")
+    s.add_argument("--max-requisicoes", type=int, default=MAX_REQUISICOES,
+                   help="requisições simultâneas antes de responder 429")
+
+    c = sub.add_parser("carga", help="teste de carga contra localhost")
+    c.add_argument("--xml", nargs="+", required=True, help="XMLs/ZIPs/pastas usados como corpo das requisições")
+    c.add_argument("--url", help="serviço já rodando (sem isso, sobe um local numa porta livre)")
+    c.add_argument("--requisicoes", type=int, default=200)
+    c.add_argument("--concorrencia", type=int, default=16)
+    c.add_argument("--tentativas", type=int, default=5, help="novas tentativas após 429 (respeitando Retry-After)")
+    c.add_argument("--trabalhadores", type=int, default=TRABALHADORES)
+    c.add_argument("--max-requisicoes", type=int, default=MAX_REQUISICOES)
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] not in ("servir", "carga", "-h", "--help"):
+        argv.insert(0, "servir")
+    args = ap.parse_args(argv)
+    if args.cmd == "servir":
+        srv = _criar_servidor(args.host, args.porta, args.trabalhadores, args.max_requisicoes)
+        print(f"Extrator em http://{args.host}:{srv.server_address[1]} "
+              f"({args.trabalhadores} processos, até {args.max_requisicoes} requisições)", file=sys.stderr)
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            srv.server_close()
+            srv.pool.shutdown(cancel_futures=True)
+        return 0
+
+    amostras = [(p.name, p.read_bytes()) for p in _arquivos_de_entrada(args.xml)]
+    if not amostras:
+        print("nenhum .xml/.zip encontrado em --xml", file=sys.stderr)
+        return 2
+    srv = None
+    url = args.url
+    if not url:
+        srv = _criar_servidor("127.0.0.1", 0, args.trabalhadores, args.max_requisicoes)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{srv.server_address[1]}"
+    try:
+        rel = _carga(url.rstrip("/"), amostras, args.requisicoes, args.concorrencia, args.tentativas)
+    finally:
+        if srv is not None:
+            srv.shutdown()
+            srv.server_close()
+            srv.pool.shutdown(cancel_futures=True)
+    print(json.dumps(rel, ensure_ascii=False, indent=2))
+    return 0 if rel["falhas"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Ingestão em segundo plano: o job só conta como concluído com o último parcial coletado."""
+import threading
+
+import ingestao
+from ingestao import _aguardar_ingestao, _coletar_ingestao, _ingestao_concluida, _iniciar_ingestao
+from test_pacotes import _nfe
+
+
+def test_fim_entre_coleta_e_checagem(monkeypatch):
+    liberar = threading.Event()
+
+    def _documentos(nome, dados):
+        yield f"{nome}:1.xml", _nfe(1)
+        liberar.wait(5)
+        yield f"{nome}:2.xml", _nfe(2)
+
+    monkeypatch.setattr(ingestao, "_contar_documentos", lambda nome, dados: 2)
+    monkeypatch.setattr(ingestao, "_documentos_do_arquivo", _documentos)
+    job = _iniciar_ingestao([("lote.zip", b"")])
+
+    _coletar_ingestao(job)
+    # a thread termina entre a coleta e a checagem: o último parcial ainda está na fila
+    liberar.set()
+    job["thread"].join(5)
+    assert job["fim"] is not None
+    assert not _ingestao_concluida(job)
+
+    _coletar_ingestao(job)
+    assert _ingestao_concluida(job)
+    assert sorted(n["Numero"] for n in job["resultado"]["notas"]) == ["1", "2"]
+
+
+def test_aguardar_com_timeout(monkeypatch):
+    liberar = threading.Event()
+
+    def _documentos(nome, dados):
+        liberar.wait(5)
+        yield f"{nome}:1.xml", _nfe(1)
+
+    monkeypatch.setattr(ingestao, "_contar_documentos", lambda nome, dados: 1)
+    monkeypatch.setattr(ingestao, "_documentos_do_arquivo", _documentos)
+    job = _iniciar_ingestao([("lote.zip", b"")])
+
+    assert not _aguardar_ingestao(job, timeout=0.01)
+    liberar.set()
+    job["thread"].join(5)
+    assert not _ingestao_concluida(job)
+    assert _aguardar_ingestao(job, timeout=0)
+    assert [n["Numero"] for n in job["resultado"]["notas"]] == ["1"]
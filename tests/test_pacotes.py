@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Leitura de pacotes locais (mmap) pelo extrator."""
+import io
+import zipfile
+
+import pandas as pd
+
+from extrator import _arquivo_mapeado, _documentos_do_arquivo, _extrair_lote_limitado
+
+NS = "http://www.portalfiscal.inf.br/nfe"
+
+
+def _nfe(n: int) -> bytes:
+    chave = f"3526{n:040d}"
+    return f"""<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="{NS}"><NFe><infNFe Id="NFe{chave}">
+<ide><nNF>{n}</nNF><dhEmi>2026-01-05T10:00:00-03:00</dhEmi></ide><emit><CNPJ>11111111000100</CNPJ></emit>
+<det nItem="1"><prod><cProd>1</cProd><xProd>SERVIÇO {n}</xProd><vProd>100.00</vProd><vDesc>0.00</vDesc></prod>
+<imposto><IBSCBS><CST>000</CST><cClassTrib>000001</cClassTrib><gIBSCBS><vBC>100.00</vBC>
+<vIBS>0.10</vIBS><gCBS><pCBS>0.90</pCBS><vCBS>0.90</vCBS></gCBS></gIBSCBS></IBSCBS></imposto></det>
+<total><ICMSTot><vProd>100.00</vProd><vDesc>0.00</vDesc><vNF>100.00</vNF></ICMSTot></total>
+</infNFe></NFe></nfeProc>""".encode()
+
+
+def _zip_local(caminho) -> dict:
+    """ZIP com membro sem compressão, membro comprimido e ZIP aninhado; devolve origem -> XML."""
+    interno = io.BytesIO()
+    with zipfile.ZipFile(interno, "w") as z:
+        z.writestr("c.xml", _nfe(3), compress_type=zipfile.ZIP_DEFLATED)
+    esperado = {"lote.zip:a.xml": _nfe(1), "lote.zip:b.xml": _nfe(2), "lote.zip:interno.zip:c.xml": _nfe(3)}
+    with zipfile.ZipFile(caminho, "w") as z:
+        z.writestr("a.xml", _nfe(1), compress_type=zipfile.ZIP_STORED)
+        z.writestr("b.xml", _nfe(2), compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr("interno.zip", interno.getvalue())
+    return esperado
+
+
+def test_zip_local_pelo_mmap(tmp_path):
+    caminho = tmp_path / "lote.zip"
+    esperado = _zip_local(caminho)
+    with _arquivo_mapeado(caminho) as dados:
+        lidos = {origem: bytes(xb) for origem, xb in _documentos_do_arquivo("lote.zip", dados)}
+    assert lidos == esperado
+
+
+def test_zip_local_memoria_limitada(tmp_path):
+    caminho = tmp_path / "lote.zip"
+    _zip_local(caminho)
+    destino = tmp_path / "itens.parquet"
+    res = _extrair_lote_limitado([caminho], destino, memoria_mb=64)
+    assert res["erros"] == []
+    assert res["processados"] == 3 and res["kpis"]["itens"] == 3
+    assert sorted(pd.read_parquet(destino)["Numero"].astype(str)) == ["1", "2", "3"]
+
+
+def test_memoria_limitada_paralelo_janela_minima(tmp_path):
+    caminho = tmp_path / "lote.zip"
+    _zip_local(caminho)
+    destino = tmp_path / "itens.parquet"
+    # orçamento menor que um XML: a janela em voo cai para um documento por vez, sem perder nenhum
+    res = _extrair_lote_limitado([caminho], destino, memoria_mb=0.001, max_workers=2)
+    assert res["erros"] == []
+    assert sorted(pd.read_parquet(destino)["Numero"].astype(str)) == ["1", "2", "3"]
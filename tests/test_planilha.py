@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Writer XML direto: abas LANCAMENTOS extras registradas no workbook e em docProps/app.xml."""
+import io
+import re
+import zipfile
+from pathlib import Path
+
+import planilha_export
+from extrator import _extrair_lote
+from planilha_export import _append_to_workbook_xml, _perfil_template
+from test_pacotes import _nfe
+
+TEMPLATE = Path(__file__).resolve().parent.parent / "planilha_modelo.xlsx"
+
+APP_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Properties xmlns="http://schemas.openxmlformats.org/officeDocument/2006/extended-properties" '
+    'xmlns:vt="http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes"><Application>Microsoft Excel</Application>'
+    '<HeadingPairs><vt:vector size="4" baseType="variant">'
+    '<vt:variant><vt:lpstr>Planilhas</vt:lpstr></vt:variant><vt:variant><vt:i4>5</vt:i4></vt:variant>'
+    '<vt:variant><vt:lpstr>Intervalos Nomeados</vt:lpstr></vt:variant><vt:variant><vt:i4>1</vt:i4></vt:variant>'
+    '</vt:vector></HeadingPairs>'
+    '<TitlesOfParts><vt:vector size="6" baseType="lpstr"><vt:lpstr>REGRAS_CST</vt:lpstr><vt:lpstr>CLASSTRIB</vt:lpstr>'
+    '<vt:lpstr>LANCAMENTOS</vt:lpstr><vt:lpstr>IMPORT_CCLASSTRIB</vt:lpstr><vt:lpstr>BASE_CCLASSTRIB</vt:lpstr>'
+    '<vt:lpstr>LANCAMENTOS!Print_Area</vt:lpstr></vt:vector></TitlesOfParts></Properties>'
+)
+
+
+def _template_com_app_xml() -> bytes:
+    out = io.BytesIO()
+    with zipfile.ZipFile(TEMPLATE) as zin, zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            dados = APP_XML.encode() if info.filename == "docProps/app.xml" else zin.read(info)
+            zout.writestr(info, dados)
+    return out.getvalue()
+
+
+def test_abas_extras_no_app_xml(tmp_path, monkeypatch):
+    for n in range(1, 6):
+        (tmp_path / f"n{n}.xml").write_bytes(_nfe(n))
+    df = _extrair_lote([tmp_path])["itens"]
+    template = _template_com_app_xml()
+    perfil = _perfil_template(template)
+    # 2 itens por aba: 5 itens -> LANCAMENTOS, LANCAMENTOS_2, LANCAMENTOS_3
+    monkeypatch.setattr(planilha_export, "EXCEL_MAX_LINHAS", perfil["next_row"] + 1)
+
+    with zipfile.ZipFile(io.BytesIO(_append_to_workbook_xml(template, df, perfil=perfil))) as z:
+        app = z.read("docProps/app.xml").decode()
+        abas = re.findall(r'<sheet name="([^"]*)"', z.read("xl/workbook.xml").decode())
+
+    assert abas[-2:] == ["LANCAMENTOS_2", "LANCAMENTOS_3"]
+    assert "<vt:lpstr>Planilhas</vt:lpstr></vt:variant><vt:variant><vt:i4>7</vt:i4>" in app
+    assert "<vt:lpstr>Intervalos Nomeados</vt:lpstr></vt:variant><vt:variant><vt:i4>1</vt:i4>" in app
+    titulos = re.findall(r"<vt:lpstr>([^<]*)</vt:lpstr>", app.split("<TitlesOfParts>")[1])
+    assert titulos == abas + ["LANCAMENTOS!Print_Area"]
+    assert '<vt:vector size="8" baseType="lpstr">' in app
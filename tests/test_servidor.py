@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Serviço HTTP contra localhost: carga, backpressure (429) e entradas multipart/ZIP."""
+import io
+import json
+import http.client
+import threading
+import urllib.error
+import urllib.request
+import zipfile
+
+import pytest
+
+from servidor import _carga, _criar_servidor, _post_extrair
+from test_pacotes import _nfe
+
+
+@pytest.fixture
+def servidor():
+    srv = _criar_servidor("127.0.0.1", 0, trabalhadores=2, max_requisicoes=1, processos=False)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv, f"http://127.0.0.1:{srv.server_address[1]}"
+    srv.shutdown()
+    srv.server_close()
+    srv.pool.shutdown(cancel_futures=True)
+
+
+def _post(url: str, corpo: bytes, content_type: str) -> tuple[int, list[dict]]:
+    req = urllib.request.Request(f"{url}/extrair", data=corpo, method="POST", headers={"Content-Type": content_type})
+    with urllib.request.urlopen(req, timeout=30) as r:
+        return r.status, [json.loads(linha) for linha in r]
+
+
+def _zip(docs: dict[str, bytes]) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        for nome, dados in docs.items():
+            z.writestr(nome, dados)
+    return buf.getvalue()
+
+
+def test_carga(servidor):
+    _, url = servidor
+    amostras = [("n1.xml", _nfe(1)), ("lote.zip", _zip({"a.xml": _nfe(2), "b.xml": _nfe(3)}))]
+    rel = _carga(url, amostras, requisicoes=8, concorrencia=1)
+    assert rel["ok"] == 8 and rel["falhas"] == 0
+    # XML: nota + item + resumo; ZIP com 2 notas: 2 x (nota + item) + resumo
+    assert rel["linhas_jsonl"] == 4 * 3 + 4 * 5
+
+
+def test_429_com_retry_after(servidor):
+    srv, url = servidor
+    srv.vagas.acquire()  # a única vaga ocupada
+    try:
+        req = urllib.request.Request(f"{url}/extrair", data=_nfe(1), method="POST")
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            urllib.request.urlopen(req, timeout=30)
+        assert exc.value.code == 429
+        assert exc.value.headers["Retry-After"] == "1"
+        assert exc.value.headers["Connection"] == "close"
+        assert _post_extrair(url, "n1.xml", _nfe(1)) == (429, 0, 1.0)
+        rel = _carga(url, [("n1.xml", _nfe(1))], requisicoes=2, concorrencia=2, tentativas=0)
+        assert rel["ok"] == 0 and rel["desistencias_429"] == 2
+    finally:
+        srv.vagas.release()
+    assert srv.recusadas >= 4
+    assert _post_extrair(url, "n1.xml", _nfe(1))[:2] == (200, 3)
+
+
+def test_multipart_e_zip(servidor):
+    _, url = servidor
+    fronteira = "----lote"
+    partes = b"".join(
+        f'--{fronteira}\r\nContent-Disposition: form-data; name="arquivos"; filename="{nome}"\r\n'
+        f"Content-Type: application/xml\r\n\r\n".encode() + dados + b"\r\n"
+        for nome, dados in (("n1.xml", _nfe(1)), ("n2.xml", _nfe(2)))
+    ) + f"--{fronteira}--\r\n".encode()
+    status, linhas = _post(url, partes, f"multipart/form-data; boundary={fronteira}")
+    assert status == 200
+    assert sorted(r["Numero"] for r in linhas if r["tipo"] == "nota") == ["1", "2"]
+    assert linhas[-1]["tipo"] == "resumo" and linhas[-1]["itens"] == 2
+
+    status, linhas = _post(url, _zip({"a.xml": _nfe(3), "sub/b.xml": _nfe(4), "c.xml": _nfe(3)}), "application/zip")
+    assert status == 200
+    resumo = linhas[-1]
+    assert resumo["processados"] == 2 and resumo["duplicados"] == 1 and resumo["erros"] == 0
+
+
+def test_corpo_ausente_ou_vazio(servidor):
+    _, url = servidor
+    req = urllib.request.Request(f"{url}/extrair", data=b"", method="POST")
+    with pytest.raises(urllib.error.HTTPError) as exc:
+        urllib.request.urlopen(req, timeout=30)
+    assert exc.value.code == 400
+
+    con = http.client.HTTPConnection("127.0.0.1", int(url.rsplit(":", 1)[1]), timeout=30)
+    con.putrequest("POST", "/extrair")
+    con.endheaders()  # sem Content-Length
+    r = con.getresponse()
+    assert r.status == 411 and r.getheader("Connection") == "close"
+    con.close()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Vigia de pastas (ingestão contínua dos downloads da SEFAZ)
+
+- Varre as pastas configuradas a cada INTERVALO_VARREDURA segundos (polling por mtime/tamanho,
+  sem dependência extra; funciona também em compartilhamentos de rede, onde inotify não chega)
+- Arquivo só entra quando está estável: mesmo mtime/tamanho em duas varreduras seguidas
+  (evita ler um ZIP ainda sendo copiado)
+- Deduplicação contra o que já está gravado (xml_sig do banco/acervo): nota conhecida nem é parseada
+- Grava no banco SQLite e/ou no acervo Parquet em lotes (LOTE_DOCUMENTOS por transação)
+- Checkpoint (arquivo -> [mtime_ns, tamanho]) gravado de forma atômica DEPOIS de cada lote gravado:
+  se o processo cair no meio, os arquivos do lote voltam a ser lidos e a deduplicação impede repetição
+- Arquivo com erro de leitura/parse não entra no checkpoint: volta na varredura seguinte (até
+  TENTATIVAS_MAX vezes por execução, ou antes se for alterado) e de novo quando o vigia reiniciar
+
+Uso:
+    python vigia.py /srv/sefaz/entrada /srv/sefaz/nfce --destino banco
+    python vigia.py /srv/sefaz/entrada --destino ambos --uma-vez      # uma passada (cron)
+"""
+import os
+import sys
+import json
+import signal
+import argparse
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from extrator import (
+    EXTENSOES_ENTRADA, _arquivo_mapeado, _novo_estado_lote, _documentos_do_arquivo, _ingerir_documento, _tabela_itens,
+)
+
+CHECKPOINT_PATH = Path(os.environ.get("EXTRATOR_VIGIA_CHECKPOINT") or (Path(__file__).parent / "vigia_checkpoint.json"))
+
+INTERVALO_VARREDURA = 5.0
+LOTE_DOCUMENTOS = 500
+# leituras com erro do mesmo arquivo (mesmo mtime/tamanho) antes de parar de tentar nesta execução
+TENTATIVAS_MAX = 3
+DESTINOS = ("banco", "acervo", "ambos")
+
+# extensões de cópia em andamento (navegador, rsync, robocopy...)
+_SUFIXOS_PARCIAIS = (".tmp", ".part", ".partial", ".crdownload", ".filepart")
+
+
+def _log(msg: str) -> None:
+    print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {msg}", file=sys.stderr, flush=True)
+
+
+# -----------------------------
+# Checkpoint
+# -----------------------------
+def _ler_checkpoint(caminho: Path) -> dict[str, list[int]]:
+    try:
+        dados = json.loads(caminho.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        # checkpoint ilegível: recomeça do zero (a deduplicação segura a repetição)
+        _log(f"checkpoint ignorado ({e})")
+        return {}
+    return {k: list(v) for k, v in dados.get("arquivos", {}).items()}
+
+
+def _gravar_checkpoint(caminho: Path, arquivos: dict[str, list[int]]) -> None:
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    tmp = caminho.with_name(f".{caminho.name}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"versao": 1, "gravado_em": datetime.now().isoformat(timespec="seconds"), "arquivos": arquivos}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, caminho)
+
+
+# -----------------------------
+# Varredura
+# -----------------------------
+def _varrer(pastas: list[Path]) -> dict[str, list[int]]:
+    """caminho -> [mtime_ns, tamanho] de cada .xml/.zip/.gz/.tar (recursivo; ignora ocultos e cópias parciais)."""
+    vistos: dict[str, list[int]] = {}
+    pilha = list(pastas)
+    while pilha:
+        pasta = pilha.pop()
+        try:
+            entradas = list(os.scandir(pasta))
+        except OSError as e:
+            _log(f"não consegui listar {pasta} ({e})")
+            continue
+        for ent in entradas:
+            nome = ent.name.lower()
+            if nome.startswith(".") or nome.endswith(_SUFIXOS_PARCIAIS):
+                continue
+            try:
+                if ent.is_dir(follow_symlinks=False):
+                    pilha.append(ent.path)
+                elif nome.endswith(EXTENSOES_ENTRADA):
+                    st = ent.stat()
+                    vistos[ent.path] = [st.st_mtime_ns, st.st_size]
+            except OSError:
+                continue  # sumiu entre o scandir e o stat
+    return vistos
+
+
+def _prontos(atual: dict, anterior: dict, checkpoint: dict) -> list[str]:
+    """Arquivos novos/alterados desde o checkpoint e estáveis desde a varredura anterior."""
+    return sorted(c for c, marca in atual.items() if marca != checkpoint.get(c) and marca == anterior.get(c))
+
+
+# -----------------------------
+# Destino (banco / acervo)
+# -----------------------------
+def _sigs_gravadas(destino: str) -> set[str]:
+    sigs: set[str] = set()
+    if destino in ("banco", "ambos"):
+        from banco_itens import _conectar, _sigs_do_banco
+
+        with _conectar() as con:
+            sigs |= _sigs_do_banco(con)
+    if destino in ("acervo", "ambos"):
+        from acervo import _sigs_do_acervo
+
+        acervo = _sigs_do_acervo()
+        # em "ambos", só pula o que já está nos dois
+        sigs = (sigs & acervo) if destino == "ambos" else acervo
+    return sigs
+
+
+def _gravar_lote(destino: str, estado: dict) -> str:
+    df = _tabela_itens(estado["colunas_itens"])
+    partes = []
+    if destino in ("banco", "ambos"):
+        from banco_itens import _conectar, _gravar_banco
+
+        with _conectar() as con:
+            info = _gravar_banco(con, df, estado["notas"])
+        partes.append(f"banco +{info['notas_novas']} nota(s)/{info['itens_gravados']} item(ns)")
+    if destino in ("acervo", "ambos"):
+        from acervo import _gravar_acervo
+
+        info = _gravar_acervo(df, estado["notas"])
+        partes.append(f"acervo +{info['notas_novas']} nota(s)/{info['itens_gravados']} item(ns)")
+    return ", ".join(partes)
+
+
+# -----------------------------
+# Laço principal
+# -----------------------------
+def _novo_lote(vistos: set[str]) -> dict:
+    estado = _novo_estado_lote()
+    estado["vistos"] = vistos  # deduplicação contra o destino e entre lotes
+    return estado
+
+
+def _vigiar(pastas: list[Path], destino: str = "banco", checkpoint_path: Path | None = None,
+            intervalo: float = INTERVALO_VARREDURA, lote_documentos: int = LOTE_DOCUMENTOS,
+            uma_vez: bool = False, parar: threading.Event | None = None) -> dict:
+    """
+    Roda até `parar` ser acionado (ou uma passada, com uma_vez=True).
+    Retorna contadores {"arquivos", "documentos", "duplicados", "lotes", "erros"}.
+    """
+    checkpoint_path = checkpoint_path or CHECKPOINT_PATH
+    parar = parar or threading.Event()
+    checkpoint = _ler_checkpoint(checkpoint_path)
+    vistos = _sigs_gravadas(destino)
+    _log(f"vigiando {', '.join(map(str, pastas))} -> {destino} "
+         f"({len(vistos)} nota(s) já gravadas, {len(checkpoint)} arquivo(s) no checkpoint)")
+
+    cont = {"arquivos": 0, "documentos": 0, "duplicados": 0, "lotes": 0, "erros": 0}
+    estado = _novo_lote(vistos)
+    concluidos: dict[str, list[int]] = {}  # arquivos inteiros dentro do lote ainda não gravado
+    falhas: dict[str, tuple[list[int], int]] = {}  # arquivo -> (marca, tentativas com erro); fora do checkpoint
+
+    def _fechar_lote():
+        nonlocal estado
+        if estado["processados"] or estado["duplicados"] or concluidos:
+            resumo = _gravar_lote(destino, estado) if estado["notas"] else "nada novo"
+            checkpoint.update(concluidos)
+            _gravar_checkpoint(checkpoint_path, checkpoint)
+            cont["lotes"] += 1
+            cont["documentos"] += estado["processados"]
+            cont["duplicados"] += estado["duplicados"]
+            _log(f"lote: {len(concluidos)} arquivo(s), {estado['processados']} XML(s) novo(s), "
+                 f"{estado['duplicados']} repetido(s); {resumo}")
+            concluidos.clear()
+            estado = _novo_lote(vistos)
+
+    # na primeira passada o checkpoint faz o papel da "varredura anterior": o que não mudou desde
+    # a última execução já conta como estável; o resto espera uma varredura
+    anterior = dict(checkpoint)
+    if uma_vez:
+        anterior = _varrer(pastas)
+
+    while True:
+        atual = _varrer(pastas)
+        for caminho in _prontos(atual, anterior, checkpoint):
+            if parar.is_set():
+                break
+            marca, tentativas = falhas.get(caminho, (None, 0))
+            if marca == atual[caminho] and tentativas >= TENTATIVAS_MAX:
+                continue
+            n, lido = 0, True
+            try:
+                with _arquivo_mapeado(Path(caminho)) as dados:
+                    for src, xb in _documentos_do_arquivo(caminho, dados):
+                        _ingerir_documento(estado, src, xb)
+                        n += 1
+                if n == 0:
+                    estado["erros"].append(f"{caminho}: pacote sem .xml")
+            except (FileNotFoundError, PermissionError) as e:  # movido/travado: tenta de novo depois
+                _log(f"! {caminho}: não consegui ler ({e}); tento na próxima varredura")
+                estado["erros"].clear()
+                continue
+            except Exception as e:
+                # arquivo corrompido: fica fora do checkpoint e volta na próxima varredura (o que já foi
+                # lido dele segue no lote; na nova tentativa a deduplicação pula)
+                lido = False
+                tentativas = (tentativas if marca == atual[caminho] else 0) + 1
+                falhas[caminho] = (atual[caminho], tentativas)
+                fim = "; só volta se o arquivo mudar" if tentativas >= TENTATIVAS_MAX else ""
+                estado["erros"].append(f"{caminho}: erro ao ler ({e}); tentativa {tentativas} de {TENTATIVAS_MAX}{fim}")
+            for erro in estado["erros"]:
+                _log(f"! {erro}")
+            cont["erros"] += len(estado["erros"])
+            estado["erros"].clear()
+            if not lido:
+                continue
+            falhas.pop(caminho, None)
+            concluidos[caminho] = atual[caminho]
+            cont["arquivos"] += 1
+            if estado["processados"] >= lote_documentos:
+                _fechar_lote()
+        _fechar_lote()
+
+        # arquivos apagados/movidos saem do checkpoint
+        for c in [c for c in falhas if c not in atual]:
+            del falhas[c]
+        removidos = [c for c in checkpoint if c not in atual]
+        if removidos:
+            for c in removidos:
+                del checkpoint[c]
+            _gravar_checkpoint(checkpoint_path, checkpoint)
+
+        anterior = atual
+        if uma_vez or parar.wait(intervalo):
+            break
+
+    _log(f"fim: {cont['arquivos']} arquivo(s), {cont['documentos']} XML(s) novo(s), "
+         f"{cont['duplicados']} repetido(s), {cont['erros']} erro(s)")
+    return cont
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Vigia pastas e grava os XMLs novos no banco/acervo local.")
+    ap.add_argument("pastas", nargs="+", help="pastas vigiadas (recursivo)")
+    ap.add_argument("--destino", choices=DESTINOS, default="banco",
+                    help="banco SQLite (banco_itens), acervo Parquet ou ambos")
+    ap.add_argument("--intervalo", type=float, default=INTERVALO_VARREDURA, help="segundos entre varreduras")
+    ap.add_argument("--lote", type=int, default=LOTE_DOCUMENTOS, help="XMLs novos por gravação")
+    ap.add_argument("--checkpoint", default=str(CHECKPOINT_PATH), help="arquivo de checkpoint (JSON)")
+    ap.add_argument("--uma-vez", action="store_true", help="faz uma passada e sai")
+    args = ap.parse_args(argv)
+
+    pastas = [Path(p) for p in args.pastas]
+    faltando = [str(p) for p in pastas if not p.is_dir()]
+    if faltando:
+        print(f"pasta(s) inexistente(s): {', '.join(faltando)}", file=sys.stderr)
+        return 2
+
+    parar = threading.Event()
+    for sinal in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sinal, lambda *_: parar.set())
+    _vigiar(pastas, args.destino, Path(args.checkpoint), args.intervalo, args.lote, args.uma_vez, parar)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())